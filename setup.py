@@ -4,6 +4,8 @@ from setuptools import setup, Extension, find_packages
 import subprocess
 import platform
 
+import numpy
+
 if sys.version_info < (3,4):
     print("SMPDF requires Python 3.4 or later", file=sys.stderr)
     sys.exit(1)
@@ -32,6 +34,7 @@ if platform.system() == 'Darwin':
     extra_compile_args += ['-mmacosx-version-min=%s' % mac_ver]
     extra_link_args += ['-mmacosx-version-min=%s' % mac_ver]
 module1 = Extension('applwrap',
+                    include_dirs = [numpy.get_include()],
                     extra_compile_args = extra_compile_args ,
                     extra_link_args = extra_link_args,
                     sources = ['src/applwrap/applwrap.cc'], language="c++")
@@ -4,113 +4,1060 @@
  ********************************************/
 
 #include "Python.h"
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/arrayobject.h>
 #include <LHAPDF/LHAPDF.h>
 #include <LHAPDF/Exceptions.h>
 #include <appl_grid/appl_grid.h>
 #include <appl_grid/appl_igrid.h>
+#include <algorithm>
+#include <mutex>
+#include <memory>
+#include <atomic>
+#include <functional>
+#include <unordered_map>
+#include <list>
+#include <map>
+#include <cmath>
 using std::vector;
 using std::string;
 using std::cout;
 using std::endl;
 using std::exception;
+using std::shared_ptr;
 
+// C++ exceptions must not escape a Py_BEGIN_ALLOW_THREADS block, since the
+// GIL would not be taken back. Append this to the catch clauses of the
+// try blocks in there: it records any exception in the bool failed and
+// the string error, so that the Python error is raised after
+// Py_END_ALLOW_THREADS.
+#define CATCH_ANY(failed, error)                \
+  catch (const std::exception& e)               \
+    {                                           \
+      failed = true;                            \
+      error = e.what();                         \
+    }                                           \
+  catch (...)                                   \
+    {                                           \
+      failed = true;                            \
+      error = "Unknown C++ exception";          \
+    }
+
+/*******************************************
+ * PDF node tables
+ ********************************************/
+
+// Number of flavours passed to the APPLgrid callback (-6..6).
+const int NFL = 13;
+
+struct Node
+{
+  double x, Q;
+  bool operator==(const Node& o) const { return x == o.x && Q == o.Q; }
+  bool operator<(const Node& o) const
+  {
+    return x < o.x || (x == o.x && Q < o.Q);
+  }
+};
+
+struct NodeHash
+{
+  size_t operator()(const Node& n) const
+  {
+    const size_t h = std::hash<double>()(n.x);
+    return h ^ (std::hash<double>()(n.Q) + 0x9e3779b9 + (h << 6) + (h >> 2));
+  }
+};
+
+// The distinct (x, Q) points at which a grid calls evolvepdf_.
+struct NodeLayout
+{
+  vector<Node> nodes;
+  std::unordered_map<Node, int, NodeHash> index;
+  size_t hash;
+
+  NodeLayout(vector<Node> points): nodes(points), hash(0)
+  {
+    std::sort(nodes.begin(), nodes.end());
+    nodes.erase(std::unique(nodes.begin(), nodes.end()), nodes.end());
+    index.reserve(nodes.size());
+    for (int i = 0; i < (int) nodes.size(); i++)
+      {
+        index[nodes[i]] = i;
+        hash ^= NodeHash()(nodes[i]) + 0x9e3779b9 + (hash << 6) + (hash >> 2);
+      }
+  }
+
+  int find(double x, double Q) const
+  {
+    Node n = {x, Q};
+    auto it = index.find(n);
+    return it == index.end() ? -1 : it->second;
+  }
+};
+
+// Maximum size in bytes of the rows kept by each node table. With the
+// MAX_TABLES tables of a set, this bounds the memory used by the tables of
+// a set to 4 GiB, independently of max_resident, so that the rows of large
+// sets can be reused by the next observable with the same nodes.
+const size_t MAX_TABLE_BYTES = (size_t) 512 << 20;
+
+// xfxQ of each member of a set, for all flavours, at the nodes of a layout.
+// Rows are computed on demand without the lock and stored under it. A row
+// is never modified once stored: evicting it only drops the reference of
+// the table, so a thread holding it can keep reading it without the lock.
+struct NodeTable
+{
+  shared_ptr<const NodeLayout> layout;
+  vector<shared_ptr<const vector<double> > > rows;
+  // Members with a row, least recently used first, and the position of
+  // each of them in the list, so that using or evicting a row is O(1).
+  std::list<int> filled;
+  std::unordered_map<int, std::list<int>::iterator> position;
+  // Number of rows that fit in MAX_TABLE_BYTES.
+  const int maxrows;
+  std::mutex lock;
+
+  NodeTable(shared_ptr<const NodeLayout> l, int nmembers):
+    layout(l), rows(nmembers),
+    maxrows((int) std::min((size_t) nmembers, std::max((size_t) 1,
+            MAX_TABLE_BYTES/(NFL*sizeof(double)
+                             *std::max((size_t) 1, l->nodes.size())))))
+  {}
+
+  shared_ptr<const vector<double> > row(int imem)
+  {
+    std::lock_guard<std::mutex> guard(lock);
+    return rows[imem];
+  }
+
+  // Mark the row of imem as the most recently used, if there is one. The
+  // caller must hold lock.
+  void touch(int imem)
+  {
+    auto it = position.find(imem);
+    if (it != position.end())
+      filled.splice(filled.end(), filled, it->second);
+  }
+
+  // Store the row of imem, unless another thread did it first. The caller
+  // must hold lock.
+  void store(int imem, shared_ptr<const vector<double> > values)
+  {
+    if (rows[imem])
+      {
+        touch(imem);
+        return;
+      }
+    rows[imem] = values;
+    position[imem] = filled.insert(filled.end(), imem);
+  }
+
+  // Drop the least recently used rows until there are at most keep. The
+  // caller must hold lock.
+  void evict(int keep)
+  {
+    while ((int) filled.size() > keep)
+      {
+        const int imem = filled.front();
+        rows[imem].reset();
+        position.erase(imem);
+        filled.pop_front();
+      }
+  }
+};
+
+// Lookups served from (and missed by) the node tables since the module was
+// loaded.
+std::atomic<long> _table_hits(0);
+std::atomic<long> _table_misses(0);
+
+// Maximum number of node layouts whose tables are kept for each set.
+const int MAX_TABLES = 8;
+
+// Default number of members of a set kept in memory at the same time.
+const int DEFAULT_MAX_RESIDENT = 100;
+
+// Serializes the creation of LHAPDF members, since LHAPDF keeps global
+// caches of the metadata it reads.
+std::mutex _lhapdf_load_lock;
+
+// An LHAPDF set. The members are loaded on demand, and at most max_resident
+// of them (besides the central member, which is always loaded) are kept in
+// memory, evicting the least recently used. The node tables keep the values
+// of as many members as fit in MAX_TABLE_BYTES each, so the memory used is
+// bounded independently of the size of the set.
+struct PDFSet
+{
+  const string name;
+  const int nmembers;
+  std::atomic<int> max_resident;
+  shared_ptr<LHAPDF::PDF> central;
+  // Most recently used first.
+  mutable std::list<std::pair<int, shared_ptr<LHAPDF::PDF> > > resident;
+  mutable std::mutex members_lock;
+  // Most recently used first.
+  mutable std::list<shared_ptr<NodeTable> > tables;
+  mutable std::mutex tables_lock;
+
+  PDFSet(const string& setname, int maxres):
+    name(setname), nmembers(LHAPDF::PDFSet(setname).size()),
+    max_resident(maxres), central(load(0)) {}
+
+  int size() const { return nmembers; }
+
+  bool valid(int imem) const
+  {
+    return imem >= 0 && imem < size();
+  }
+
+  // Create member imem.
+  shared_ptr<LHAPDF::PDF> load(int imem) const
+  {
+    std::lock_guard<std::mutex> guard(_lhapdf_load_lock);
+    shared_ptr<LHAPDF::PDF> pdf(LHAPDF::mkPDF(name, imem));
+    // Initialize the (lazily computed) alpha_s before the member can be
+    // shared between threads.
+    pdf->alphasQ(91.1876);
+    return pdf;
+  }
+
+  // Return member imem, loading it if it is not resident. The member stays
+  // valid for as long as the returned pointer is held, even if it is
+  // evicted meanwhile.
+  shared_ptr<LHAPDF::PDF> member(int imem) const
+  {
+    if (imem == 0)
+      return central;
+    {
+      std::lock_guard<std::mutex> guard(members_lock);
+      for (auto it = resident.begin(); it != resident.end(); ++it)
+        if (it->first == imem)
+          {
+            resident.splice(resident.begin(), resident, it);
+            return it->second;
+          }
+    }
+
+    shared_ptr<LHAPDF::PDF> pdf = load(imem);
+    std::lock_guard<std::mutex> guard(members_lock);
+    // Another thread could have loaded it in the meantime.
+    for (auto it = resident.begin(); it != resident.end(); ++it)
+      if (it->first == imem)
+        return it->second;
+    resident.push_front(std::make_pair(imem, pdf));
+    while ((int) resident.size() > std::max(1, (int) max_resident))
+      resident.pop_back();
+    return pdf;
+  }
+
+  // Return the table for layout (shared with any other grid having the same
+  // nodes), with the rows of the given members filled. Rows of other
+  // members are evicted to keep at most t->maxrows (or mem.size() if
+  // larger) rows. The missing rows are computed without holding the lock
+  // of the table, so other threads can keep using it meanwhile.
+  shared_ptr<NodeTable> table(shared_ptr<const NodeLayout> layout,
+                              const vector<int>& mem) const
+  {
+    shared_ptr<NodeTable> t;
+    {
+      std::lock_guard<std::mutex> guard(tables_lock);
+      for (auto it = tables.begin(); it != tables.end(); ++it)
+        if ((*it)->layout->hash == layout->hash
+            && (*it)->layout->nodes == layout->nodes)
+          {
+            t = *it;
+            tables.erase(it);
+            break;
+          }
+      if (!t)
+        t = std::make_shared<NodeTable>(layout, size());
+      tables.push_front(t);
+      if ((int) tables.size() > MAX_TABLES)
+        tables.pop_back();
+    }
+
+    vector<int> missing;
+    {
+      std::lock_guard<std::mutex> guard(t->lock);
+      for (int i = 0; i < (int) mem.size(); i++)
+        if (t->rows[mem[i]])
+          t->touch(mem[i]);
+        else
+          missing.push_back(mem[i]);
+    }
+
+    const vector<Node>& nodes = t->layout->nodes;
+    vector<shared_ptr<const vector<double> > > computed;
+    computed.reserve(missing.size());
+    for (int i = 0; i < (int) missing.size(); i++)
+      {
+        shared_ptr<LHAPDF::PDF> pdf = member(missing[i]);
+        shared_ptr<vector<double> > values =
+          std::make_shared<vector<double> >(NFL*nodes.size());
+        for (int n = 0; n < (int) nodes.size(); n++)
+          for (int f = 0; f < NFL; f++)
+            (*values)[NFL*n + f] = pdf->xfxQ(f - 6, nodes[n].x, nodes[n].Q);
+        computed.push_back(values);
+      }
+
+    std::lock_guard<std::mutex> guard(t->lock);
+    for (int i = 0; i < (int) missing.size(); i++)
+      t->store(missing[i], computed[i]);
+    t->evict(std::max((int) mem.size(), t->maxrows));
+    return t;
+  }
+
+  void clear_tables() const
+  {
+    std::lock_guard<std::mutex> guard(tables_lock);
+    tables.clear();
+  }
+};
+
+// A loaded APPLgrid. appl::grid keeps internal buffers during the
+// convolution and is not reentrant, so every use of g must hold lock.
+struct Grid
+{
+  appl::grid *g;
+  std::mutex lock;
+  // Node layouts by (order, Kf). Only accessed holding lock.
+  std::map<std::pair<int, double>, shared_ptr<const NodeLayout> > layouts;
+
+  Grid(const string& file): g(new appl::grid(file)) {}
+
+  ~Grid() { delete g; }
+
+  // Return the (x, Q) nodes at which the convolution at order pto and
+  // factorization scale factor Kf evaluates the PDFs. The caller must hold
+  // lock. Nodes missing here (e.g. for unusual grid types) are still
+  // evaluated correctly by evolvepdf_, but directly through LHAPDF.
+  shared_ptr<const NodeLayout> layout(int pto, double Kf)
+  {
+    const std::pair<int, double> key(pto, Kf);
+    auto it = layouts.find(key);
+    if (it != layouts.end())
+      return it->second;
+
+    vector<int> orders;
+    if (g->calculation() == appl::grid::AMCATNLO)
+      orders.push_back((pto == 0) ? 3:0);
+    else
+      for (int iorder = 0; iorder <= pto; iorder++)
+        orders.push_back(iorder);
+
+    vector<Node> points;
+    for (int bin = 0; bin < g->Nobs(); bin++)
+      for (int io = 0; io < (int) orders.size(); io++)
+        {
+          appl::igrid const *igrid = g->weightgrid(orders[io], bin);
+          if (!igrid)
+            continue;
+          for (int t = 0; t < igrid->Ntau(); t++)
+            {
+              const double Q = Kf*std::sqrt(igrid->fQ2(igrid->gettau(t)));
+              for (int iy = 0; iy < igrid->Ny1(); iy++)
+                {
+                  Node n = {igrid->fx(igrid->gety1(iy)), Q};
+                  points.push_back(n);
+                }
+              for (int iy = 0; iy < igrid->Ny2(); iy++)
+                {
+                  Node n = {igrid->fx(igrid->gety2(iy)), Q};
+                  points.push_back(n);
+                }
+            }
+        }
+
+    shared_ptr<const NodeLayout> l = std::make_shared<NodeLayout>(points);
+    layouts[key] = l;
+    return l;
+  }
+};
+
+// State used by the module level functions. The handle objects below own
+// their own state and do not touch these.
 // I hate singletons - sc
-appl::grid *_g = nullptr;
-vector<LHAPDF::PDF*> _pdfs;
+Grid *_grid = nullptr;
+PDFSet *_pdfset = nullptr;
 int _imem = 0;
 
+// Member (and set, for alpha_s) being convolved by the current thread. Only
+// read from the APPLgrid callbacks, which have no user data argument.
+thread_local LHAPDF::PDF *_conv_pdf = nullptr;
+thread_local LHAPDF::PDF *_conv_alphas = nullptr;
+// Node layout and table row (if any) of the member being convolved.
+thread_local const NodeLayout *_conv_layout = nullptr;
+thread_local const double *_conv_row = nullptr;
+
 extern "C" void evolvepdf_(const double& x,const double& Q, double* pdf)
 {
-  for (int i = 0; i < 13; i++)
+  if (_conv_row)
+    {
+      const int i = _conv_layout->find(x, Q);
+      if (i >= 0)
+        {
+          _table_hits++;
+          std::copy(_conv_row + NFL*i, _conv_row + NFL*(i+1), pdf);
+          return;
+        }
+      _table_misses++;
+    }
+  for (int i = 0; i < NFL; i++)
     {
       const int id = i-6;
-      pdf[i] = _pdfs[_imem]->xfxQ(id, x, Q);
+      pdf[i] = _conv_pdf->xfxQ(id, x, Q);
     }
 }
 
 extern "C" double alphaspdf_(const double& Q)
 {
-  return _pdfs[0]->alphasQ(Q);
+  return _conv_alphas->alphasQ(Q);
 }
 
-static PyObject* py_initpdf(PyObject* self, PyObject* args)
+/*******************************************
+ * Helpers shared by the module functions
+ * and the handle objects
+ ********************************************/
+
+static bool check_pdfset(const PDFSet *set)
 {
-  char* setname;
-  PyArg_ParseTuple(args, "s", &setname);
+  if (!set)
+    {
+      PyErr_SetString(PyExc_ValueError, "PDF not allocated");
+      return false;
+    }
+  return true;
+}
+
+static bool check_grid(const Grid *g)
+{
+  if (!g)
+    {
+      PyErr_SetString(PyExc_ValueError, "Grid not allocated");
+      return false;
+    }
+  return true;
+}
+
+// Fill members with the indexes in pymem (all members of set if pymem is
+// None). Return false with a Python exception set on failure.
+static bool parse_members(PyObject *pymem, const PDFSet *set,
+                          vector<int>& members)
+{
+  if (pymem == Py_None)
+    {
+      for (int i = 0; i < set->size(); i++)
+        members.push_back(i);
+    }
+  else
+    {
+      PyArrayObject *mem = (PyArrayObject*) PyArray_FROM_OTF(pymem, NPY_INT,
+                                                     NPY_ARRAY_IN_ARRAY);
+      if (!mem)
+        return false;
+      const int *pmem = (const int*) PyArray_DATA(mem);
+      members.assign(pmem, pmem + PyArray_SIZE(mem));
+      Py_DECREF(mem);
+    }
 
-  for (int i = 0; i < (int) _pdfs.size(); i++)
-    if (_pdfs[i]) delete _pdfs[i];
-  _pdfs.clear();
+  for (int i = 0; i < (int) members.size(); i++)
+    if (!set->valid(members[i]))
+      {
+        PyErr_SetString(PyExc_ValueError, "PDF not allocated");
+        return false;
+      }
+  return true;
+}
+
+static PyObject* set_xfxQ(const PDFSet *set, int rep, int fl,
+                          double x, double Q)
+{
+  double res;
+  if (!check_pdfset(set))
+    return NULL;
+  if (!set->valid(rep))
+    {
+      PyErr_SetString(PyExc_ValueError, "PDF not allocated");
+      return NULL;
+    }
 
   try
   {
-    _pdfs = LHAPDF::mkPDFs(setname);
+    res = set->member(rep)->xfxQ(fl, x, Q);
   }
   catch (LHAPDF::Exception e)
   {
     PyErr_SetString(PyExc_ValueError, e.what());
     return NULL;
   }
-  _imem = 0;
 
-  return Py_BuildValue("");
+  return Py_BuildValue("d", res);
 }
 
-static PyObject* py_setverbosity(PyObject *self, PyObject *args)
+// Fill out[iQ][imem][ifl][ix] with xfxQ for every combination of the
+// given members, flavours, x points and scales. Members are visited one at
+// a time, so that only one needs to be resident.
+static void fill_xfxQ(const PDFSet *set, const vector<int>& mem,
+                      const int *fl, npy_intp nfl,
+                      const double *xs, npy_intp nx,
+                      const double *Qs, npy_intp nQ,
+                      double *out)
 {
-  int ver;
-  PyArg_ParseTuple(args, "i", &ver);
-  LHAPDF::setVerbosity(ver);
-
-  return Py_BuildValue("");
+  const npy_intp nmem = mem.size();
+  for (npy_intp r = 0; r < nmem; r++)
+    {
+      shared_ptr<LHAPDF::PDF> pdf = set->member(mem[r]);
+      for (npy_intp q = 0; q < nQ; q++)
+        {
+          double *o = out + (q*nmem + r)*nfl*nx;
+          for (npy_intp f = 0; f < nfl; f++)
+            for (npy_intp ix = 0; ix < nx; ix++)
+              *o++ = pdf->xfxQ(fl[f], xs[ix], Qs[q]);
+        }
+    }
 }
 
-static PyObject* py_xfxQ(PyObject *self, PyObject *args)
+// Shared implementation of xfxQ_grid and xfxQ_multigrid. The output has
+// shape (nQ, nmem, nfl, nx), or (nmem, nfl, nx) if squeeze_Q is set.
+static PyObject* xfxQ_tensor(const PDFSet *set,
+                             PyObject *pymem, PyObject *pyfl, PyObject *pyx,
+                             PyObject *pyQ, bool squeeze_Q)
 {
-  int rep, fl;
-  double x, Q, res;
-  PyArg_ParseTuple(args, "iidd", &rep, &fl, &x, &Q);
+  if (!check_pdfset(set))
+    return NULL;
+
+  vector<int> members;
+  if (!parse_members(pymem, set, members))
+    return NULL;
+
+  PyArrayObject *fl = (PyArrayObject*) PyArray_FROM_OTF(pyfl, NPY_INT,
+                                                        NPY_ARRAY_IN_ARRAY);
+  PyArrayObject *xs = (PyArrayObject*) PyArray_FROM_OTF(pyx, NPY_DOUBLE,
+                                                        NPY_ARRAY_IN_ARRAY);
+  PyArrayObject *Qs = (PyArrayObject*) PyArray_FROM_OTF(pyQ, NPY_DOUBLE,
+                                                        NPY_ARRAY_IN_ARRAY);
+  if (!fl || !xs || !Qs)
+    {
+      Py_XDECREF(fl); Py_XDECREF(xs); Py_XDECREF(Qs);
+      return NULL;
+    }
+
+  const npy_intp nmem = members.size();
+  const npy_intp nfl = PyArray_SIZE(fl);
+  const npy_intp nx = PyArray_SIZE(xs);
+  const npy_intp nQ = PyArray_SIZE(Qs);
 
-  if (_pdfs[rep] == 0)
+  PyArrayObject *out = NULL;
+  if (squeeze_Q)
+    {
+      npy_intp dims[3] = {nmem, nfl, nx};
+      out = (PyArrayObject*) PyArray_SimpleNew(3, dims, NPY_DOUBLE);
+    }
+  else
+    {
+      npy_intp dims[4] = {nQ, nmem, nfl, nx};
+      out = (PyArrayObject*) PyArray_SimpleNew(4, dims, NPY_DOUBLE);
+    }
+
+  if (out)
+    {
+      bool failed = false;
+      string error;
+      Py_BEGIN_ALLOW_THREADS
+      try
+      {
+        fill_xfxQ(set, members, (const int*) PyArray_DATA(fl), nfl,
+                  (const double*) PyArray_DATA(xs), nx,
+                  (const double*) PyArray_DATA(Qs), nQ,
+                  (double*) PyArray_DATA(out));
+      }
+      catch (LHAPDF::Exception e)
+      {
+        failed = true;
+        error = e.what();
+      }
+      CATCH_ANY(failed, error)
+      Py_END_ALLOW_THREADS
+      if (failed)
+        {
+          PyErr_SetString(PyExc_ValueError, error.c_str());
+          Py_CLEAR(out);
+        }
+    }
+
+  Py_DECREF(fl); Py_DECREF(xs); Py_DECREF(Qs);
+  return (PyObject*) out;
+}
+
+static PyObject* set_q2Min(const PDFSet *set)
+{
+  double res;
+  if (!check_pdfset(set))
+    return NULL;
+  if (!set->valid(0))
     {
       PyErr_SetString(PyExc_ValueError, "PDF not allocated");
       return NULL;
     }
 
-  try
-  {
-    res = _pdfs[rep]->xfxQ(fl, x, Q);
-  }
-  catch (LHAPDF::Exception e)
-  {
-    PyErr_SetString(PyExc_ValueError, e.what());
+  try
+  {
+    res = set->central->q2Min();
+  }
+  catch (LHAPDF::Exception e)
+  {
+    PyErr_SetString(PyExc_ValueError, e.what());
+    return NULL;
+  }
+
+  return Py_BuildValue("d", res);
+}
+
+static Grid* load_grid(const char *file)
+{
+  Grid *g = NULL;
+  bool failed = false;
+  string error;
+  Py_BEGIN_ALLOW_THREADS
+  try
+  {
+    g = new Grid(file);
+  }
+  catch(appl::grid::exception e)
+  {
+    error = e.what();
+  }
+  CATCH_ANY(failed, error)
+  Py_END_ALLOW_THREADS
+  if (!g)
+    PyErr_SetString(PyExc_ValueError, error.c_str());
+  return g;
+}
+
+static PDFSet* load_pdfset(const char *setname,
+                           int max_resident = DEFAULT_MAX_RESIDENT)
+{
+  PDFSet *set = NULL;
+  bool failed = false;
+  string error;
+  Py_BEGIN_ALLOW_THREADS
+  try
+  {
+    set = new PDFSet(setname, max_resident);
+  }
+  catch (LHAPDF::Exception e)
+  {
+    error = e.what();
+  }
+  CATCH_ANY(failed, error)
+  Py_END_ALLOW_THREADS
+  if (!set)
+    PyErr_SetString(PyExc_ValueError, error.c_str());
+  return set;
+}
+
+// Return the node table of set for the grid g with the rows of members
+// filled. Does not use the Python API, so it can run without the GIL.
+static shared_ptr<NodeTable> grid_table(Grid *g, const PDFSet *set,
+                                        const vector<int>& members,
+                                        int pto, double Kf)
+{
+  shared_ptr<const NodeLayout> layout;
+  {
+    std::lock_guard<std::mutex> guard(g->lock);
+    layout = g->layout(pto, Kf);
+  }
+  return set->table(layout, members);
+}
+
+// Convolute member imem of set with the grid g, taking the PDF values from
+// table when possible. The caller must hold g->lock. Does not use the
+// Python API, so it can run without the GIL.
+static vector<double> convolute_member(Grid *g, const PDFSet *set,
+                                       NodeTable *table,
+                                       int imem, int pto,
+                                       double Kr, double Kf)
+{
+  // Keep the member and its row alive during the convolution.
+  shared_ptr<LHAPDF::PDF> pdf = set->member(imem);
+  shared_ptr<const vector<double> > row;
+  if (table)
+    row = table->row(imem);
+  _conv_pdf = pdf.get();
+  _conv_alphas = set->central.get();
+  _conv_layout = table ? table->layout.get() : nullptr;
+  _conv_row = row ? row->data() : nullptr;
+  vector<double> xsec;
+  try
+  {
+    xsec = g->g->vconvolute(evolvepdf_, alphaspdf_, pto, Kr, Kf);
+  }
+  catch (...)
+  {
+    _conv_row = nullptr;
+    throw;
+  }
+  _conv_row = nullptr;
+  return xsec;
+}
+
+typedef std::pair<double, double> Scale;
+
+// Convolute the members in pymem (all if None) of set with the grid g, for
+// each (Kr, Kf) pair in scales, into a (nscales, nmem, nbins) array, or a
+// (nmem, nbins) array if squeeze is true and there is only one scale. The
+// members are processed in chunks of set->max_resident, so that only one
+// chunk needs to be in memory. Within a chunk, the node table is filled
+// once for each distinct Kf, and all the scales are computed for a member
+// before moving to the next, while its row of the table is hot.
+static PyObject* convolute_scales(Grid *g, const PDFSet *set,
+                                  PyObject *pymem, int pto,
+                                  const vector<Scale>& scales, bool squeeze)
+{
+  if (!check_grid(g) || !check_pdfset(set))
+    return NULL;
+
+  vector<int> members;
+  if (!parse_members(pymem, set, members))
+    return NULL;
+
+  const npy_intp nbins = g->g->Nobs(), nmem = members.size();
+  npy_intp dims[3] = {(npy_intp) scales.size(), nmem, nbins};
+  const bool two_d = squeeze && scales.size() == 1;
+  PyArrayObject *out = (PyArrayObject*) PyArray_SimpleNew(two_d ? 2:3,
+                                                          two_d ? dims+1:dims,
+                                                          NPY_DOUBLE);
+  if (!out)
+    return NULL;
+  double *res = (double*) PyArray_DATA(out);
+
+  // Scales grouped by Kf, which determines the nodes of the table.
+  std::map<double, vector<int> > by_Kf;
+  for (int is = 0; is < (int) scales.size(); is++)
+    by_Kf[scales[is].second].push_back(is);
+
+  bool failed = false;
+  string error;
+  Py_BEGIN_ALLOW_THREADS
+  try
+  {
+    const int chunksize = std::max(1, (int) set->max_resident);
+    for (int start = 0; start < (int) nmem; start += chunksize)
+      {
+        const int end = std::min((int) nmem, start + chunksize);
+        const vector<int> chunk(members.begin() + start,
+                                members.begin() + end);
+        for (auto it = by_Kf.begin(); it != by_Kf.end(); ++it)
+          {
+            const double Kf = it->first;
+            shared_ptr<NodeTable> table = grid_table(g, set, chunk, pto, Kf);
+            std::lock_guard<std::mutex> guard(g->lock);
+            for (int i = start; i < end; i++)
+              for (int k = 0; k < (int) it->second.size(); k++)
+                {
+                  const int is = it->second[k];
+                  vector<double> xsec = convolute_member(g, set, table.get(),
+                                                         members[i], pto,
+                                                         scales[is].first,
+                                                         Kf);
+                  std::copy(xsec.begin(), xsec.begin() + nbins,
+                            res + (is*nmem + i)*nbins);
+                }
+          }
+      }
+  }
+  catch (LHAPDF::Exception e)
+  {
+    failed = true;
+    error = e.what();
+  }
+  CATCH_ANY(failed, error)
+  Py_END_ALLOW_THREADS
+  if (failed)
+    {
+      Py_DECREF(out);
+      PyErr_SetString(PyExc_ValueError, error.c_str());
+      return NULL;
+    }
+
+  return (PyObject*) out;
+}
+
+// Convolute the members in pymem (all if None) of set with the grid g into
+// a (nmem, nbins) array.
+static PyObject* convolute_members(Grid *g, const PDFSet *set,
+                                   PyObject *pymem, int pto,
+                                   double Kr, double Kf)
+{
+  return convolute_scales(g, set, pymem, pto,
+                          vector<Scale>(1, Scale(Kr, Kf)), true);
+}
+
+// Parse a sequence of (Kr, Kf) pairs.
+static bool parse_scales(PyObject *pyscales, vector<Scale>& scales)
+{
+  PyArrayObject *arr = (PyArrayObject*) PyArray_FROM_OTF(pyscales,
+                                                         NPY_DOUBLE,
+                                                         NPY_ARRAY_IN_ARRAY);
+  if (!arr)
+    return false;
+  if (PyArray_NDIM(arr) != 2 || PyArray_DIM(arr, 1) != 2)
+    {
+      Py_DECREF(arr);
+      PyErr_SetString(PyExc_ValueError,
+                      "Scales must be a sequence of (Kr, Kf) pairs");
+      return false;
+    }
+  const double *p = (const double*) PyArray_DATA(arr);
+  for (npy_intp i = 0; i < PyArray_DIM(arr, 0); i++)
+    scales.push_back(Scale(p[2*i], p[2*i+1]));
+  Py_DECREF(arr);
+  return true;
+}
+
+// Distribution in Q of the nonzero weights of the grid for the given bin:
+// for each tau node with nonzero weights, its Q and the number of weights.
+// The caller must hold g->lock.
+static void obsq_distribution(const appl::grid *g, int pto, int bin,
+                              vector<double>& Q, vector<int>& counts)
+{
+  int iorder = pto;
+  if (g->calculation() == appl::grid::AMCATNLO) // if aMCfast change iorder
+    iorder = (pto == 0) ? 3:0;
+
+  appl::igrid const *igrid = g->weightgrid(iorder,bin);
+  appl::igrid *ig = const_cast<appl::igrid*>(igrid);
+  for (int t = 0; t < igrid->Ntau(); t++)
+    {
+      int n = 0;
+      for (int ip = 0; ip < g->subProcesses(0); ip++)
+        {
+          const SparseMatrix3d *w = (const SparseMatrix3d*) ig->weightgrid(ip);
+          for (int ix1 = 0; ix1 < igrid->Ny1(); ix1++)
+            for (int ix2 = 0; ix2 < igrid->Ny2(); ix2++)
+              if ((*w)(t,ix1,ix2) != 0)
+                n++;
+        }
+      if (n)
+        {
+          Q.push_back(sqrt(igrid->fQ2(igrid->gettau(t))));
+          counts.push_back(n);
+        }
+    }
+}
+
+static double mean_obsq(const vector<double>& Q, const vector<int>& counts)
+{
+  double sum = 0;
+  int n = 0;
+  for (int i = 0; i < (int) Q.size(); i++)
+    {
+      sum += counts[i]*Q[i];
+      n += counts[i];
+    }
+  return sum/n;
+}
+
+// Mean Q of the nonzero weights of the grid for the given bin. The caller
+// must hold g->lock.
+static double mean_obsq(const appl::grid *g, int pto, int bin)
+{
+  vector<double> Q;
+  vector<int> counts;
+  obsq_distribution(g, pto, bin, Q, counts);
+  return mean_obsq(Q, counts);
+}
+
+template <typename T>
+static PyObject* to_array(const vector<T>& v, int typenum)
+{
+  npy_intp dims[1] = {(npy_intp) v.size()};
+  PyArrayObject *out = (PyArrayObject*) PyArray_SimpleNew(1, dims, typenum);
+  if (out && !v.empty())
+    std::copy(v.begin(), v.end(), (T*) PyArray_DATA(out));
+  return (PyObject*) out;
+}
+
+// Add the arrays in items to the dictionary d, stealing the references.
+static bool fill_dict(PyObject *d, const char **names, PyObject **items,
+                      int n)
+{
+  bool ok = true;
+  for (int i = 0; i < n; i++)
+    {
+      if (!items[i] || PyDict_SetItemString(d, names[i], items[i]) < 0)
+        ok = false;
+      Py_XDECREF(items[i]);
+    }
+  return ok;
+}
+
+static PyObject* grid_obsq(Grid *g, int pto, int bin)
+{
+  if (!check_grid(g))
+    return NULL;
+  if (bin < 0 || bin >= g->g->Nobs())
+    {
+      PyErr_SetString(PyExc_IndexError, "Bin out of range");
+      return NULL;
+    }
+
+  double res = 0;
+  bool failed = false;
+  string error;
+  Py_BEGIN_ALLOW_THREADS
+  try
+  {
+    std::lock_guard<std::mutex> guard(g->lock);
+    res = mean_obsq(g->g, pto, bin);
+  }
+  CATCH_ANY(failed, error)
+  Py_END_ALLOW_THREADS
+  if (failed)
+    {
+      PyErr_SetString(PyExc_ValueError, error.c_str());
+      return NULL;
+    }
+
+  return Py_BuildValue("d", res);
+}
+
+// Scale information of all the bins, computed in a single pass over the
+// grid: the mean Q of each bin and the distribution of the weights in Q,
+// concatenated for all bins (the entries of bin i go from offset[i] to
+// offset[i+1]).
+static PyObject* grid_obsq_all(Grid *g, int pto)
+{
+  if (!check_grid(g))
+    return NULL;
+
+  vector<double> meanQ, Q;
+  vector<int> counts, offset(1, 0);
+  int nbins = 0;
+  bool failed = false;
+  string error;
+  Py_BEGIN_ALLOW_THREADS
+  try
+  {
+    std::lock_guard<std::mutex> guard(g->lock);
+    nbins = g->g->Nobs();
+    for (int bin = 0; bin < nbins; bin++)
+      {
+        vector<double> binQ;
+        vector<int> bincounts;
+        obsq_distribution(g->g, pto, bin, binQ, bincounts);
+        meanQ.push_back(mean_obsq(binQ, bincounts));
+        Q.insert(Q.end(), binQ.begin(), binQ.end());
+        counts.insert(counts.end(), bincounts.begin(), bincounts.end());
+        offset.push_back(Q.size());
+      }
+  }
+  CATCH_ANY(failed, error)
+  Py_END_ALLOW_THREADS
+  if (failed)
+    {
+      PyErr_SetString(PyExc_ValueError, error.c_str());
+      return NULL;
+    }
+
+  PyObject *d = PyDict_New();
+  if (!d)
+    return NULL;
+  const char *names[] = {"nbins", "meanQ", "Q", "counts", "offset"};
+  PyObject *items[] = {PyLong_FromLong(nbins),
+                       to_array(meanQ, NPY_DOUBLE), to_array(Q, NPY_DOUBLE),
+                       to_array(counts, NPY_INT), to_array(offset, NPY_INT)};
+  if (!fill_dict(d, names, items, sizeof(items)/sizeof(items[0])))
+    {
+      Py_DECREF(d);
+      return NULL;
+    }
+  return d;
+}
+
+static PyObject* grid_nbins(const Grid *g)
+{
+  int nbins;
+  if (!check_grid(g))
+    return NULL;
+  try
+  {
+    nbins = g->g->Nobs();
+  }
+  catch(appl::grid::exception e)
+  {
+    PyErr_SetString(PyExc_ValueError, e.what());
+    return NULL;
+  }
+
+  return Py_BuildValue("i", nbins);
+}
+
+/*******************************************
+ * Module level functions, acting on the
+ * global grid and PDF set
+ ********************************************/
+
+static PyObject* py_initpdf(PyObject* self, PyObject* args)
+{
+  char* setname;
+  if (!PyArg_ParseTuple(args, "s", &setname))
+    return NULL;
+
+  delete _pdfset;
+  _pdfset = load_pdfset(setname);
+  _imem = 0;
+  if (!_pdfset)
+    return NULL;
+
+  return Py_BuildValue("");
+}
+
+static PyObject* py_setverbosity(PyObject *self, PyObject *args)
+{
+  int ver;
+  PyArg_ParseTuple(args, "i", &ver);
+  LHAPDF::setVerbosity(ver);
+
+  return Py_BuildValue("");
+}
+
+static PyObject* py_xfxQ(PyObject *self, PyObject *args)
+{
+  int rep, fl;
+  double x, Q;
+  if (!PyArg_ParseTuple(args, "iidd", &rep, &fl, &x, &Q))
     return NULL;
-  }
 
-  return Py_BuildValue("d", res);
+  return set_xfxQ(_pdfset, rep, fl, x, Q);
 }
 
-static PyObject* py_q2Min(PyObject *self, PyObject *args)
+static PyObject* py_xfxQ_grid(PyObject *self, PyObject *args)
 {
-  double res;
+  PyObject *pymem, *pyfl, *pyx;
+  double Q;
+  if (!PyArg_ParseTuple(args, "OOOd", &pymem, &pyfl, &pyx, &Q))
+    return NULL;
 
-  if (_pdfs[0] == 0)
-    {
-      PyErr_SetString(PyExc_ValueError, "PDF not allocated");
-      return NULL;
-    }
+  PyObject *pyQ = PyFloat_FromDouble(Q);
+  PyObject *out = xfxQ_tensor(_pdfset, pymem, pyfl, pyx, pyQ, true);
+  Py_DECREF(pyQ);
+  return out;
+}
 
-  try
-  {
-    res = _pdfs[0]->q2Min();
-  }
-  catch (LHAPDF::Exception e)
-  {
-    PyErr_SetString(PyExc_ValueError, e.what());
+static PyObject* py_xfxQ_multigrid(PyObject *self, PyObject *args)
+{
+  PyObject *pymem, *pyfl, *pyx, *pyQ;
+  if (!PyArg_ParseTuple(args, "OOOO", &pymem, &pyfl, &pyx, &pyQ))
     return NULL;
-  }
 
-  return Py_BuildValue("d", res);
+  return xfxQ_tensor(_pdfset, pymem, pyfl, pyx, pyQ, false);
+}
+
+static PyObject* py_q2Min(PyObject *self, PyObject *args)
+{
+  return set_q2Min(_pdfset);
 }
 
 static PyObject* py_pdfreplica(PyObject* self, PyObject* args)
@@ -125,18 +1072,13 @@ static PyObject* py_pdfreplica(PyObject* self, PyObject* args)
 static PyObject* py_initobs(PyObject* self, PyObject* args)
 {
   char *file;
-  PyArg_ParseTuple(args,"s", &file);
+  if (!PyArg_ParseTuple(args,"s", &file))
+    return NULL;
 
-  if (_g) delete _g;
-  try
-  {
-    _g = new appl::grid(file);
-  }
-  catch(appl::grid::exception e)
-  {
-    PyErr_SetString(PyExc_ValueError, e.what());
+  delete _grid;
+  _grid = load_grid(file);
+  if (!_grid)
     return NULL;
-  }
 
   return Py_BuildValue("");
 }
@@ -148,13 +1090,38 @@ static PyObject* py_convolute(PyObject* self, PyObject* args)
   // Added handling of muR and muF generic factors
   // you might want to extend this to other
   // functions as well!
-  
+
   double Kr(1.), Kf(1.);
-  PyArg_ParseTuple(args,"i|dd", &pto, &Kr, &Kf);
+  if (!PyArg_ParseTuple(args,"i|dd", &pto, &Kr, &Kf))
+    return NULL;
+
+  if (!check_grid(_grid) || !check_pdfset(_pdfset))
+    return NULL;
+  if (!_pdfset->valid(_imem))
+    {
+      PyErr_SetString(PyExc_ValueError, "PDF not allocated");
+      return NULL;
+    }
 
-  if (!_g) exit(-1);
-  vector<double> xsec = _g->vconvolute(evolvepdf_,alphaspdf_,pto,
-				       Kr, Kf);
+  vector<double> xsec;
+  bool failed = false;
+  string error;
+  Py_BEGIN_ALLOW_THREADS
+  try
+  {
+    const vector<int> members(1, _imem);
+    shared_ptr<NodeTable> table = grid_table(_grid, _pdfset, members, pto,
+                                             Kf);
+    std::lock_guard<std::mutex> guard(_grid->lock);
+    xsec = convolute_member(_grid, _pdfset, table.get(), _imem, pto, Kr, Kf);
+  }
+  CATCH_ANY(failed, error)
+  Py_END_ALLOW_THREADS
+  if (failed)
+    {
+      PyErr_SetString(PyExc_ValueError, error.c_str());
+      return NULL;
+    }
 
   PyObject *out = PyList_New(xsec.size());
   for (int i = 0; i < (int) xsec.size(); i++)
@@ -163,51 +1130,38 @@ static PyObject* py_convolute(PyObject* self, PyObject* args)
   return out;
 }
 
-static PyObject* py_getobsq(PyObject* self, PyObject* args)
+static PyObject* py_convolute_all(PyObject* self, PyObject* args)
 {
-  int pto, bin;
-  PyArg_ParseTuple(args,"ii", &pto, &bin);
-
-  vector<double> Q;
-
-  int iorder = pto;
-  if (_g->calculation() == appl::grid::AMCATNLO) // if aMCfast change iorder
-    iorder = (pto == 0) ? 3:0;
+  int pto;
+  PyObject *pymem = Py_None;
+  double Kr(1.), Kf(1.);
+  if (!PyArg_ParseTuple(args,"i|Odd", &pto, &pymem, &Kr, &Kf))
+    return NULL;
 
-  appl::igrid const *igrid = _g->weightgrid(iorder,bin);
-  for (int ix1 = 0; ix1 < igrid->Ny1(); ix1++)
-    for (int ix2 = 0; ix2 < igrid->Ny2(); ix2++)
-      for (int t = 0; t < igrid->Ntau(); t++)
-	for (int ip = 0; ip < _g->subProcesses(0); ip++)
-	  {
+  return convolute_members(_grid, _pdfset, pymem, pto, Kr, Kf);
+}
 
-	    const bool zero_weight = (*(const SparseMatrix3d*) const_cast<appl::igrid*>(igrid)->weightgrid(ip))(t,ix1,ix2) == 0;
+static PyObject* py_getobsq(PyObject* self, PyObject* args)
+{
+  int pto, bin;
+  if (!PyArg_ParseTuple(args,"ii", &pto, &bin))
+    return NULL;
 
-	    if (!zero_weight)
-	      Q.push_back(sqrt(igrid->fQ2(igrid->gettau(t))));
-	  }
+  return grid_obsq(_grid, pto, bin);
+}
 
-  double sum = 0;
-  for (int i = 0; i < (int) Q.size(); i++) sum += Q[i];
-  sum /= Q.size();
+static PyObject* py_getobsq_all(PyObject* self, PyObject* args)
+{
+  int pto;
+  if (!PyArg_ParseTuple(args,"i", &pto))
+    return NULL;
 
-  return Py_BuildValue("d", sum);
+  return grid_obsq_all(_grid, pto);
 }
 
 static PyObject* py_getnbins(PyObject* self, PyObject* args)
 {
-  int nbins;
-  try
-  {
-    nbins = _g->Nobs();
-  }
-  catch(appl::grid::exception e)
-  {
-    PyErr_SetString(PyExc_ValueError, e.what());
-    return NULL;
-  }
-
-  return Py_BuildValue("i", nbins);
+  return grid_nbins(_grid);
 }
 
 static PyObject* py_setlhapdfpath(PyObject* self, PyObject* args)
@@ -230,24 +1184,555 @@ static PyObject* py_getlhapdfpath(PyObject* self, PyObject* args)
   return out;
 }
 
+static PyObject* py_nodetable_stats(PyObject* self, PyObject* noargs)
+{
+  return Py_BuildValue("ll", (long) _table_hits, (long) _table_misses);
+}
+
 static PyObject* py_lhapdf_version(PyObject* self,  PyObject* noargs){
    string version = LHAPDF::version();
    return Py_BuildValue("s#", version.c_str(), version.length());
 }
 
+/*******************************************
+ * PDFSetHandle: an LHAPDF set owned by a
+ * Python object
+ ********************************************/
+
+typedef struct {
+  PyObject_HEAD
+  PDFSet *set;
+  PyObject *name;
+} PDFSetHandleObject;
+
+static PyTypeObject PDFSetHandleType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "applwrap.PDFSetHandle"
+};
+
+static void PDFSetHandle_dealloc(PDFSetHandleObject *self)
+{
+  delete self->set;
+  Py_XDECREF(self->name);
+  Py_TYPE(self)->tp_free((PyObject*) self);
+}
+
+static int PDFSetHandle_init(PDFSetHandleObject *self, PyObject *args,
+                             PyObject *kwds)
+{
+  static const char *kwlist[] = {"setname", "max_resident", NULL};
+  char *setname;
+  int max_resident = DEFAULT_MAX_RESIDENT;
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "s|i", (char**) kwlist,
+                                   &setname, &max_resident))
+    return -1;
+  if (max_resident < 1)
+    {
+      PyErr_SetString(PyExc_ValueError, "max_resident must be positive");
+      return -1;
+    }
+
+  PDFSet *set = load_pdfset(setname, max_resident);
+  if (!set)
+    return -1;
+
+  delete self->set;
+  self->set = set;
+  Py_XDECREF(self->name);
+  self->name = PyUnicode_FromString(setname);
+  return 0;
+}
+
+static PyObject* PDFSetHandle_xfxQ(PDFSetHandleObject *self, PyObject *args)
+{
+  int rep, fl;
+  double x, Q;
+  if (!PyArg_ParseTuple(args, "iidd", &rep, &fl, &x, &Q))
+    return NULL;
+
+  return set_xfxQ(self->set, rep, fl, x, Q);
+}
+
+static PyObject* PDFSetHandle_xfxQ_grid(PDFSetHandleObject *self,
+                                        PyObject *args)
+{
+  PyObject *pymem, *pyfl, *pyx;
+  double Q;
+  if (!PyArg_ParseTuple(args, "OOOd", &pymem, &pyfl, &pyx, &Q))
+    return NULL;
+
+  PyObject *pyQ = PyFloat_FromDouble(Q);
+  PyObject *out = xfxQ_tensor(self->set, pymem, pyfl, pyx, pyQ, true);
+  Py_DECREF(pyQ);
+  return out;
+}
+
+static PyObject* PDFSetHandle_xfxQ_multigrid(PDFSetHandleObject *self,
+                                             PyObject *args)
+{
+  PyObject *pymem, *pyfl, *pyx, *pyQ;
+  if (!PyArg_ParseTuple(args, "OOOO", &pymem, &pyfl, &pyx, &pyQ))
+    return NULL;
+
+  return xfxQ_tensor(self->set, pymem, pyfl, pyx, pyQ, false);
+}
+
+static PyObject* PDFSetHandle_q2Min(PDFSetHandleObject *self,
+                                    PyObject *noargs)
+{
+  return set_q2Min(self->set);
+}
+
+static PyObject* PDFSetHandle_alphasQ(PDFSetHandleObject *self,
+                                      PyObject *args)
+{
+  PyObject *pymem, *pyQ;
+  if (!PyArg_ParseTuple(args, "OO", &pymem, &pyQ))
+    return NULL;
+  if (!check_pdfset(self->set))
+    return NULL;
+
+  vector<int> members;
+  if (!parse_members(pymem, self->set, members))
+    return NULL;
+  PyArrayObject *Qs = (PyArrayObject*) PyArray_FROM_OTF(pyQ, NPY_DOUBLE,
+                                                        NPY_ARRAY_IN_ARRAY);
+  if (!Qs)
+    return NULL;
+  npy_intp dims[2] = {(npy_intp) members.size(), PyArray_SIZE(Qs)};
+  PyArrayObject *out = (PyArrayObject*) PyArray_SimpleNew(2, dims,
+                                                          NPY_DOUBLE);
+  if (out)
+    {
+      const double *pQ = (const double*) PyArray_DATA(Qs);
+      double *res = (double*) PyArray_DATA(out);
+      const PDFSet *set = self->set;
+      bool failed = false;
+      string error = "Failed to evaluate alpha_s";
+      Py_BEGIN_ALLOW_THREADS
+      try
+        {
+          for (npy_intp m = 0; m < dims[0]; m++)
+            {
+              shared_ptr<LHAPDF::PDF> pdf = set->member(members[m]);
+              for (npy_intp i = 0; i < dims[1]; i++)
+                res[m*dims[1] + i] = pdf->alphasQ(pQ[i]);
+            }
+        }
+      catch (LHAPDF::Exception e)
+        {
+          failed = true;
+        }
+      CATCH_ANY(failed, error)
+      Py_END_ALLOW_THREADS
+      if (failed)
+        {
+          PyErr_SetString(PyExc_ValueError, error.c_str());
+          Py_CLEAR(out);
+        }
+    }
+  Py_DECREF(Qs);
+  return (PyObject*) out;
+}
+
+static PyObject* PDFSetHandle_clear_nodetables(PDFSetHandleObject *self,
+                                              PyObject *noargs)
+{
+  if (!check_pdfset(self->set))
+    return NULL;
+  self->set->clear_tables();
+  return Py_BuildValue("");
+}
+
+static PyObject* PDFSetHandle_get_name(PDFSetHandleObject *self,
+                                       void *closure)
+{
+  if (!self->name)
+    return Py_BuildValue("");
+  Py_INCREF(self->name);
+  return self->name;
+}
+
+static PyObject* PDFSetHandle_get_nmembers(PDFSetHandleObject *self,
+                                           void *closure)
+{
+  if (!check_pdfset(self->set))
+    return NULL;
+  return Py_BuildValue("i", self->set->size());
+}
+
+static PyObject* PDFSetHandle_get_max_resident(PDFSetHandleObject *self,
+                                               void *closure)
+{
+  if (!check_pdfset(self->set))
+    return NULL;
+  return Py_BuildValue("i", (int) self->set->max_resident);
+}
+
+static int PDFSetHandle_set_max_resident(PDFSetHandleObject *self,
+                                         PyObject *value, void *closure)
+{
+  if (!check_pdfset(self->set))
+    return -1;
+  if (!value)
+    {
+      PyErr_SetString(PyExc_TypeError, "Cannot delete max_resident");
+      return -1;
+    }
+  const long n = PyLong_AsLong(value);
+  if (n == -1 && PyErr_Occurred())
+    return -1;
+  if (n < 1)
+    {
+      PyErr_SetString(PyExc_ValueError, "max_resident must be positive");
+      return -1;
+    }
+  self->set->max_resident = n;
+  return 0;
+}
+
+static PyMethodDef PDFSetHandle_methods[] = {
+  {"xfxQ", (PyCFunction) PDFSetHandle_xfxQ, METH_VARARGS, "get xfxQ"},
+  {"xfxQ_grid", (PyCFunction) PDFSetHandle_xfxQ_grid, METH_VARARGS,
+   "get xfxQ for arrays of members, flavours and x at one Q"},
+  {"xfxQ_multigrid", (PyCFunction) PDFSetHandle_xfxQ_multigrid, METH_VARARGS,
+   "get xfxQ for arrays of members, flavours, x and Q"},
+  {"q2Min", (PyCFunction) PDFSetHandle_q2Min, METH_NOARGS, "get q2min"},
+  {"alphasQ", (PyCFunction) PDFSetHandle_alphasQ, METH_VARARGS,
+   "get alpha_s for arrays of members and Q, as a (nmem, nQ) array"},
+  {"clear_nodetables", (PyCFunction) PDFSetHandle_clear_nodetables,
+   METH_NOARGS, "free the cached PDF values at the grid nodes"},
+  {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef PDFSetHandle_getset[] = {
+  {(char*) "name", (getter) PDFSetHandle_get_name, NULL,
+   (char*) "LHAPDF name of the set", NULL},
+  {(char*) "nmembers", (getter) PDFSetHandle_get_nmembers, NULL,
+   (char*) "number of members of the set", NULL},
+  {(char*) "max_resident", (getter) PDFSetHandle_get_max_resident,
+   (setter) PDFSetHandle_set_max_resident,
+   (char*) "maximum number of members kept in memory", NULL},
+  {NULL, NULL, NULL, NULL, NULL}
+};
+
+/*******************************************
+ * GridHandle: an APPLgrid owned by a
+ * Python object
+ ********************************************/
+
+typedef struct {
+  PyObject_HEAD
+  Grid *g;
+  PyObject *filename;
+} GridHandleObject;
+
+static PyTypeObject GridHandleType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "applwrap.GridHandle"
+};
+
+static void GridHandle_dealloc(GridHandleObject *self)
+{
+  delete self->g;
+  Py_XDECREF(self->filename);
+  Py_TYPE(self)->tp_free((PyObject*) self);
+}
+
+static int GridHandle_init(GridHandleObject *self, PyObject *args,
+                           PyObject *kwds)
+{
+  char *file;
+  if (!PyArg_ParseTuple(args, "s", &file))
+    return -1;
+
+  Grid *g = load_grid(file);
+  if (!g)
+    return -1;
+
+  delete self->g;
+  self->g = g;
+  Py_XDECREF(self->filename);
+  self->filename = PyUnicode_FromString(file);
+  return 0;
+}
+
+static PyObject* GridHandle_nbins(GridHandleObject *self, PyObject *noargs)
+{
+  return grid_nbins(self->g);
+}
+
+static PyObject* GridHandle_getobsq(GridHandleObject *self, PyObject *args)
+{
+  int pto, bin;
+  if (!PyArg_ParseTuple(args,"ii", &pto, &bin))
+    return NULL;
+
+  return grid_obsq(self->g, pto, bin);
+}
+
+static PyObject* GridHandle_convolute_scales(GridHandleObject *self,
+                                             PyObject *args)
+{
+  PDFSetHandleObject *pdf;
+  int pto;
+  PyObject *pyscales, *pymem = Py_None;
+  if (!PyArg_ParseTuple(args, "O!iO|O", &PDFSetHandleType, &pdf, &pto,
+                        &pyscales, &pymem))
+    return NULL;
+
+  vector<Scale> scales;
+  if (!parse_scales(pyscales, scales))
+    return NULL;
+
+  return convolute_scales(self->g, pdf->set, pymem, pto, scales, false);
+}
+
+static PyObject* GridHandle_getobsq_all(GridHandleObject *self,
+                                        PyObject *args)
+{
+  int pto;
+  if (!PyArg_ParseTuple(args,"i", &pto))
+    return NULL;
+
+  return grid_obsq_all(self->g, pto);
+}
+
+static PyObject* GridHandle_convolute_all(GridHandleObject *self,
+                                          PyObject *args)
+{
+  PDFSetHandleObject *pdf;
+  int pto;
+  PyObject *pymem = Py_None;
+  double Kr(1.), Kf(1.);
+  if (!PyArg_ParseTuple(args, "O!i|Odd", &PDFSetHandleType, &pdf, &pto,
+                        &pymem, &Kr, &Kf))
+    return NULL;
+
+  return convolute_members(self->g, pdf->set, pymem, pto, Kr, Kf);
+}
+
+// Export the weights of the grid needed for the convolution at order pto.
+// The weights are split in blocks, one per (order, bin), each with its own
+// interpolation nodes. The sparse weights of all blocks are returned
+// concatenated, together with the offsets of each block, and with the
+// width of each bin and the number of runs, by which vconvolute divides.
+static PyObject* GridHandle_export_weights(GridHandleObject *self,
+                                           PyObject *args)
+{
+  int pto;
+  if (!PyArg_ParseTuple(args, "i", &pto))
+    return NULL;
+  if (!check_grid(self->g))
+    return NULL;
+
+  vector<int> block_bin, block_power;
+  vector<int> tau_offset(1, 0), x1_offset(1, 0), x2_offset(1, 0),
+    w_offset(1, 0);
+  vector<double> Q, x1, x2, fun1, fun2;
+  vector<int> w_sub, w_tau, w_x1, w_x2;
+  vector<double> w_val;
+  vector<double> lumi, bin_width;
+  double run = 0;
+  int nsub = 0, nbins = 0;
+  bool standard = true, normalised = false, failed = false;
+  string error;
+
+  Py_BEGIN_ALLOW_THREADS
+  try
+  {
+    std::lock_guard<std::mutex> guard(self->g->lock);
+    appl::grid *g = self->g->g;
+    standard = g->calculation() == appl::grid::STANDARD;
+    nbins = g->Nobs();
+    nsub = g->subProcesses(0);
+    run = g->run();
+    normalised = g->getNormalised();
+    for (int bin = 0; bin < nbins; bin++)
+      bin_width.push_back(g->deltaobs(bin));
+    if (standard)
+      {
+        // The luminosity combinations are bilinear in the PDFs of each
+        // beam, so probing with unit vectors gives the full tensor.
+        lumi.assign(nsub*NFL*NFL, 0);
+        vector<double> H(nsub);
+        for (int a = 0; a < NFL; a++)
+          for (int b = 0; b < NFL; b++)
+            {
+              double fA[NFL] = {0}, fB[NFL] = {0};
+              fA[a] = 1;
+              fB[b] = 1;
+              g->genpdf(0)->evaluate(fA, fB, &H[0]);
+              for (int sp = 0; sp < nsub; sp++)
+                lumi[(sp*NFL + a)*NFL + b] = H[sp];
+            }
+
+        for (int iorder = 0; iorder <= pto; iorder++)
+          for (int bin = 0; bin < nbins; bin++)
+            {
+              appl::igrid const *igrid = g->weightgrid(iorder, bin);
+              if (!igrid)
+                continue;
+              appl::igrid *ig = const_cast<appl::igrid*>(igrid);
+              block_bin.push_back(bin);
+              block_power.push_back(g->leadingOrder() + iorder);
+              for (int t = 0; t < igrid->Ntau(); t++)
+                Q.push_back(std::sqrt(igrid->fQ2(igrid->gettau(t))));
+              for (int iy = 0; iy < igrid->Ny1(); iy++)
+                {
+                  const double x = igrid->fx(igrid->gety1(iy));
+                  x1.push_back(x);
+                  fun1.push_back((igrid->reweight() ?
+                                  appl::igrid::weightfun(x) : 1)/x);
+                }
+              for (int iy = 0; iy < igrid->Ny2(); iy++)
+                {
+                  const double x = igrid->fx(igrid->gety2(iy));
+                  x2.push_back(x);
+                  fun2.push_back((igrid->reweight() ?
+                                  appl::igrid::weightfun(x) : 1)/x);
+                }
+              for (int sp = 0; sp < nsub; sp++)
+                {
+                  const SparseMatrix3d *w =
+                    (const SparseMatrix3d*) ig->weightgrid(sp);
+                  if (!w)
+                    continue;
+                  for (int t = 0; t < igrid->Ntau(); t++)
+                    for (int iy1 = 0; iy1 < igrid->Ny1(); iy1++)
+                      for (int iy2 = 0; iy2 < igrid->Ny2(); iy2++)
+                        {
+                          const double val = (*w)(t, iy1, iy2);
+                          if (val == 0)
+                            continue;
+                          w_sub.push_back(sp);
+                          w_tau.push_back(t);
+                          w_x1.push_back(iy1);
+                          w_x2.push_back(iy2);
+                          w_val.push_back(val);
+                        }
+                }
+              tau_offset.push_back(Q.size());
+              x1_offset.push_back(x1.size());
+              x2_offset.push_back(x2.size());
+              w_offset.push_back(w_val.size());
+            }
+      }
+  }
+  CATCH_ANY(failed, error)
+  Py_END_ALLOW_THREADS
+
+  if (failed)
+    {
+      PyErr_SetString(PyExc_ValueError, error.c_str());
+      return NULL;
+    }
+
+  if (!standard)
+    {
+      PyErr_SetString(PyExc_NotImplementedError,
+                      "Only standard APPLgrids can be exported");
+      return NULL;
+    }
+
+  PyObject *d = PyDict_New();
+  if (!d)
+    return NULL;
+
+  npy_intp ldims[3] = {nsub, NFL, NFL};
+  PyArrayObject *pylumi = (PyArrayObject*) PyArray_SimpleNew(3, ldims,
+                                                             NPY_DOUBLE);
+  if (pylumi)
+    std::copy(lumi.begin(), lumi.end(), (double*) PyArray_DATA(pylumi));
+
+  const char *names[] = {"nbins", "run", "normalised", "bin_width",
+                         "lumi", "block_bin", "block_power",
+                         "tau_offset", "x1_offset", "x2_offset", "w_offset",
+                         "Q", "x1", "x2", "fun1", "fun2",
+                         "w_sub", "w_tau", "w_x1", "w_x2", "w_val"};
+  PyObject *items[] = {PyLong_FromLong(nbins), PyFloat_FromDouble(run),
+                       PyBool_FromLong(normalised),
+                       to_array(bin_width, NPY_DOUBLE), (PyObject*) pylumi,
+                       to_array(block_bin, NPY_INT),
+                       to_array(block_power, NPY_INT),
+                       to_array(tau_offset, NPY_INT),
+                       to_array(x1_offset, NPY_INT),
+                       to_array(x2_offset, NPY_INT),
+                       to_array(w_offset, NPY_INT),
+                       to_array(Q, NPY_DOUBLE), to_array(x1, NPY_DOUBLE),
+                       to_array(x2, NPY_DOUBLE), to_array(fun1, NPY_DOUBLE),
+                       to_array(fun2, NPY_DOUBLE),
+                       to_array(w_sub, NPY_INT), to_array(w_tau, NPY_INT),
+                       to_array(w_x1, NPY_INT), to_array(w_x2, NPY_INT),
+                       to_array(w_val, NPY_DOUBLE)};
+  if (!fill_dict(d, names, items, sizeof(items)/sizeof(items[0])))
+    {
+      Py_DECREF(d);
+      return NULL;
+    }
+  return d;
+}
+
+static PyObject* GridHandle_get_filename(GridHandleObject *self,
+                                         void *closure)
+{
+  if (!self->filename)
+    return Py_BuildValue("");
+  Py_INCREF(self->filename);
+  return self->filename;
+}
+
+static PyMethodDef GridHandle_methods[] = {
+  {"nbins", (PyCFunction) GridHandle_nbins, METH_NOARGS,
+   "get number of bins"},
+  {"getobsq", (PyCFunction) GridHandle_getobsq, METH_VARARGS,
+   "get observable q"},
+  {"getobsq_all", (PyCFunction) GridHandle_getobsq_all, METH_VARARGS,
+   "get the mean q and the q distribution of the weights of all bins"},
+  {"convolute_all", (PyCFunction) GridHandle_convolute_all, METH_VARARGS,
+   "convolute all (or the given) members of a PDFSetHandle into a "
+   "(nmem, nbins) array"},
+  {"convolute_scales", (PyCFunction) GridHandle_convolute_scales,
+   METH_VARARGS, "convolute all (or the given) members of a PDFSetHandle "
+   "for a sequence of (Kr, Kf) pairs into a (nscales, nmem, nbins) array"},
+  {"export_weights", (PyCFunction) GridHandle_export_weights, METH_VARARGS,
+   "export the weights and nodes of the grid as a dict of arrays"},
+  {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef GridHandle_getset[] = {
+  {(char*) "filename", (getter) GridHandle_get_filename, NULL,
+   (char*) "path of the grid file", NULL},
+  {NULL, NULL, NULL, NULL, NULL}
+};
+
+/*******************************************
+ * Module definition
+ ********************************************/
+
 static PyMethodDef applwrap_methods[] = {
   {"setlhapdfpath", py_setlhapdfpath, METH_VARARGS, "set lhapdf path"},
   {"getlhapdfpath", py_getlhapdfpath, METH_VARARGS, "get lhapdf path"},
   {"setverbosity",  py_setverbosity,  METH_VARARGS, "set verbosity"},
   {"initpdf", py_initpdf, METH_VARARGS, "init pdf"},
   {"xfxQ", py_xfxQ, METH_VARARGS, "get xfxQ"},
+  {"xfxQ_grid", py_xfxQ_grid, METH_VARARGS,
+   "get xfxQ for arrays of members, flavours and x at one Q"},
+  {"xfxQ_multigrid", py_xfxQ_multigrid, METH_VARARGS,
+   "get xfxQ for arrays of members, flavours, x and Q"},
   {"q2Min", py_q2Min, METH_VARARGS, "get q2min"},
   {"pdfreplica", py_pdfreplica, METH_VARARGS, "set pdf replica"},
   {"initobs", py_initobs, METH_VARARGS, "init obs"},
   {"convolute", py_convolute, METH_VARARGS, "convolute"},
+  {"convolute_all", py_convolute_all, METH_VARARGS,
+   "convolute all (or the given) members into a (nmem, nbins) array"},
   {"getobsq", py_getobsq, METH_VARARGS, "get observable q"},
+  {"getobsq_all", py_getobsq_all, METH_VARARGS,
+   "get the mean q and the q distribution of the weights of all bins"},
   {"getnbins",py_getnbins, METH_VARARGS, "get number of bins"},
   {"lhapdf_version",py_lhapdf_version, METH_NOARGS, "get LHAPDF version"},
+  {"nodetable_stats", py_nodetable_stats, METH_NOARGS,
+   "get the number of PDF lookups served and missed by the node tables"},
   {NULL, NULL, 0, NULL}
 };
 
@@ -262,5 +1747,40 @@ static struct PyModuleDef applwrap_module = {
 PyMODINIT_FUNC
 PyInit_applwrap(void)
 {
-  return PyModule_Create(&applwrap_module);
+  import_array();
+
+  PDFSetHandleType.tp_basicsize = sizeof(PDFSetHandleObject);
+  PDFSetHandleType.tp_dealloc = (destructor) PDFSetHandle_dealloc;
+  PDFSetHandleType.tp_flags = Py_TPFLAGS_DEFAULT;
+  PDFSetHandleType.tp_doc = "PDFSetHandle(setname, max_resident=100): an "
+    "LHAPDF set, independent from the global PDF of initpdf. Members are "
+    "loaded on demand, keeping at most max_resident in memory";
+  PDFSetHandleType.tp_methods = PDFSetHandle_methods;
+  PDFSetHandleType.tp_getset = PDFSetHandle_getset;
+  PDFSetHandleType.tp_init = (initproc) PDFSetHandle_init;
+  PDFSetHandleType.tp_new = PyType_GenericNew;
+
+  GridHandleType.tp_basicsize = sizeof(GridHandleObject);
+  GridHandleType.tp_dealloc = (destructor) GridHandle_dealloc;
+  GridHandleType.tp_flags = Py_TPFLAGS_DEFAULT;
+  GridHandleType.tp_doc = "GridHandle(filename): an APPLgrid loaded "
+    "in memory, independent from the global grid of initobs";
+  GridHandleType.tp_methods = GridHandle_methods;
+  GridHandleType.tp_getset = GridHandle_getset;
+  GridHandleType.tp_init = (initproc) GridHandle_init;
+  GridHandleType.tp_new = PyType_GenericNew;
+
+  if (PyType_Ready(&PDFSetHandleType) < 0 || PyType_Ready(&GridHandleType) < 0)
+    return NULL;
+
+  PyObject *m = PyModule_Create(&applwrap_module);
+  if (!m)
+    return NULL;
+
+  Py_INCREF(&PDFSetHandleType);
+  PyModule_AddObject(m, "PDFSetHandle", (PyObject*) &PDFSetHandleType);
+  Py_INCREF(&GridHandleType);
+  PyModule_AddObject(m, "GridHandle", (PyObject*) &GridHandleType);
+
+  return m;
 }
@@ -16,5 +16,15 @@ class TestConfig(unittest.TestCase):
         with self.assertRaises(ValueError):
             applwrap.initpdf("patata")
 
+    def test_bad_handles(self):
+        with self.assertRaises(ValueError):
+            applwrap.GridHandle("patata")
+        with self.assertRaises(ValueError):
+            applwrap.PDFSetHandle("patata")
+        with self.assertRaises(TypeError):
+            applwrap.GridHandle()
+        with self.assertRaises(ValueError):
+            applwrap.PDFSetHandle("patata", max_resident=0)
+
 if __name__ == '__main__':
     unittest.main()
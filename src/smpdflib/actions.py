@@ -76,14 +76,15 @@ def save_figures(generator, output_dir, namefunc=None,
                 plt.close(fig)
 
 def check_know_errors(action, group, config):
-    from smpdflib.core import RESULT_TYPES, PDFDoesNotExist
+    from smpdflib.core import RESULT_TYPES
+    from smpdflib import lhaindex
 
     bad_types = []
+    infos = lhaindex.set_infos([str(pdf) for pdf in group['pdfsets']])
     for pdf in group['pdfsets']:
-        try:
-            error_type = pdf.ErrorType
-        except PDFDoesNotExist:
+        if str(pdf) not in infos:
             continue
+        error_type = infos[str(pdf)].get('ErrorType')
         if  error_type not in RESULT_TYPES:
             bad_types.append((pdf, error_type))
     if bad_types:
@@ -201,16 +202,64 @@ def export_html(total, output_dir, prefix):
     filename = "%sresults.html" % (prefix if prefix else '')
     utils.save_html(total[lib.DISPLAY_COLUMNS], osp.join(output_dir, filename))
 
+OBSCORRS_FORMATS = ('csv', 'npy', 'pairs')
+
+def check_obscorrs_options(action, group, config):
+    fmt = group.get('obscorrs_format', 'csv')
+    if fmt not in OBSCORRS_FORMATS:
+        raise ActionError("Unknown obscorrs_format '%s'. Valid ones are: %s"
+                          % (fmt, OBSCORRS_FORMATS))
+    if fmt == 'pairs' and (group.get('obscorrs_topk') is None and
+                           group.get('obscorrs_threshold') is None):
+        raise ActionError("obscorrs_format 'pairs' requires "
+                          "'obscorrs_topk' or 'obscorrs_threshold'")
+
 @check(check_know_errors)
-def export_obscorrs(data_table, output_dir, prefix, base_pdf=None):
+@check(check_obscorrs_options)
+def export_obscorrs(data_table, output_dir, prefix, base_pdf=None,
+                    obscorrs_format='csv', obscorrs_topk=None,
+                    obscorrs_threshold=None, obscorrs_float32=False):
+    """
+    Export the correlations between the bins of the observables. The
+    matrix is computed by blocks of rows, so that it is never held in memory
+    with the 'csv' (tab separated) and 'npy' (binary, with the labels in a
+    separate text file) formats. The 'pairs' format writes only the
+    ``obscorrs_topk`` largest correlations of each bin and/or those above
+    ``obscorrs_threshold``, in absolute value."""
+    import numpy as np
     import pandas as pd
 
-    from smpdflib.corrutils import observable_correlations
-
-    for title, corrmat, labels in observable_correlations(data_table, base_pdf):
-        name = prefix + "_" + normalize_name(title)
-        filename = osp.join(output_dir, name + ".csv")
-        pd.DataFrame(corrmat, index=labels, columns=labels).to_csv(filename, sep='\t')
+    from smpdflib.corrutils import (observable_correlation_blocks,
+                                    correlation_matrix, top_correlations)
+
+    dtype = np.float32 if obscorrs_float32 else np.float64
+    for title, labels, blocks in observable_correlation_blocks(data_table,
+                                                               base_pdf,
+                                                               dtype=dtype):
+        name = osp.join(output_dir, prefix + "_" + normalize_name(title))
+        if obscorrs_format == 'csv':
+            with open(name + ".csv", 'w') as f:
+                for start, block in blocks:
+                    pd.DataFrame(block, index=labels[start:start+len(block)],
+                                 columns=labels).to_csv(f, sep='\t',
+                                                        header=not start)
+        elif obscorrs_format == 'npy':
+            n = len(labels)
+            out = np.lib.format.open_memmap(name + ".npy", mode='w+',
+                                            dtype=dtype, shape=(n, n))
+            correlation_matrix(blocks, n, out=out)
+            out.flush()
+            del out
+            with open(name + "_labels.txt", 'w') as f:
+                f.write('\n'.join(labels) + '\n')
+        elif obscorrs_format == 'pairs':
+            rows, cols, values = top_correlations(blocks, k=obscorrs_topk,
+                                                  threshold=obscorrs_threshold)
+            labels = np.asarray(labels, dtype=object)
+            pd.DataFrame({'Bin': labels[rows], 'Other bin': labels[cols],
+                          'Correlation': values},
+                         columns=['Bin', 'Other bin', 'Correlation']
+                         ).to_csv(name + "_pairs.csv", sep='\t', index=False)
 
 #TODO: Ability to import exported csv
 @check(check_know_errors)
@@ -240,6 +289,41 @@ def save_correlations(results, output_dir, prefix, fmt='pdf'):
                         fmt=fmt, namefunc=namefunc)
 
 
+def check_scale_variations(action, group, config):
+    from smpdflib.core import DEFAULT_SCALE_VARIATIONS
+    scales = group.get('scale_variations', DEFAULT_SCALE_VARIATIONS)
+    try:
+        scales = [(float(Kr), float(Kf)) for (Kr, Kf) in scales]
+    except (TypeError, ValueError):
+        raise ActionError("scale_variations must be a list of [Kr, Kf] "
+                          "pairs, not %s" % (scales,))
+    if (1, 1) not in scales:
+        raise ActionError("scale_variations must include the central "
+                          "scale [1, 1]")
+    if any(K <= 0 for scale in scales for K in scale):
+        raise ActionError("Scale factors must be positive")
+    group['scale_variations'] = scales
+
+@check(check_know_errors)
+@check(check_scale_variations)
+def export_scalevariations(pdfsets, observables, output_dir, prefix,
+                           scale_variations):
+    """
+    Compute the APPLgrid observables with all the members of each PDF set at
+    several (Kr, Kf) factors of the renormalization and factorization
+    scales, given by 'scale_variations' (the 7-point variation by default),
+    and export them as a tab-separated CSV file, together with the envelope
+    of the central values."""
+    import smpdflib.core as lib
+    svresults = lib.produce_scale_variations(pdfsets, observables,
+                                             scales=scale_variations)
+    if not svresults:
+        return []
+    filename = "%sscalevariations.csv" % (prefix if prefix else '')
+    table = lib.scale_variations_table(svresults)
+    table.to_csv(osp.join(output_dir, filename), sep='\t')
+    return svresults
+
 def _mc2hname(prefix, pdf, group, config):
     return '_'.join((prefix, str(pdf), str(group['Neig'])))
 
@@ -361,6 +445,7 @@ ACTION_DICT = OrderedDict((
                ('exporthtml', export_html),
                ('exportcsv', export_csv),
                ('exportobscorrs', export_obscorrs),
+               ('scalevariations', export_scalevariations),
                ('plotcorrs', save_correlations),
                ('smpdf', create_smpdf),
                ('mc2hessian', create_mc2hessian),
@@ -370,7 +455,12 @@ ACTION_DICT = OrderedDict((
 
 REALACTIONS = set(ACTION_DICT.keys())
 
-METAACTION_DICT = {'all': (REALACTIONS, "Implies all other actions."),
+#Expensive actions that only run when requested by name.
+EXPLICIT_ACTIONS = {'scalevariations'}
+
+METAACTION_DICT = {'all': (REALACTIONS - EXPLICIT_ACTIONS,
+                           "Implies all other actions, except: %s." %
+                           ', '.join(sorted(EXPLICIT_ACTIONS))),
                    'savedata': ({'exportcsv', 'exporthtml'}, "Export html and "
                                                                    "csv.")
                   }
@@ -439,14 +529,26 @@ def execute_config(conf, output_dir, db):
         # perform convolution
         #TODO Do this better
         if any(requires_result(act) for act in group['actions']):
-            results = lib.produce_results(pdfsets, observables, db)
+            engine = group.get('convolution_engine',
+                               lib.DEFAULT_CONVOLUTION_ENGINE)
+            backend = group.get('convolution_backend',
+                                lib.DEFAULT_CONVOLUTION_BACKEND)
+            results = lib.produce_results(pdfsets, observables, db,
+                                          engine=engine, backend=backend)
             resultset.append(results)
             data_table = lib.results_table(results)
             summed_table = lib.summed_results_table(results)
-
-            total = pd.concat((data_table,
-                                summed_table),
-                                ignore_index = True)
+            tables = [data_table, summed_table]
+            if 'bin_groups' in group:
+                from smpdflib.bingroups import group_results
+                grouped = group_results(results, group['bin_groups'])
+                if grouped:
+                    grouped_table = lib.results_table(grouped)
+                    grouped_table['Bin'] = 'group'
+                    tables.append(grouped_table)
+                    resources['grouped_table'] = grouped_table
+
+            total = pd.concat(tables, ignore_index = True)
             if logging.getLogger().isEnabledFor(logging.DEBUG):
                 ...
                 #print_results(results)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+A size bounded, on disk cache of NumPy arrays.
+
+Each entry is a directory containing one ``.npy`` file per array, so that
+entries can be memory mapped when read. Entries are written to a temporary
+directory and renamed into place, so readers (in this or any other process)
+never see partial entries. When the total size exceeds the limit, the least
+recently used entries are removed.
+
+Each ``ArrayCache`` keeps a running total of the size of the directory,
+computed with a full scan the first time and then updated by the entries it
+stores, so that a ``put`` doesn't list the directory. The entries are only
+scanned again (which also accounts for the entries stored by other
+processes) when the total goes over the limit.
+"""
+import os
+import os.path as osp
+import shutil
+import tempfile
+import hashlib
+import logging
+
+import numpy as np
+
+
+def make_key(*parts):
+    """Return a hex digest identifying ``parts``. Arrays are hashed by
+    content, dtype and shape, bytes as they are and anything else by its
+    ``repr``."""
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(str((part.dtype.str, part.shape)).encode())
+            h.update(part.tobytes())
+        elif isinstance(part, bytes):
+            h.update(part)
+        else:
+            h.update(repr(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+class ArrayCache(object):
+    """Cache of tuples of arrays in ``directory``, using at most
+    ``maxsize`` bytes."""
+    def __init__(self, directory, maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+        #Running total of the size of the entries, or None before the
+        #first scan.
+        self._size = None
+
+    def _path(self, key):
+        return osp.join(self.directory, key)
+
+    def get(self, key, mmap_mode='r'):
+        """Return the tuple of arrays stored for ``key``, or ``None``."""
+        path = self._path(key)
+        try:
+            names = sorted(f for f in os.listdir(path) if f.endswith('.npy'))
+            arrays = tuple(np.load(osp.join(path, name), mmap_mode=mmap_mode)
+                           for name in names)
+            #Mark as recently used
+            os.utime(path)
+        except (IOError, OSError, ValueError):
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        """Store the sequence of ``arrays`` for ``key`` and evict old
+        entries if needed."""
+        path = self._path(key)
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        try:
+            size = 0
+            for i, array in enumerate(arrays):
+                filename = osp.join(tmp, '%d.npy' % i)
+                np.save(filename, array)
+                size += osp.getsize(filename)
+            os.rename(tmp, path)
+        except OSError:
+            #Another process stored the same entry first.
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not osp.isdir(path):
+                raise
+            size = 0
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self.entries())
+        else:
+            self._size += size
+        if self._size > self.maxsize:
+            self.evict()
+
+    def entries(self):
+        """Return a list of ``(last_used, size, path)`` for each entry."""
+        result = []
+        for name in os.listdir(self.directory):
+            path = osp.join(self.directory, name)
+            if name.startswith('.') or not osp.isdir(path):
+                continue
+            try:
+                size = sum(osp.getsize(osp.join(path, f))
+                           for f in os.listdir(path))
+                result.append((osp.getmtime(path), size, path))
+            except OSError:
+                continue
+        return result
+
+    def evict(self):
+        """Remove the least recently used entries until the total size is
+        below ``maxsize``."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxsize:
+                break
+            logging.debug("Evicting %s from the cache" % path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+        self._size = 0
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+User defined groupings of the bins of one or more observables, declared in
+the ``bin_groups`` key of the config::
+
+    bin_groups:
+      - name: central_jets
+        observable: atlas-incljets-eta*
+        bins: [1, 2, 3]
+      - name: forward_over_central
+        bins: {atlas-incljets-eta6: all, atlas-incljets-eta7: [1, 2]}
+        over: {atlas-incljets-eta1: all}
+
+Observables are matched by name with glob patterns and bins are numbered
+from 1, as in the tables. The prediction of a group is the sum of its bins
+or, if ``over`` is given, the ratio of that sum to the sum of the bins in
+``over``.
+
+For each PDF, all the groups are compiled into a sparse aggregation matrix
+acting on the stacked values of its ``ResultSet``, so they are computed for
+all the members with a single multiplication.
+"""
+import fnmatch
+import logging
+
+import numpy as np
+import scipy.sparse as sparse
+
+from smpdflib.core import BaseObservable, result_sets
+
+
+class BinGroup(object):
+    """A group of bins. ``bins`` and ``over`` are lists of
+    ``(pattern, bins)`` where ``bins`` is None for all the bins."""
+    def __init__(self, name, bins, over=None):
+        self.name = name
+        self.bins = bins
+        self.over = over
+
+    def __repr__(self):
+        return "<%s:%s>" % (self.__class__.__name__, self.name)
+
+    def patterns(self):
+        selections = self.bins + (self.over or [])
+        return [pattern for pattern, _ in selections]
+
+def _parse_selection(spec, observable=None):
+    if isinstance(spec, dict):
+        items = spec.items()
+    elif observable is not None:
+        items = [(observable, spec)]
+    else:
+        raise ValueError("Bins must be a mapping from observables to bins "
+                         "unless 'observable' is given")
+    selection = []
+    for pattern, bins in items:
+        if bins is None or bins == 'all':
+            bins = None
+        else:
+            if isinstance(bins, int):
+                bins = [bins]
+            if (not isinstance(bins, list) or
+                not all(isinstance(b, int) and b > 0 for b in bins)):
+                raise ValueError("Bins must be 'all' or a list of positive "
+                                 "integers, not %r" % (bins,))
+        selection.append((str(pattern), bins))
+    return selection
+
+def parse_bin_groups(spec):
+    """Return a list of ``BinGroup`` from the content of the ``bin_groups``
+    key of the config. Raises ``ValueError`` if it is malformed."""
+    if not isinstance(spec, list):
+        raise ValueError("bin_groups must be a list of groups")
+    groups = []
+    for item in spec:
+        if not isinstance(item, dict) or 'name' not in item:
+            raise ValueError("Each bin group must be a mapping with a "
+                             "'name': %r" % (item,))
+        unknown = set(item) - {'name', 'observable', 'bins', 'over'}
+        if unknown:
+            raise ValueError("Unknown keys for bin group '%s': %s" %
+                             (item['name'], ', '.join(unknown)))
+        observable = item.get('observable')
+        bins = _parse_selection(item.get('bins'), observable)
+        over = item.get('over')
+        if over is not None:
+            over = _parse_selection(over, observable)
+        groups.append(BinGroup(str(item['name']), bins, over))
+    names = [group.name for group in groups]
+    if len(set(names)) != len(names):
+        raise ValueError("The names of the bin groups must be unique")
+    return groups
+
+def _columns(result_set, selection):
+    """Positions in the stacked values of ``result_set`` of the bins in
+    ``selection``. Return ``(columns, order)``, where ``order`` is the
+    perturbative order of the first matching observable."""
+    columns = set()
+    order = None
+    for i, result in enumerate(result_set):
+        for pattern, bins in selection:
+            if not fnmatch.fnmatch(result.obs.name, pattern):
+                continue
+            if order is None:
+                order = result.obs.order
+            s = result_set.slice(i)
+            if bins is None:
+                columns.update(range(s.start, s.stop))
+                continue
+            for b in bins:
+                if b > result.nbins:
+                    raise ValueError("Observable %s has only %d bins" %
+                                     (result.obs, result.nbins))
+                columns.add(s.start + b - 1)
+    return sorted(columns), order
+
+def aggregation_matrix(columns, nbins):
+    """Sparse matrix of shape ``(len(columns), nbins)`` with a row for each
+    list of ``columns`` which sums them."""
+    indices = np.concatenate([np.asarray(c, dtype=int) for c in columns] +
+                             [np.empty(0, dtype=int)])
+    indptr = np.cumsum([0] + [len(c) for c in columns])
+    return sparse.csr_matrix((np.ones(len(indices)), indices, indptr),
+                             shape=(len(columns), nbins))
+
+def group_results(results, groups):
+    """Apply the ``BinGroup``s ``groups`` to ``results``. Return a list with
+    a ``Result`` for each group and PDF, of the type of the PDF. Groups
+    with no matching bins for a PDF are skipped for it."""
+    grouped = []
+    for pdf, result_set in result_sets(results).items():
+        rows = []
+        active = []
+        for group in groups:
+            columns, order = _columns(result_set, group.bins)
+            over = None
+            if group.over is not None:
+                over, _ = _columns(result_set, group.over)
+            if not columns or (group.over is not None and not over):
+                logging.warning("Bin group '%s' has no bins for %s" %
+                                (group.name, pdf))
+                continue
+            active.append((group, order, len(rows),
+                           None if over is None else len(rows) + 1))
+            rows.append(columns)
+            if over is not None:
+                rows.append(over)
+        if not active:
+            continue
+        A = aggregation_matrix(rows, result_set.values.shape[0])
+        sums = np.asarray(A.dot(result_set.values))
+        cls = type(result_set.stacked)
+        for group, order, num, den in active:
+            values = sums[num]
+            if den is not None:
+                values = values/sums[den]
+            grouped.append(cls(BaseObservable(group.name, order), pdf,
+                               values[np.newaxis]))
+    return grouped
@@ -6,6 +6,7 @@ Created on Tue May  5 15:03:41 2015
 """
 from __future__ import print_function
 import sys
+import numbers
 import itertools
 import glob
 import fnmatch
@@ -16,7 +17,9 @@ import yaml
 
 import smpdflib.lhaindex as lhaindex
 import smpdflib.actions as actions
-from smpdflib.core import PDF, make_observable
+from smpdflib.bingroups import parse_bin_groups
+from smpdflib.core import (PDF, make_observable, CONVOLUTION_ENGINES,
+                           CONVOLUTION_BACKENDS, PDF_EVALUATORS, QLadder)
 
 class ConfigError(ValueError): pass
 
@@ -84,6 +87,46 @@ class Config(object):
                                   % base_pdf)
             d['base_pdf'] = base_pdf
 
+        if 'pdf_evaluator' in group or 'pdf_evaluator' in defaults:
+            evaluator = group.get('pdf_evaluator',
+                                  defaults.get('pdf_evaluator'))
+            if evaluator not in PDF_EVALUATORS:
+                raise ConfigError("Unknown pdf_evaluator '%s'. "
+                                  "Valid ones are: %s" % (evaluator,
+                                                          PDF_EVALUATORS))
+            for pdf in pdfsets:
+                pdf.evaluator = evaluator
+            if 'base_pdf' in d:
+                d['base_pdf'].evaluator = evaluator
+
+        if 'qladder' in group or 'qladder' in defaults:
+            qladder = self.parse_qladder(group.get('qladder',
+                                                   defaults.get('qladder')))
+            for pdf in pdfsets:
+                pdf.qladder = qladder
+            if 'base_pdf' in d:
+                d['base_pdf'].qladder = qladder
+
+        if 'bin_groups' in group or 'bin_groups' in defaults:
+            d['bin_groups'] = self.parse_bin_groups(
+                                  group.get('bin_groups',
+                                            defaults.get('bin_groups')),
+                                  observables)
+
+        if 'convolution_engine' in group:
+            d['convolution_engine'] = self.parse_convolution_engine(
+                                          group['convolution_engine'])
+        elif 'convolution_engine' in defaults:
+            d['convolution_engine'] = self.parse_convolution_engine(
+                                          defaults['convolution_engine'])
+
+        if 'convolution_backend' in group:
+            d['convolution_backend'] = self.parse_convolution_backend(
+                                           group['convolution_backend'])
+        elif 'convolution_backend' in defaults:
+            d['convolution_backend'] = self.parse_convolution_backend(
+                                           defaults['convolution_backend'])
+
         if 'smpdf_spec' in group:
             smpdf_spec = self.parse_smpdf_spec(group['smpdf_spec'],
                                                      observables)
@@ -234,6 +277,53 @@ class Config(object):
 
         return observables
 
+    def parse_convolution_engine(self, engine):
+        if engine not in CONVOLUTION_ENGINES:
+            raise ConfigError("Unknown convolution_engine '%s'. "
+                              "Valid ones are: %s" % (engine,
+                                                      CONVOLUTION_ENGINES))
+        return engine
+
+    def parse_convolution_backend(self, backend):
+        if backend not in CONVOLUTION_BACKENDS:
+            raise ConfigError("Unknown convolution_backend '%s'. "
+                              "Valid ones are: %s" % (backend,
+                                                      CONVOLUTION_BACKENDS))
+        return backend
+
+    def parse_bin_groups(self, bin_groups, observables):
+        try:
+            groups = parse_bin_groups(bin_groups)
+        except ValueError as e:
+            raise ConfigError("Could not parse bin_groups: %s" % e)
+        names = [obs.name for obs in observables]
+        for group in groups:
+            for pattern in group.patterns():
+                if not fnmatch.filter(names, pattern):
+                    raise ConfigError("The pattern '%s' of the bin group "
+                                      "'%s' matches no observable" %
+                                      (pattern, group.name))
+        return groups
+
+    def parse_qladder(self, qladder):
+        """``qladder`` can be a boolean, the number of scales per decade or
+        a mapping with the arguments of ``QLadder``."""
+        if qladder is False or qladder is None:
+            return None
+        if qladder is True:
+            return QLadder()
+        if isinstance(qladder, numbers.Number):
+            qladder = {'density': qladder}
+        if not isinstance(qladder, dict) or (set(qladder) -
+                                             {'density', 'rtol', 'atol'}):
+            raise ConfigError("qladder must be a boolean, a number of scales "
+                              "per decade or a mapping with the keys "
+                              "'density', 'rtol' and 'atol'")
+        try:
+            return QLadder(**qladder)
+        except (TypeError, ValueError) as e:
+            raise ConfigError("Bad qladder: %s" % e)
+
     def parse_smpdf_spec(self, smpdf_spec, observables):
         if not isinstance(smpdf_spec, list):
             raise ConfigError("smpdf_spec must be a list of:\n"
@@ -13,26 +13,32 @@ __license__ = 'GPL'
 __version__ = '1.0.0'
 __email__ = 'stefano.carrazza@mi.infn.it'
 
+import os
 import os.path as osp
 import sys
 from collections import defaultdict, OrderedDict
 import contextlib
 import numbers
 import multiprocessing
+import concurrent.futures
+import threading
 import logging
 import hashlib
+import functools
 
 import numpy as np
 import pandas as pd
 import yaml
 import scipy.stats
 import fastcache
-from pandas.stats import ols
 
 from smpdflib import lhaindex
 from smpdflib import plotutils
+from smpdflib import fastconv
+from smpdflib import lhagrid
+from smpdflib.arraycache import ArrayCache, make_key
 from smpdflib.loggingutils import supress_stdout, initlogging, get_logging_queue
-from smpdflib.utils import break_along
+from smpdflib.utils import break_along, get_cache_dir, save_npz_atomic
 
 import applwrap
 
@@ -40,6 +46,53 @@ import applwrap
 ORDERS_QCD = {0: 'LO', 1: 'NLO', 2: 'NNLO'}
 NUMS_QCD = {val: key for key , val in ORDERS_QCD.items()}
 
+#Ways of computing the APPLgrid predictions: 'applgrid' calls APPLgrid for
+#each member and 'weights' contracts the exported grid weights with all the
+#members at once (see ``smpdflib.fastconv``).
+CONVOLUTION_ENGINES = ('applgrid', 'weights')
+DEFAULT_CONVOLUTION_ENGINE = 'applgrid'
+
+#Ways of running the convolutions: 'processes' uses a process per
+#(pdf, observable) pair (see ``get_dataset_parallel``) and 'threads' a pool
+#of threads in this process (see ``get_dataset``). APPLgrid and AMCFast are
+#not reliable with several grids in one process, so 'threads' is opt-in.
+CONVOLUTION_BACKENDS = ('processes', 'threads')
+DEFAULT_CONVOLUTION_BACKEND = 'processes'
+
+#Ways of evaluating the PDFs: 'lhapdf' goes through applwrap and 'numpy'
+#reads and interpolates the grids with ``smpdflib.lhagrid``.
+PDF_EVALUATORS = ('lhapdf', 'numpy')
+DEFAULT_PDF_EVALUATOR = 'lhapdf'
+
+#Maximum size in bytes of the on disk cache of PDF values (see
+#``PDF.grid_values``). Can be overriden with $SMPDF_GRID_CACHE_SIZE.
+GRID_VALUES_CACHE_SIZE = 2*1024**3
+
+#Number of scales per decade of the Q ladder (see ``QLadder``).
+DEFAULT_QLADDER_DENSITY = 10
+#Maximum estimated error of the interpolation in the Q ladder, relative to
+#the standard deviation of the replicas.
+DEFAULT_QLADDER_RTOL = 1e-2
+#Absolute error of the interpolation in the Q ladder that is always accepted,
+#so that points where the replicas have no spread (flavours that vanish,
+#x close to 1) do not force a direct evaluation.
+DEFAULT_QLADDER_ATOL = 1e-8
+
+#Relative difference below which two energy scales are considered equal when
+#evaluating PDFs at many scales at once.
+DEFAULT_Q_RTOL = 1e-3
+#Maximum number of distinct scales whose PDF matrices ``iter_X_multiQ`` holds
+#in memory at once.
+DEFAULT_Q_CHUNKSIZE = 16
+
+#Number of samples generated at once by ``Result.iter_sample_chunks``.
+DEFAULT_SAMPLE_CHUNKSIZE = 4096
+
+#(Kr, Kf) factors of the renormalization and factorization scales of the
+#usual 7-point scale variation. The first one is the central scale.
+DEFAULT_SCALE_VARIATIONS = ((1, 1), (2, 2), (0.5, 0.5), (2, 1), (1, 2),
+                            (0.5, 1), (1, 0.5))
+
 #for N_f = 4, LHAPDF's M_Z is actually M_{charm}
 M_REF = defaultdict(lambda: 'Z', {4:'c'})
 
@@ -110,22 +163,158 @@ class Observable(BaseObservable):
     @property
     @fastcache.lru_cache()
     def sha1hash(self):
-        with open(self.filename, 'rb') as f:
-            return hashlib.sha1(f.read()).digest()
+        """The sha1 digest of the file. It is only computed again if the
+        file changes (see ``lhaindex.file_digests``)."""
+        return bytes.fromhex(lhaindex.file_digests([self.filename])[0])
+
+#Serialize the loading of handles, so that threads asking for the same
+#grid or set at the same time do not load it twice.
+_handles_lock = threading.RLock()
+
+@fastcache.lru_cache(maxsize=32)
+def _load_grid(filename):
+    with contextlib.ExitStack() as stack:
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            stack.enter_context(supress_stdout())
+        handle = applwrap.GridHandle(filename)
+    return handle
+
+@fastcache.lru_cache(maxsize=8)
+def _load_pdf(name):
+    return applwrap.PDFSetHandle(name)
+
+def load_grid(filename):
+    """Return an ``applwrap.GridHandle`` for the APPLgrid in ``filename``.
+    Handles are cached, so each grid is read only once per process, and
+    any number of them can be alive at the same time."""
+    with _handles_lock:
+        return _load_grid(filename)
+
+def load_pdf(name):
+    """Return an ``applwrap.PDFSetHandle`` for the LHAPDF set ``name``.
+    Handles are cached, so each set is opened only once per process. Only
+    the central member is loaded upfront."""
+    with _handles_lock:
+        return _load_pdf(name)
+
+_grid_values_cache = None
+
+def grid_values_cache():
+    """The ``ArrayCache`` where the values computed by ``PDF.grid_values``
+    are stored."""
+    global _grid_values_cache
+    if _grid_values_cache is None:
+        maxsize = int(os.environ.get('SMPDF_GRID_CACHE_SIZE',
+                                     GRID_VALUES_CACHE_SIZE))
+        _grid_values_cache = ArrayCache(get_cache_dir('grid_values'),
+                                        maxsize)
+    return _grid_values_cache
+
+class QLadder(TupleComp):
+    """Log spaced energy scales, ``density`` per decade, where the values
+    of a PDF are computed (and cached) once, to be interpolated with a cubic
+    in log Q to any other scale. The nodes are ``10**(k/density)`` for
+    integer ``k``, so they are the same for any analysis.
+
+    The error of the interpolation at each scale is estimated as the
+    difference with the quadratic interpolation through the three closest
+    nodes. Scales where it is larger than ``rtol`` times the standard
+    deviation of the replicas plus ``atol`` at some point (for example
+    close to the heavy quark thresholds) are computed directly instead.
+    """
+    def __init__(self, density=DEFAULT_QLADDER_DENSITY,
+                 rtol=DEFAULT_QLADDER_RTOL, atol=DEFAULT_QLADDER_ATOL):
+        if density <= 0:
+            raise ValueError("The density of the Q ladder must be positive")
+        self.density = density
+        self.rtol = rtol
+        self.atol = atol
+
+    def __repr__(self):
+        return "%s(density=%r, rtol=%r, atol=%r)" % (
+                   self.__class__.__name__, self.density, self.rtol,
+                   self.atol)
 
-_selected_grid = None
+    def get_key(self):
+        return (self.density, self.rtol, self.atol)
+
+    def node(self, k):
+        return 10**(k/self.density)
+
+    def locate(self, Q):
+        """Return ``(k, t)`` such that ``Q`` is at the fraction ``t`` (in
+        log Q) of the interval between the nodes ``k`` and ``k+1``."""
+        s = self.density*np.log10(Q)
+        k = int(np.floor(s))
+        return k, s - k
+
+    @staticmethod
+    def cubic_weights(t):
+        """Weights of the nodes ``k-1, ..., k+2`` for the cubic
+        interpolation at ``t``."""
+        return np.array([-t*(t - 1)*(t - 2)/6, (t + 1)*(t - 1)*(t - 2)/2,
+                         -(t + 1)*t*(t - 2)/2, (t + 1)*t*(t - 1)/6])
+
+    @staticmethod
+    def quadratic_weights(t):
+        """Weights of the nodes ``k-1, ..., k+2`` for the quadratic
+        interpolation at ``t`` through the three closest nodes."""
+        if t < 0.5:
+            return np.array([t*(t - 1)/2, 1 - t*t, (t + 1)*t/2, 0])
+        return np.array([0, (t - 1)*(t - 2)/2, -t*(t - 2), t*(t - 1)/2])
 
 class APPLGridObservable(Observable):
     """Class that represents an APPLGrid. """
 
+    @property
+    def handle(self):
+        """The ``applwrap.GridHandle`` with the content of the grid."""
+        return load_grid(self.filename)
+
+    _scales = None
+
+    @property
+    def scales_filename(self):
+        """Path of the sidecar file where the scale information of the grid
+        is cached."""
+        return osp.join(get_cache_dir('applgrid_scales'),
+                        '%s_%d.npz' % (self.sha1hash.hex(), self.order))
+
+    @property
+    def scales(self):
+        """Scale information of the grid, as returned by
+        ``applwrap.GridHandle.getobsq_all``. It is computed in a single pass
+        over the grid the first time and then read from
+        ``scales_filename``, so that it is available without loading the
+        grid in later runs."""
+        if self._scales is not None:
+            return self._scales
+        filename = self.scales_filename
+        try:
+            with np.load(filename) as f:
+                scales = dict(f)
+        except (IOError, ValueError):
+            logging.debug("Computing scales of %s" % self)
+            scales = self.handle.getobsq_all(self.order)
+            save_npz_atomic(filename, **scales)
+        self._scales = scales
+        return scales
+
+    def weights_Qdistribution(self, bin):
+        """Return the values of Q of the nodes with nonzero weights in
+        ``bin``, and the number of weights at each."""
+        scales = self.scales
+        start, end = scales['offset'][bin], scales['offset'][bin+1]
+        return scales['Q'][start:end], scales['counts'][start:end]
+
     @property
     def nbins(self):
-        """Number of bins in the APPLGrid. It will be loaded
-         in memory the first time this property is quiried."""
+        """Number of bins in the APPLGrid. The grid will be loaded
+        in memory the first time this property is quiried, unless the
+        scales are cached (see ``scales``)."""
         if self._nbins is not None:
             return self._nbins
-        with self:
-            nbins = applwrap.getnbins()
+        nbins = int(self.scales['nbins'])
         self._nbins = nbins
         return nbins
 
@@ -135,34 +324,44 @@ class APPLGridObservable(Observable):
         the nonzero weights of each bin"""
         if self._meanQ is not None:
             return self._meanQ
-        with self:
-            meanQ = [applwrap.getobsq(self.order, i) for
-                 i in range(self.nbins)]
+        meanQ = list(self.scales['meanQ'])
         self._meanQ = meanQ
         return meanQ
 
+    def convolute(self, pdf, members=None):
+        """Convolve the grid with the given ``members`` of ``pdf`` (all
+        by default). Return an array of shape ``(nmembers, nbins)``."""
+        if members is not None:
+            members = np.asarray(members, dtype=np.intc)
+        return self.handle.convolute_all(pdf.handle, self.order, members)
+
+    def convolute_scales(self, pdf, scales, members=None):
+        """Convolve the grid with the given ``members`` of ``pdf`` (all
+        by default) for each of the ``(Kr, Kf)`` pairs in ``scales``, in a
+        single call to applwrap. Return an array of shape
+        ``(nscales, nmembers, nbins)``."""
+        if members is not None:
+            members = np.asarray(members, dtype=np.intc)
+        return self.handle.convolute_scales(pdf.handle, self.order,
+                                            np.asarray(scales,
+                                                       dtype=np.float64),
+                                            members)
+
     def __enter__(self):
-        """Load observable file in memory, using `with obs`.
+        """Load observable file in memory, using `with obs`. The grid stays
+        loaded (see ``load_grid``) after the block exits, and several
+        observables can be used at the same time.
+
+        Note: Expect random bugs due to APPLGrid poor implementation when
+        convolving several observables in the same process. In particular,
+        convolutions of grids made with AMCFast may not work. By default
+        each convolution runs in its own process (see
+        ``get_dataset_parallel``)."""
+        self.handle
+        return self
 
-        Note: Except random bugs due to APPLGrid poor implementation
-        when loading several observables in the same process. In particular,pdf
-        convolutions of grids made with AMCFast will not work."""
-        global _selected_grid
-        if _selected_grid == self.filename:
-            return
-        if _selected_grid is not None:
-            raise RuntimeError("Contrdicting observable scope. "
-                               "Was %s and trying to enter %s" %
-                               (_selected_grid, self.filename))
-
-        with contextlib.ExitStack() as stack:
-            if not logging.getLogger().isEnabledFor(logging.DEBUG):
-                stack.enter_context(supress_stdout())
-            applwrap.initobs(self.filename)
-        _selected_grid = self.filename
     def __exit__(self, exc_type, exc_value, traceback):
-        global _selected_grid
-        _selected_grid = None
+        pass
 
 class PredictionObservable(Observable):
     """Class representing a prediction in the custom SMPDF format."""
@@ -225,8 +424,6 @@ class PDFValues(Observable):
 
 class PDFDoesNotExist(AttributeError): pass
 
-_selected_pdf = None
-_context_pdf = None
 class PDF(TupleComp):
     """A class representig the metadata and content of an LHAPDF grid.
     The attributes of the `.info` file can be queried directly as attribute
@@ -241,13 +438,26 @@ class PDF(TupleComp):
            that require reading the metadata will fail.
     label : str
            A label used for plotting (instrad the gris name).
+    evaluator : str
+           How to compute the values of the PDFs, one of ``PDF_EVALUATORS``.
+           With 'numpy', ``grid_values`` (and everything built on it) does
+           not use applwrap.
+    qladder : QLadder
+           If given, ``grid_values`` computes the values at the nodes of the
+           ladder and interpolates them to the requested scale.
     """
-    def __init__(self, name, label=None):
+    def __init__(self, name, label=None, evaluator=DEFAULT_PDF_EVALUATOR,
+                 qladder=None):
 
         self.name = name
         if label is None:
             label = name
         self.label = label
+        if evaluator not in PDF_EVALUATORS:
+            raise ValueError("Unknown PDF evaluator '%s'. Valid ones are: %s"
+                             % (evaluator, PDF_EVALUATORS))
+        self.evaluator = evaluator
+        self.qladder = qladder
 
 
     def get_key(self):
@@ -256,24 +466,34 @@ class PDF(TupleComp):
         return (str(self.name),)
 
 
+    @property
+    def handle(self):
+        """The ``applwrap.PDFSetHandle`` of the set. Members are loaded on
+        demand, keeping at most ``handle.max_resident`` of them in
+        memory."""
+        return load_pdf(self.name)
+
+    def iter_member_chunks(self, chunksize=None, members=None):
+        """Iterate over the ``members`` (all by default) in arrays of at
+        most ``chunksize`` indexes (``handle.max_resident`` by default).
+        Processing the members chunk by chunk keeps the memory bounded by
+        the chunk size rather than by the size of the set."""
+        if members is None:
+            members = self.reps
+        if chunksize is None:
+            chunksize = self.handle.max_resident
+        members = np.asarray(members, dtype=np.intc)
+        for start in range(0, len(members), chunksize):
+            yield members[start:start+chunksize]
+
     def __enter__(self):
-        """Load PDF in memory."""
-        global _selected_pdf
-        global _context_pdf
-        if _selected_pdf == str(self):
-            _context_pdf = str(self)
-            return
-        if _context_pdf is not None and _context_pdf != str(self):
-            raise RuntimeError("Contrdicting PDF scope. "
-                               "Was %s and trying to enter %s" %
-                               (_context_pdf, self))
-        _selected_pdf = str(self)
-        _context_pdf = str(self)
-        applwrap.initpdf(self.name)
+        """Load PDF in memory. The set stays loaded (see ``load_pdf``) after
+        the block exits."""
+        self.handle
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        global _context_pdf
-        _context_pdf = None
+        pass
 
     def __str__(self):
         return self.name
@@ -316,9 +536,15 @@ class PDF(TupleComp):
     def q2min_rep0(self):
         """Retreive the min q2 value of repica zero. NNote that this will
         load the whole grid if not already in memory."""
-        with self:
-            res = applwrap.q2Min()
-        return res
+        if self.evaluator == 'numpy':
+            return self.gridset.subgrids[0].q[0]**2
+        return self.handle.q2Min()
+
+    @property
+    def gridset(self):
+        """The ``lhagrid.GridSet`` with the grids of all the members, used
+        by the 'numpy' evaluator."""
+        return lhagrid.load_gridset(self.name)
 
     @staticmethod
     def make_xgrid(xminlog=1e-5, xminlin=1e-1, xmax=1, nplog=50, nplin=50):
@@ -334,11 +560,9 @@ class PDF(TupleComp):
     def make_flavors(nf=3):
         return np.arange(-nf,nf+1)
 
-    @fastcache.lru_cache(maxsize=128, unhashable='ignore')
-    def grid_values(self, Q, xgrid=None, fl=None):
-
-        if Q is None:
-            Q = self.q2Min
+    def _grid_spec(self, xgrid=None, fl=None):
+        """Resolve the ``xgrid`` and ``fl`` arguments of ``grid_values``
+        into arrays."""
         if xgrid is None:
             xgrid = self.make_xgrid()
         #Allow tuples that can be saved in cache
@@ -351,23 +575,130 @@ class PDF(TupleComp):
             fl = self.make_flavors(fl)
         elif isinstance(fl, tuple):
             fl = self.make_flavors(*fl)
+        return xgrid, fl
+
+    def _cached_values(self, compute, *spec):
+        """Return the arrays computed by ``compute()``, storing them in
+        the on disk cache (see ``grid_values_cache``) under a key made of
+        the hash of the set and ``spec``."""
+        cache = grid_values_cache()
+        key = make_key(self.name, self.sha1hash, self.evaluator, *spec)
+        cached = cache.get(key)
+        if cached is not None:
+            logging.debug("Reading values of %s from the disk cache" % self)
+            return cached
+        result = compute()
+        cache.put(key, result)
+        return result
 
-        with self:
-            all_members = [[[applwrap.xfxQ(r, f, x, Q)
-                             for x in xgrid]
-                             for f in fl]
-                             for r in range(len(self))]
-
-            all_members = np.array(all_members)
-            mean = all_members[0]
-            replicas = all_members[1:]
+    def grid_values(self, Q, xgrid=None, fl=None):
+        """Return ``(mean, replicas)``, the values of :math:`xf(x, Q)` of
+        the central member, with shape ``(nfl, nx)``, and of the other
+        members, with shape ``(nrep, nfl, nx)``. The values are stored on
+        disk, keyed by the content of the set, ``Q``, ``xgrid`` and ``fl``,
+        and are read back as (read only) memory mapped arrays. If the PDF
+        has a ``qladder``, they are interpolated from the nodes of the
+        ladder when the estimated error is small enough."""
+        if Q is None:
+            Q = self.q2Min
+        if self.qladder is not None:
+            result = self._ladder_values(Q, xgrid, fl)
+            if result is not None:
+                return result
+            logging.debug("Computing the values of %s at Q=%g directly" %
+                          (self, Q))
+        return self._grid_values(Q, xgrid, fl)
+
+    def _ladder_values(self, Q, xgrid, fl):
+        """Interpolate the values at ``Q`` from the ``qladder``. Return
+        ``None`` if the nodes needed are outside the range of the set or
+        if the estimated error is too large."""
+        ladder = self.qladder
+        k, t = ladder.locate(Q)
+        nodes = [ladder.node(k + i) for i in range(-1, 3)]
+        if nodes[0] < self.QMin or nodes[-1] > self.QMax:
+            return None
+        values = [self._grid_values(node, xgrid, fl) for node in nodes]
+        means = np.array([mean for mean, _ in values])
+        replicas = np.array([reps for _, reps in values])
+        cubic, quadratic = ladder.cubic_weights(t), ladder.quadratic_weights(t)
+        mean = np.tensordot(cubic, means, axes=1)
+        reps = np.tensordot(cubic, replicas, axes=1)
+        error = np.maximum(
+                    np.abs(np.tensordot(cubic - quadratic, means, axes=1)),
+                    np.abs(np.tensordot(cubic - quadratic, replicas,
+                                        axes=1)).max(axis=0))
+        if np.any(error > ladder.rtol*reps.std(axis=0) + ladder.atol):
+            return None
+        return mean, reps
+
+    def _grid_values(self, Q, xgrid=None, fl=None):
+        """Compute (or read from the disk cache) the values of
+        ``grid_values`` at exactly ``Q``."""
+        #PDFs compare equal by name, so the settings that change how the
+        #values are computed must be part of the key of the memory cache.
+        return self._memory_grid_values(self.evaluator, self.qladder, Q,
+                                        xgrid, fl)
 
-        return mean, replicas
+    @fastcache.lru_cache(maxsize=128, unhashable='ignore')
+    def _memory_grid_values(self, evaluator, qladder, Q, xgrid=None,
+                            fl=None):
+        xgrid, fl = self._grid_spec(xgrid, fl)
+
+        def compute():
+            all_members = self.xfxQ_grid(self.reps, fl, xgrid, Q)
+            return all_members[0], all_members[1:]
+
+        return self._cached_values(compute, 'grid_values', float(Q),
+                                   np.asarray(xgrid, dtype=np.float64),
+                                   np.asarray(fl, dtype=np.intc))
+
+    def grid_values_multiQ(self, Qs, xgrid=None, fl=None):
+        """Like ``grid_values``, but for a sequence of energy scales ``Qs``,
+        computed in a single pass. The returned ``mean`` has shape
+        ``(len(Qs), nfl, nx)`` and ``replicas`` has shape
+        ``(len(Qs), nrep, nfl, nx)``. If the PDF has a ``qladder``, each
+        scale is computed as in ``grid_values``."""
+        if self.qladder is not None:
+            values = [self.grid_values(Q, xgrid, fl) for Q in Qs]
+            return (np.array([mean for mean, _ in values]),
+                    np.array([reps for _, reps in values]))
+        xgrid, fl = self._grid_spec(xgrid, fl)
+        Qs = np.asarray(Qs, dtype=np.float64)
+
+        def compute():
+            all_members = self.xfxQ_multigrid(self.reps, fl, xgrid, Qs)
+            return all_members[:, 0], all_members[:, 1:]
+
+        return self._cached_values(compute, 'grid_values_multiQ', Qs,
+                                   np.asarray(xgrid, dtype=np.float64),
+                                   np.asarray(fl, dtype=np.intc))
 
     def xfxQ(self, rep, fl, x, Q):
-        with self:
-            res = applwrap.xfxQ(rep, fl, x, Q)
-        return res
+        return self.handle.xfxQ(rep, fl, x, Q)
+
+    def xfxQ_grid(self, reps, fl, xgrid, Q):
+        """Return an array of shape ``(len(reps), len(fl), len(xgrid))``
+        with the values of :math:`xf(x, Q)` for the given members,
+        flavours (PDG ids) and x points. The whole tensor is filled in
+        a single call to applwrap (or to ``lhagrid``)."""
+        if self.evaluator == 'numpy':
+            return self.gridset.xfxQ_grid(reps, fl, xgrid, Q)
+        return self.handle.xfxQ_grid(np.asarray(reps, dtype=np.intc),
+                                     np.asarray(fl, dtype=np.intc),
+                                     np.asarray(xgrid, dtype=np.float64),
+                                     Q)
+
+    def xfxQ_multigrid(self, reps, fl, xgrid, Qs):
+        """Like ``xfxQ_grid`` but for several energy scales ``Qs``. Return
+        an array of shape ``(len(Qs), len(reps), len(fl), len(xgrid))``."""
+        if self.evaluator == 'numpy':
+            return self.gridset.xfxQ_multigrid(reps, fl, xgrid, Qs)
+        return self.handle.xfxQ_multigrid(np.asarray(reps, dtype=np.intc),
+                                          np.asarray(fl, dtype=np.intc),
+                                          np.asarray(xgrid,
+                                                     dtype=np.float64),
+                                          np.asarray(Qs, dtype=np.float64))
 
     @property
     def infopath(self):
@@ -376,10 +707,16 @@ class PDF(TupleComp):
     @property
     @fastcache.lru_cache()
     def sha1hash(self):
-        """Currently hashs the info file. This could not be sufficient for
-        as proof since the grid inside could be modified."""
-        with open(self.infopath, 'rb') as f:
-            return hashlib.sha1(f.read()).digest()
+        """Hash of the content of all the files of the set (see
+        ``lhaindex.fingerprint``). Files that did not change since they were
+        last hashed are not read again."""
+        return lhaindex.fingerprint(self.name)
+
+    def member_digests(self):
+        """Return the sha1 hex digests of the files of the members, in
+        order."""
+        return lhaindex.file_digests([lhagrid.member_path(self.name, m)
+                                      for m in self.reps])
 
 
     def __getattr__(self, name):
@@ -398,14 +735,35 @@ class PDF(TupleComp):
         return self.NumMembers
 
 
-class Result():
+def _default_labels(labels, n):
+    """Return None if ``labels`` are ``0, ..., n-1``, so that they need not
+    be stored, or the labels as an ``Index`` otherwise."""
+    labels = pd.Index(labels)
+    if (len(labels) == n and labels.dtype.kind in 'iu' and
+        np.array_equal(labels.values, np.arange(n))):
+        return None
+    return labels
+
+def _result_values(data):
+    """Return ``(values, bins, members)`` from the ``data`` of a ``Result``,
+    where ``values`` is an array of shape ``(nbins, nmem)``."""
+    if isinstance(data, dict) and all(isinstance(v, (np.ndarray, list))
+                                      for v in data.values()):
+        values = np.column_stack([np.asarray(v, dtype=float).reshape(-1)
+                                  for v in data.values()])
+        return values, None, list(data.keys())
+    if not isinstance(data, pd.DataFrame):
+        if isinstance(data, np.ndarray) and data.ndim == 2:
+            return data, None, None
+        data = pd.DataFrame(data)
+    return data.values, data.index, data.columns
+
+class Result(object):
     """A class representing a result of the computation of an observable for
-    each member of a PDF set. `pd.DataFrame` will be called on `data`. The
-    result must have the bins as the columns and each replica as the rows.
+    each member of a PDF set. The values are stored in an array of shape
+    ``(nbins, nmem)``, where the first member is the central one.
     Subclasses of `Result` provide specialized methods to compute uncertainty.
 
-    #TODO: This docstring is **WRONG**, must traspose evey signle DataFrame!
-
     Parameters
     ----------
     obs :
@@ -417,13 +775,54 @@ class Result():
 
 
     data :
-        `DataFrame`-like
+        Array of shape ``(nbins, nmem)``, `DataFrame`  with the bins as rows
+        and the members as columns, or mapping from each member to an array
+        with the value for each bin.
 
+    The `DataFrame` views (``_data``, ``_all_vals``, ...) are only built
+    when requested.
     """
+    __slots__ = ('obs', 'pdf', '_values', '_bins', '_members', '_frame',
+                 '_cache')
+
     def __init__(self, obs, pdf, data):
         self.obs = obs
         self.pdf = pdf
-        self._data = pd.DataFrame(data)
+        values, bins, members = _result_values(data)
+        self._values = np.ascontiguousarray(values, dtype=float)
+        nbins, nmem = self._values.shape
+        self._bins = None if bins is None else _default_labels(bins, nbins)
+        self._members = (None if members is None else
+                         _default_labels(members, nmem))
+        self._frame = None
+        #Uncertainties already computed, which depend only on the values.
+        self._cache = {}
+
+    def __getstate__(self):
+        return {'obs': self.obs, 'pdf': self.pdf, '_values': self._values,
+                '_bins': self._bins, '_members': self._members}
+
+    def __setstate__(self, state):
+        #Results pickled before they were array backed only have _data
+        if '_data' in state:
+            self.__init__(state['obs'], state['pdf'], state['_data'])
+            return
+        for attr, value in state.items():
+            setattr(self, attr, value)
+        self._frame = None
+        self._cache = {}
+
+    @property
+    def _data(self):
+        """`DataFrame` with the bins as rows and the members as columns.
+        It is a view of the values, built on first access."""
+        if self._frame is None:
+            self._frame = pd.DataFrame(self._values, index=self.binlabels,
+                                       columns=self.memberlabels, copy=False)
+        return self._frame
+
+    def _bin_series(self, values):
+        return pd.Series(values, index=self.binlabels)
 
     @property
     def central_value(self):
@@ -432,21 +831,27 @@ class Result():
 
     @property
     def _cv(self):
-        return self._data[0]
+        return self._bin_series(self._values[:, 0])
 
     @property
     def _all_vals(self):
         return self._data.iloc[:,1:]
 
+    @property
+    def _diffs(self):
+        """Array with the difference between each member and the central
+        value, with shape ``(nbins, nrep)``."""
+        return self._values[:, 1:] - self._values[:, :1]
+
     @property
     def nrep(self):
         """Number of PDF members"""
-        return self._all_vals.shape[1]
+        return self._values.shape[1] - 1
 
     @property
     def nbins(self):
         """Number of bins in the preduction."""
-        return self._all_vals.shape[0]
+        return self._values.shape[0]
 
     @property
     def meanQ(self):
@@ -457,37 +862,78 @@ class Result():
         raise NotImplementedError("No error computation implemented for this"
                                   "type of set")
 
-    def sample_values(self, n):
+    def _sample_chunk(self, n, rng):
+        """Return an array of shape ``(n, nbins)`` with ``n`` random
+        predictions, using the ``numpy.random.Generator`` ``rng``."""
         raise NotImplementedError("No sampling implemented for this"
                                   "type of set")
 
+    def iter_sample_chunks(self, n, rng=None,
+                           chunksize=DEFAULT_SAMPLE_CHUNKSIZE):
+        """Generate ``n`` random predictions, in arrays of shape
+        ``(m, nbins)`` with ``m`` at most ``chunksize``. ``rng`` can be a
+        ``numpy.random.Generator`` or anything accepted by
+        ``numpy.random.default_rng`` (such as a seed)."""
+        rng = np.random.default_rng(rng)
+        for start in range(0, n, chunksize):
+            yield self._sample_chunk(min(chunksize, n - start), rng)
+
+    def sample_matrix(self, n, rng=None, chunksize=DEFAULT_SAMPLE_CHUNKSIZE):
+        """Return an array of shape ``(n, nbins)`` with ``n`` random
+        predictions (see ``iter_sample_chunks``)."""
+        chunks = list(self.iter_sample_chunks(n, rng, chunksize))
+        if not chunks:
+            return np.empty((0, self.nbins))
+        return np.concatenate(chunks)
+
+    def sample_values(self, n):
+        """Generate ``n`` random predictions as `Series`. Prefer
+        ``sample_matrix``."""
+        for row in self.sample_matrix(n):
+            yield self._bin_series(row)
+
     def errorbar68(self):
         raise NotImplementedError("Error computation for PDF set"
                                    " not implmented")
 
     def std_interval(self, nsigma=1):
-        std = self.std_error(nsigma)
-        return pd.DataFrame({'min':self._cv - std,
-                             'max':self._cv + std})
+        std = np.asarray(self.std_error(nsigma))
+        cv = self._values[:, 0]
+        return pd.DataFrame({'min':cv - std,
+                             'max':cv + std}, index=self.binlabels)
 
     def rel_std_interval(self, nsigma=1):
-        std = self.std_error(nsigma)
+        std = np.asarray(self.std_error(nsigma))
         return pd.DataFrame({'min':-std,
-                             'max':std})
+                             'max':std}, index=self.binlabels)
 
     #TODO: Start from 1 by default?
     @property
     def binlabels(self):
         "Return the labels of the bins for this observable"
-        return self._data.index
+        if self._bins is None:
+            return pd.Index(np.arange(self.nbins))
+        return self._bins
 
+    @property
+    def memberlabels(self):
+        "Return the labels of the members, the first being the central one"
+        if self._members is None:
+            return pd.Index(np.arange(self._values.shape[1]))
+        return self._members
 
     def __getitem__(self, item):
-        return self._data[item]
+        if self._members is None:
+            if not 0 <= item < self._values.shape[1]:
+                raise KeyError(item)
+            pos = item
+        else:
+            pos = self._members.get_loc(item)
+        return self._bin_series(self._values[:, pos])
 
     def iterreplicas(self):
         """Iterate over all data, first being the central prediction"""
-        return iter(self._data)
+        return iter(self.memberlabels)
 
 #==============================================================================
 #     def __iter__(self):
@@ -500,10 +946,10 @@ class Result():
 
 
     def _violin_data(self, rel_to=None):
-        absdata = pd.concat(self.sample_values(10000),axis=1)
+        absdata = self.sample_matrix(10000)
         if rel_to is None:
             rel_to = 1
-        reldata = absdata.as_matrix().T/rel_to
+        reldata = absdata/rel_to
         return reldata
 
     def violin_plot(self, data=None , **kwargs):
@@ -515,8 +961,20 @@ class Result():
         return plotutils.violin_plot(data, **myargs)
 
     def sumbins(self, bins = None):
-        sumobs = BaseObservable(self.obs.name + '[Sum]', self.obs.order)
-        data = pd.DataFrame(self._data.sum(axis=0)).T
+        """Return a result with a single bin, the sum of the bins at the
+        (zero based) positions ``bins``, or of all the bins by default."""
+        if bins is None:
+            return self._summed(self._values.sum(axis=0))
+        bins = list(bins)
+        return self._summed(self._values[bins].sum(axis=0),
+                            'Sum %s' % ','.join(str(b) for b in bins))
+
+    def _summed(self, total, label='Sum'):
+        """Result of the same type with a single bin with the values
+        ``total``."""
+        sumobs = BaseObservable('%s[%s]' % (self.obs.name, label),
+                                self.obs.order)
+        data = pd.DataFrame(total[np.newaxis], columns=self.memberlabels)
         return self.__class__(sumobs, self.pdf, data)
 
     @property
@@ -527,6 +985,7 @@ class Result():
 
 class SymHessianResult(Result):
     """Result obtained from a symmetric Hessain PDF set"""
+    __slots__ = ()
 
     def rescale_ci(self):
         if hasattr(self.pdf, "ErrorConfLevel"):
@@ -539,25 +998,24 @@ class SymHessianResult(Result):
             return 1
 
     def std_error(self, nsigma=1):
-        diffsq = (self._all_vals.subtract(self._cv, axis=0))**2
-        return diffsq.sum(axis=1).apply(np.sqrt)*nsigma/self.rescale_ci()
+        diffs = self._diffs
+        std = np.sqrt(np.einsum('ij,ij->i', diffs, diffs))
+        return self._bin_series(std*nsigma/self.rescale_ci())
 
     @property
     def errorbar68(self):
         """Compute the errorbars from the one sigma error"""
         return self.rel_std_interval()
 
-    def sample_values(self, n):
-        """Sample n random values from th resulting Gaussian distribution"""
-        diffs = self._all_vals.subtract(self._cv, axis=0)
-        for _ in range(n):
-            weights = np.random.normal(scale=self.rescale_ci(), size=self.nrep)
-            error = (diffs*weights).sum(axis=1)
-            yield self._cv + error
+    def _sample_chunk(self, n, rng):
+        """Sample from the resulting Gaussian distribution: one Gaussian
+        weight per eigenvector times the matrix of differences."""
+        weights = rng.normal(scale=self.rescale_ci(), size=(n, self.nrep))
+        return self._values[:, 0] + weights.dot(self._diffs.T)
 
     def _violin_data(self, rel_to = None):
-        std = self.std_error()
-        mean = self.central_value.as_matrix()
+        std = np.asarray(self.std_error())
+        mean = self._values[:, 0]
 
         if rel_to is None:
             rel_to = np.ones_like(mean)
@@ -587,27 +1045,31 @@ class SymHessianResult(Result):
 
 class HessianResult(SymHessianResult):
     """Result obtained from an asymmetric Hessian PDF set"""
+    __slots__ = ()
 
     def std_error(self, nsigma=1):
-        m = self._all_vals.as_matrix()
+        m = self._values[:, 1:]
         diffsq = (m[:, ::2] - m[:, 1::2])**2
-        return np.sqrt(diffsq.sum(axis=1))/2.0*nsigma/self.rescale_ci()
-
-    def sample_values(self, n):
-        """Sample n random values from the resulting asymmetric
-        distribution"""
-        m = self._all_vals.as_matrix()
-        plus = m[:, ::2]
-        minus = m[:, 1::2]
-
-        for _ in range(n):
-            r = np.random.normal(scale=self.rescale_ci(), size=len(plus))
-            error = (r >=0)*r*plus - (r < 0)*r*minus
-            yield self._cv + error
+        return self._bin_series(np.sqrt(diffsq.sum(axis=1))/2.0*nsigma/
+                                self.rescale_ci())
+
+    def _sample_chunk(self, n, rng):
+        """Sample from the resulting asymmetric distribution: for each pair
+        of eigenvectors, positive weights move towards the first member and
+        negative ones towards the second."""
+        diffs = self._diffs
+        plus = diffs[:, ::2]
+        minus = diffs[:, 1::2]
+        r = rng.normal(scale=self.rescale_ci(), size=(n, plus.shape[1]))
+        error = np.where(r >= 0, r, 0).dot(plus.T) - np.where(r < 0, r,
+                                                              0).dot(minus.T)
+        return self._values[:, 0] + error
 
 
 class MCResult(Result):
     """Result obtained from a Monte Carlo PDF set"""
+    __slots__ = ()
+
     def centered_interval(self, percent=68, addcentral=True):
         """Compute the ``percent`` confidence intervals for each bin in the
         following way:
@@ -616,36 +1078,112 @@ class MCResult(Result):
         percentage. With the option  ``addcentral`` enabled,
         the intervals will be
         returned around the mean, and without it, will be around zero."""
-        n = percent*self.nrep//100
-        def get_lims(row):
-            row = row.as_matrix()
-            s = np.argsort(np.abs(row))
-            sel = row[s][:n]
-            return pd.Series({'min':np.min(sel), 'max':np.max(sel)})
-
-        diffs = self._all_vals.subtract(self._cv, axis=0)
-        limits = diffs.apply(get_lims, axis=1)
-        if addcentral:
-            limits = limits.add(self._cv, axis=0)
-        return limits
+        return self.centered_intervals([percent], addcentral)[percent]
+
+    def centered_intervals(self, percents, addcentral=True):
+        """Like ``centered_interval`` for each of the ``percents``, computed
+        in the same pass. Return an ``OrderedDict`` mapping each percentage
+        to its intervals. The intervals are stored in the result, so they
+        are computed only once."""
+        missing = [p for p in percents if ('centered', p) not in self._cache]
+        if missing:
+            ns = {p: p*self.nrep//100 for p in missing}
+            for p, n in ns.items():
+                if not 0 < n <= self.nrep:
+                    raise ValueError("Cannot compute a %s%% interval with %d "
+                                     "replicas" % (p, self.nrep))
+            #After partitioning, the n closest members to the mean are the
+            #first n ones for each n - 1 in kth.
+            kth = sorted({n - 1 for n in ns.values()})
+            diffs = self._diffs
+            order = np.argpartition(np.abs(diffs), kth, axis=1)
+            diffs = diffs[np.arange(self.nbins)[:, np.newaxis], order]
+            for p, n in ns.items():
+                self._cache[('centered', p)] = (diffs[:, :n].min(axis=1),
+                                                diffs[:, :n].max(axis=1))
+        result = OrderedDict()
+        for p in percents:
+            lims = self._cache[('centered', p)]
+            if addcentral:
+                lims = tuple(lim + self._values[:, 0] for lim in lims)
+            result[p] = pd.DataFrame({'min':lims[0], 'max':lims[1]},
+                                     index=self.binlabels)
+        return result
 
     @property
     def errorbar68(self):
         return self.centered_interval(addcentral=False)
 
     def std_error(self, nsigma=1):
-        return self._all_vals.std(axis=1)*nsigma
+        return self._bin_series(np.std(self._values[:, 1:], axis=1, ddof=1)
+                                *nsigma)
 
-    def sample_values(self, n):
+    def _sample_chunk(self, n, rng):
         """Sample n random values from the results for the replicas"""
-        for _ in range(n):
-            col = np.random.choice(self._all_vals.columns)
-            yield self._all_vals[col]
+        cols = rng.integers(1, self.nrep + 1, size=n)
+        return self._values[:, cols].T
 
     def _violin_data(self, rel_to = None):
         if rel_to is None:
             rel_to = 1
-        return self._all_vals.as_matrix().T/ rel_to
+        return self._values[:, 1:].T/ rel_to
+
+class ResultSet(object):
+    """The results of several observables for the same PDF, with the bins
+    of all of them stacked in one array of shape ``(total_bins, nmem)``.
+    ``stacked`` is a ``Result`` of the type of the PDF over all the bins,
+    so the uncertainties of the whole set are computed in a single call.
+    The bins of ``results[i]`` are ``slice(i)``."""
+    def __init__(self, results):
+        self.results = list(results)
+        if not self.results:
+            raise ValueError("A ResultSet needs at least one result")
+        self.pdf = self.results[0].pdf
+        if any(result.pdf != self.pdf for result in self.results):
+            raise ValueError("All the results in a ResultSet must be for the "
+                             "same PDF")
+        self.offsets = np.cumsum([0] + [result.nbins for result in
+                                        self.results])
+        values = np.concatenate([result._values for result in self.results])
+        self.stacked = type(self.results[0])(None, self.pdf, values)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    @property
+    def values(self):
+        return self.stacked._values
+
+    def slice(self, i):
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    @property
+    def index(self):
+        """``MultiIndex`` of (observable, bin) for the stacked bins."""
+        obs = [result.obs for result in self.results for _ in
+               range(result.nbins)]
+        bins = np.concatenate([np.asarray(result.binlabels) for result in
+                               self.results])
+        return pd.MultiIndex.from_arrays([obs, bins],
+                                         names=['Observable', 'Bin'])
+
+    def sumbins(self):
+        """Return the ``sumbins()`` of each result."""
+        totals = np.add.reduceat(self.values, self.offsets[:-1], axis=0)
+        return [result._summed(total) for result, total in
+                zip(self.results, totals)]
+
+def result_sets(results):
+    """Group ``results`` by PDF. Return an ``OrderedDict`` mapping each PDF
+    (in order of appearance) to a ``ResultSet``."""
+    grouped = OrderedDict()
+    for result in results:
+        grouped.setdefault(result.pdf, []).append(result)
+    return OrderedDict((pdf, ResultSet(pdf_results)) for pdf, pdf_results in
+                       grouped.items())
 
 def aggregate_results(results):
     combined = defaultdict(lambda: OrderedDict())
@@ -656,32 +1194,64 @@ def aggregate_results(results):
 DISPLAY_COLUMNS = ['Observable', 'PDF', 'Bin', 'CV', 'Up68', 'Down68',
                    'Remarks']
 
+def _object_array(values):
+    #np.array would try to iterate over some of the objects
+    result = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        result[i] = value
+    return result
+
 def results_table(results):
-    records = pd.concat([pd.DataFrame(OrderedDict([
-                ('Observable'       , result.obs),
-                ('PDF'              , result.pdf),
-                ('Collaboration'    , result.pdf.collaboration),
-                ('as_from_name'     , result.pdf.as_from_name),
-                ('alpha_sMref'      , result.pdf.AlphaS_MZ),
-                ('PDF_OrderQCD'     , result.pdf.oqcd_str),
-                ('NumFlavors'       , result.pdf.NumFlavors),
-                ('Bin'              , np.arange(1, result.nbins + 1)),
-                ('CV'               , result.central_value),
-                ('Up68'             , np.abs(result.errorbar68['max'])),
-                ('Down68'           , np.abs(result.errorbar68['min'])),
-                ('Remarks'          , None),
-                ('Result'           , result),
-               ])) for result in results],
-               ignore_index=True)
-    #Must be an independent list for each record
-    records['Remarks'] = records.apply(lambda x: [], axis=1)
+    """Return a `DataFrame` with a row for each bin of each result. The
+    uncertainties are computed for all the results of each PDF at once
+    (see ``ResultSet``)."""
+    results = list(results)
+    stats = {}
+    for result_set in result_sets(results).values():
+        cv = result_set.stacked._values[:, 0]
+        errorbar = result_set.stacked.errorbar68
+        up = np.abs(errorbar['max'].values)
+        down = np.abs(errorbar['min'].values)
+        for i, result in enumerate(result_set):
+            s = result_set.slice(i)
+            stats[id(result)] = cv[s], up[s], down[s]
+    nbins = [result.nbins for result in results]
+    def per_result(f, dtype=None):
+        values = [f(result) for result in results]
+        if dtype is object:
+            values = _object_array(values)
+        return np.repeat(np.asarray(values, dtype=dtype), nbins)
+    def stat(i):
+        return np.concatenate([stats[id(result)][i] for result in results])
+
+    records = pd.DataFrame(OrderedDict([
+                ('Observable'       , per_result(lambda r: r.obs, object)),
+                ('PDF'              , per_result(lambda r: r.pdf, object)),
+                ('Collaboration'    , per_result(lambda r: r.pdf.collaboration)),
+                ('as_from_name'     , per_result(lambda r: r.pdf.as_from_name)),
+                ('alpha_sMref'      , per_result(lambda r: r.pdf.AlphaS_MZ)),
+                ('PDF_OrderQCD'     , per_result(lambda r: r.pdf.oqcd_str)),
+                ('NumFlavors'       , per_result(lambda r: r.pdf.NumFlavors)),
+                ('Bin'              , np.concatenate([np.arange(1, n + 1)
+                                                      for n in nbins])),
+                ('CV'               , stat(0)),
+                ('Up68'             , stat(1)),
+                ('Down68'           , stat(2)),
+                #Must be an independent list for each record
+                ('Remarks'          , [[] for _ in range(sum(nbins))]),
+                ('Result'           , per_result(lambda r: r, object)),
+               ]))
     return records
 
 def summed_results_table(results):
 
     if isinstance(results, pd.DataFrame):
         results = results['Result'].unique()
-    table = results_table([result.sumbins() for result in results])
+    sums = {}
+    for result_set in result_sets(results).values():
+        for result, summed in zip(result_set, result_set.sumbins()):
+            sums[id(result)] = summed
+    table = results_table([sums[id(result)] for result in results])
     table['Bin'] = 'sum'
     return table
 
@@ -695,6 +1265,95 @@ def make_result(obs, pdf, datas):
     error_type = pdf.ErrorType
     return RESULT_TYPES[error_type](obs, pdf, datas)
 
+class ScaleVariationResult(object):
+    """The results of an observable for a PDF set at several choices of the
+    renormalization and factorization scales. ``results`` maps each
+    ``(Kr, Kf)`` pair to the corresponding ``Result``."""
+    def __init__(self, obs, pdf, results):
+        self.obs = obs
+        self.pdf = pdf
+        self.results = OrderedDict(results)
+
+    @property
+    def scales(self):
+        return list(self.results.keys())
+
+    def __getitem__(self, scale):
+        return self.results[tuple(scale)]
+
+    def __iter__(self):
+        return iter(self.results.items())
+
+    @property
+    def central(self):
+        """The result at the central scale, ``(1, 1)``."""
+        return self[(1, 1)]
+
+    @property
+    def central_values(self):
+        """DataFrame with the central value of each bin (rows) for each
+        scale (columns)."""
+        return pd.DataFrame(OrderedDict((scale, result.central_value) for
+                                        scale, result in self))
+
+    @property
+    def envelope(self):
+        """Return a DataFrame with the minimum and maximum central value
+        of each bin over all scales."""
+        cvs = self.central_values
+        return pd.DataFrame({'min': cvs.min(axis=1), 'max': cvs.max(axis=1)})
+
+def make_scale_variation(pdf, observable, scales=DEFAULT_SCALE_VARIATIONS):
+    """Compute all the members of ``pdf`` for ``observable`` at each of the
+    ``(Kr, Kf)`` pairs in ``scales`` and return a
+    ``ScaleVariationResult``."""
+    logging.info("Computing %d scale variations of %s with %s" %
+                 (len(scales), observable, pdf))
+    values = observable.convolute_scales(pdf, scales)
+    results = ((tuple(scale), make_result(observable, pdf,
+                                          OrderedDict(zip(pdf.reps, vals))))
+               for scale, vals in zip(scales, values))
+    return ScaleVariationResult(observable, pdf, results)
+
+def produce_scale_variations(pdfsets, observables,
+                             scales=DEFAULT_SCALE_VARIATIONS, nthreads=None):
+    """Return a list of ``ScaleVariationResult`` for each pair of PDF
+    set and APPLgrid observable. The pairs are computed concurrently
+    in ``nthreads`` threads (one per CPU by default)."""
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    applgrids = [obs for obs in observables if
+                 isinstance(obs, APPLGridObservable)]
+    to_compute = [(pdf, obs) for pdf in pdfsets for obs in applgrids]
+    if not to_compute:
+        return []
+    compute = functools.partial(make_scale_variation, scales=scales)
+    executor = concurrent.futures.ThreadPoolExecutor(
+                   max_workers=min(nthreads, len(to_compute)))
+    with executor:
+        return list(executor.map(compute, *zip(*to_compute)))
+
+def scale_variations_table(svresults):
+    """Table with the central value and PDF uncertainty of each bin at each
+    scale, and the scale envelope."""
+    records = []
+    for svresult in svresults:
+        envelope = svresult.envelope
+        for (Kr, Kf), result in svresult:
+            records.append(pd.DataFrame(OrderedDict([
+                ('Observable'       , svresult.obs),
+                ('PDF'              , svresult.pdf),
+                ('Bin'              , np.arange(1, result.nbins + 1)),
+                ('Kr'               , Kr),
+                ('Kf'               , Kf),
+                ('CV'               , result.central_value),
+                ('Up68'             , np.abs(result.errorbar68['max'])),
+                ('Down68'           , np.abs(result.errorbar68['min'])),
+                ('ScaleMin'         , envelope['min']),
+                ('ScaleMax'         , envelope['max']),
+                ])))
+    return pd.concat(records, ignore_index=True)
+
 def make_pdf_results(pdf, Q, flavors=None, xgrid=None):
     """Return a Result object containig the value of the pdfs a function of
     x for the specified Q and flavors given by their PDG id (all by default)."""
@@ -730,36 +1389,66 @@ def make_observable(name, *args, **kwargs):
 
 
 
-def convolve_one(pdf, observable, logger=None):
-    import applwrap
+def convolve_one(pdf, observable, logger=None,
+                 engine=DEFAULT_CONVOLUTION_ENGINE):
     from smpdflib.core import PDF, APPLGridObservable #analysis:ignore
-    res = {}
     import os
     logging.debug("Convolving in PID: %d" % os.getpid())
     logging.info("Convolving %s with %s" % (observable, pdf))
-    with pdf, observable:
-        for rep in pdf.reps:
-            applwrap.pdfreplica(rep)
-            res[rep] = np.array(applwrap.convolute(observable.order))
+    if engine == 'weights':
+        values = fastconv.convolute(observable, pdf)
+    elif engine == 'applgrid':
+        values = np.concatenate([observable.convolute(pdf, chunk) for chunk
+                                 in pdf.iter_member_chunks()])
+    else:
+        raise ValueError("Unknown convolution engine '%s'. Valid ones are: %s"
+                         % (engine, CONVOLUTION_ENGINES))
+    logging.debug("PDF node table lookups (served, missed): %d, %d" %
+                  applwrap.nodetable_stats())
+    res = OrderedDict(zip(pdf.reps, values))
     return res
 
 
+def _convolute_members(observable, pdf, members, engine):
+    if engine == 'weights':
+        return fastconv.convolute(observable, pdf, members)
+    elif engine == 'applgrid':
+        return observable.convolute(pdf, members)
+    raise ValueError("Unknown convolution engine '%s'. Valid ones are: %s"
+                     % (engine, CONVOLUTION_ENGINES))
+
+def convolve_members(pdf, observable, members, key, digests, db,
+                     engine=DEFAULT_CONVOLUTION_ENGINE):
+    """Convolve the ``members`` of ``pdf`` with ``observable``, chunk by
+    chunk, storing each chunk in ``db`` under ``key`` as soon as it is
+    computed, together with the ``digests`` of the files of the members.
+    Return the values of all the members of ``pdf``, read from ``db``."""
+    import os
+    logging.debug("Convolving in PID: %d" % os.getpid())
+    if len(members):
+        logging.info("Convolving %s with %d members of %s" %
+                     (observable, len(members), pdf))
+        for chunk in pdf.iter_member_chunks(members=members):
+            values = _convolute_members(observable, pdf, chunk, engine)
+            db.store_members(key, chunk.tolist(), values,
+                             [digests[m] for m in chunk])
+    reps = list(pdf.reps)
+    return OrderedDict(zip(reps, db.load_members(key, reps)))
+
+
 def make_convolution(pdf, observables):
     datas = defaultdict(lambda:OrderedDict())
     if not observables:
         return {}
 
-    with(pdf):
-        for obs in observables:
-            with obs:
-                for rep in pdf.reps:
-                    sys.stdout.write('\r-> Computing replica %d of %s' %
-                                     (rep, pdf))
-                    sys.stdout.flush()
-                    applwrap.pdfreplica(rep)
-                    res = applwrap.convolute(obs.order)
-                    datas[obs][rep] = np.array(res)
-        sys.stdout.write('\n')
+    for obs in observables:
+        sys.stdout.write('\r-> Computing %s with all members of %s' %
+                         (obs, pdf))
+        sys.stdout.flush()
+        values = np.concatenate([obs.convolute(pdf, chunk) for chunk in
+                                 pdf.iter_member_chunks()])
+        datas[obs] = OrderedDict(zip(pdf.reps, values))
+    sys.stdout.write('\n')
     return datas
 
 #TODO: Merge this with results_table
@@ -770,37 +1459,102 @@ def results_from_datas(dataset):
         results += [make_result(obs, pdf, data[obs]) for obs in data]
     return results
 
-def get_dataset(pdfsets, observables, db=None):
-    def make_key(pdf, obs):
-        return str((pdf.get_key(), obs.get_key()))
+def result_key(pdf, obs):
+    """Key of the convolution of ``pdf`` and ``obs`` in the ``db``."""
+    return str((pdf.get_key(), obs.get_key()))
+
+def member_key(pdf, obs):
+    """Key of the results of each member of ``pdf`` with ``obs`` in the
+    ``db``, identifying the grid by its content."""
+    return str((pdf.get_key(), obs.sha1hash.hex(), obs.order))
+
+def stored_keys(db, pdfsets, observables):
+    """Return the set of keys of the (pdf, observable) pairs that are in
+    ``db``. ``ResultStore`` answers this with a few queries; other mappings
+    (such as ``shelve`` files) are queried key by key."""
+    if db is None:
+        return set()
+    keys = [result_key(pdf, obs) for pdf in pdfsets for obs in observables]
+    if hasattr(db, 'existing'):
+        return db.existing(keys)
+    return {key for key in keys if key in db}
+
+def _plan_dataset(pdfsets, observables, db):
+    """Return ``(dataset, to_compute)``, where ``dataset`` has the results
+    complete in ``db`` and ``to_compute`` lists the remaining
+    ``(pdf, obs)`` pairs. If ``db`` stores results by member, the pairs are
+    ``(pdf, obs, members, key, digests)``, with only the members that are
+    not stored for the current version of their files."""
     dataset = OrderedDict()
+    to_compute = []
+    stored = stored_keys(db, pdfsets, observables)
     for pdf in pdfsets:
-        #bool(db) == False if empty
-        if db is not None:
-            res = {}
-            obs_to_compute = []
-            for obs in observables:
-                key = make_key(pdf, obs)
-                if key in db:
-                    res[obs] = db[key]
-                else:
-                    obs_to_compute.append(obs)
-
-            computed_data = make_convolution(pdf, obs_to_compute)
-            for newobs in computed_data:
-                key = make_key(pdf, newobs)
-                db[key] = computed_data[newobs]
-            res.update(computed_data)
-
-
-        else:
-            res = make_convolution(pdf, observables)
-
-        dataset[pdf] = res
+        dataset[pdf] = OrderedDict()
+        for obs in observables:
+            key = result_key(pdf, obs)
+            if key in stored:
+                data = db[key]
+                #Sets can be extended
+                if len(data) == len(pdf.reps):
+                    dataset[pdf][obs] = data
+                    continue
+            to_compute.append((pdf, obs))
+    if not to_compute or not hasattr(db, 'stored_members'):
+        return dataset, to_compute
+    digests = {}
+    for pdf, _ in to_compute:
+        if pdf not in digests:
+            digests[pdf] = dict(zip(pdf.reps, pdf.member_digests()))
+    keys = [member_key(pdf, obs) for pdf, obs in to_compute]
+    stored_members = db.stored_members(keys)
+    plan = []
+    for (pdf, obs), key in zip(to_compute, keys):
+        done = stored_members[key]
+        members = [m for m, digest in digests[pdf].items()
+                   if done.get(m) != digest]
+        plan.append((pdf, obs, members, key, digests[pdf]))
+    return dataset, plan
+
+def get_dataset(pdfsets, observables, db=None, nthreads=1,
+                engine=DEFAULT_CONVOLUTION_ENGINE):
+    """Convolve a set of pdf with a set of observables in this process.
+    If ``nthreads`` is greater than one, the (pdf, observable) pairs are
+    convolved concurrently by a ``concurrent.futures.ThreadPoolExecutor``.
+    The threads share the grids and PDF members loaded in memory (the
+    convolutions run without the GIL). Note that APPLgrid (and in
+    particular grids made with AMCFast) can misbehave when several grids
+    are used in the same process, so ``get_dataset_parallel`` is the
+    default in ``convolve_or_load``. If ``db`` stores results by member
+    (``resultstore.ResultStore``), only the missing members are convolved
+    and each chunk is stored by the worker as soon as it is computed. Other
+    ``db`` (such as ``shelve`` files) are only written from the calling
+    thread. ``engine`` is one of ``CONVOLUTION_ENGINES``."""
+    dataset, to_compute = _plan_dataset(pdfsets, observables, db)
+    by_member = hasattr(db, 'stored_members')
+    if by_member:
+        convolve = functools.partial(convolve_members, db=db, engine=engine)
+    else:
+        convolve = functools.partial(convolve_one, engine=engine)
+    if nthreads > 1 and len(to_compute) > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(
+                       max_workers=min(nthreads, len(to_compute)))
+        with executor:
+            results = list(executor.map(convolve, *zip(*to_compute)))
+    else:
+        results = (convolve(*task) for task in to_compute)
+
+    for (task, result) in zip(to_compute, results):
+        pdf, obs = task[:2]
+        dataset[pdf][obs] = result
+        if db is not None and not by_member:
+            key = result_key(pdf, obs)
+            logging.debug("Appending result for %s to db" % key)
+            db[key] = result
     return dataset
 
 
-def get_dataset_parallel(pdfsets, observables, db=None):
+def get_dataset_parallel(pdfsets, observables, db=None,
+                         engine=DEFAULT_CONVOLUTION_ENGINE):
     """Convolve a set of pdf with a set of observables. Note that to get rid of
     issues arising from applgrid poor design, the multiprocessing start method
     must be 'spawn', ie:
@@ -810,24 +1564,16 @@ def get_dataset_parallel(pdfsets, observables, db=None):
         multiprocessing.set_start_method('spawn')
 
     Only once at the beginning of the program. This only works in Python 3.4+.
+    As in ``get_dataset``, a ``db`` that stores results by member is written
+    by the workers, chunk by chunk.
     """
-    def make_key(pdf, obs):
-        return str((pdf.get_key(), obs.get_key()))
     n_cores = multiprocessing.cpu_count()
-    dataset = OrderedDict()
-    to_compute =  []
-    for pdf in pdfsets:
-        dataset[pdf] = OrderedDict()
-        for obs in observables:
-            if db is not None:
-                key = make_key(pdf, obs)
-                if key in db:
-                    dataset[pdf][obs] = db[key]
-                else:
-                    to_compute.append((pdf, obs))
-            else:
-                to_compute.append((pdf, obs))
-
+    dataset, to_compute = _plan_dataset(pdfsets, observables, db)
+    by_member = hasattr(db, 'stored_members')
+    if by_member:
+        convolve = functools.partial(convolve_members, db=db, engine=engine)
+    else:
+        convolve = functools.partial(convolve_one, engine=engine)
 
     nprocesses = min((n_cores, len(to_compute)))
     if nprocesses:
@@ -838,24 +1584,39 @@ def get_dataset_parallel(pdfsets, observables, db=None):
                                     maxtasksperchild=1,
                                     initializer=initlogging,
                                     initargs=(q, loglevel))
-        results = pool.starmap(convolve_one, to_compute, chunksize=1)
+        results = pool.starmap(convolve, to_compute, chunksize=1)
         pool.close()
-        for ((pdf, obs), result) in zip(to_compute, results):
+        for (task, result) in zip(to_compute, results):
+            pdf, obs = task[:2]
             dataset[pdf][obs] = result
-            if db is not None:
-                key = make_key(pdf, obs)
+            if db is not None and not by_member:
+                key = result_key(pdf, obs)
                 logging.debug("Appending result for %s to db" % key)
                 db[key] = result
 
     return dataset
 
 
-def convolve_or_load(pdfsets, observables, db=None):
-    #results = []
-    results = results_from_datas(get_dataset_parallel(pdfsets, observables, db))
-    return results
+def convolve_or_load(pdfsets, observables, db=None,
+                     engine=DEFAULT_CONVOLUTION_ENGINE,
+                     backend=DEFAULT_CONVOLUTION_BACKEND):
+    """Return the results of the convolutions, computed with ``backend``
+    (one of ``CONVOLUTION_BACKENDS``) or loaded from ``db``."""
+    if backend == 'threads':
+        nthreads = multiprocessing.cpu_count()
+        dataset = get_dataset(pdfsets, observables, db, nthreads=nthreads,
+                              engine=engine)
+    elif backend == 'processes':
+        dataset = get_dataset_parallel(pdfsets, observables, db,
+                                       engine=engine)
+    else:
+        raise ValueError("Unknown convolution backend '%s'. Valid ones "
+                         "are: %s" % (backend, CONVOLUTION_BACKENDS))
+    return results_from_datas(dataset)
 
-def produce_results(pdfsets, observables, db=None):
+def produce_results(pdfsets, observables, db=None,
+                    engine=DEFAULT_CONVOLUTION_ENGINE,
+                    backend=DEFAULT_CONVOLUTION_BACKEND):
     if isinstance(pdfsets, PDF) or isinstance(pdfsets, str):
         pdfsets = [pdfsets]
     pdfsets = [PDF(pdf) if isinstance(pdf,str) else pdf for pdf in pdfsets]
@@ -869,26 +1630,40 @@ def produce_results(pdfsets, observables, db=None):
                    isinstance(obs, APPLGridObservable)]
 
 
-    results = (convolve_or_load(pdfsets, applgrids, db) +
+    results = (convolve_or_load(pdfsets, applgrids, db, engine, backend) +
                [pred.to_result(pdfset)
                 for pdfset in pdfsets for pred in predictions])
     return results
 
 def test_as_linearity(summed_table, diff_from_line = 0.25):
-    group_by = ('Observable','NumFlavors', 'PDF_OrderQCD', 'Collaboration')
-    for (process, nf, oqcd, col), curve_df in summed_table.groupby(group_by,
-                                                                   sort=False):
-        if len(curve_df) <= 2:
-            continue
-        fit = ols.OLS(y=curve_df['CV'], x=curve_df['alpha_sMref'],
-                      weights=1/curve_df['CV']**2)
-
-        diff = (fit.y_predict - curve_df['CV'])/curve_df['Up68']
-        bad = diff > diff_from_line
-        for ind in curve_df[bad].index:
-                remark = (u"Point away from linear fit by %1.1fσ" %
-                                diff.ix[ind])
-                summed_table.loc[ind,'Remarks'].append(remark)
+    """Fit the central values of each group of (Observable, NumFlavors,
+    PDF_OrderQCD, Collaboration) in ``summed_table`` to a straight line in
+    alpha_s, weighting each point by 1/CV**2, and add a remark to the
+    points that are above the line by more than ``diff_from_line`` times
+    their error. All the weighted least squares fits are solved at once
+    with the closed form expressions."""
+    group_by = ['Observable','NumFlavors', 'PDF_OrderQCD', 'Collaboration']
+    if not len(summed_table):
+        return
+    groups = summed_table.groupby(group_by, sort=False).ngroup().values
+    y = summed_table['CV'].values.astype(float)
+    x = summed_table['alpha_sMref'].values.astype(float)
+    w = 1/y**2
+
+    ngroups = groups.max() + 1
+    def wsum(values):
+        return np.bincount(groups, weights=w*values, minlength=ngroups)
+    W, Sx, Sy = wsum(1), wsum(x), wsum(y)
+    Sxx, Sxy = wsum(x*x), wsum(x*y)
+    counts = np.bincount(groups, minlength=ngroups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (W*Sxy - Sx*Sy)/(W*Sxx - Sx*Sx)
+        intercept = (Sy - slope*Sx)/W
+        y_predict = intercept[groups] + slope[groups]*x
+        diff = (y_predict - y)/summed_table['Up68'].values
+    bad = (counts[groups] > 2) & (diff > diff_from_line)
+    for remarks, d in zip(summed_table['Remarks'].values[bad], diff[bad]):
+        remarks.append(u"Point away from linear fit by %1.1fσ" % d)
 
 
 
@@ -902,6 +1677,56 @@ def match_spec(corrlist, smpdf_spec):
     return result
 
 
+def group_scales(Qs, rtol=DEFAULT_Q_RTOL):
+    """Group the energy scales ``Qs`` that differ by less than ``rtol``
+    (relative to the smallest scale of the group). Return ``(unique, index)``
+    where ``unique`` is a sorted array of representative scales and
+    ``index[i]`` is the position in ``unique`` corresponding to ``Qs[i]``."""
+    Qs = np.asarray(Qs, dtype=np.float64)
+    index = np.empty(len(Qs), dtype=int)
+    unique = []
+    for i in np.argsort(Qs, kind='mergesort'):
+        if not unique or Qs[i] > unique[-1]*(1 + rtol):
+            unique.append(Qs[i])
+        index[i] = len(unique) - 1
+    return np.array(unique), index
+
+def get_X_multiQ(pdf, Qs, xgrid=None, fl=None, rtol=DEFAULT_Q_RTOL):
+    """Compute the PDF matrices for all the scales in ``Qs`` in one
+    evaluation sweep. Scales closer than ``rtol`` are only evaluated once.
+    Return ``(X, index)``, where ``X`` has shape ``(nQ, nrep, nfl*nx)``
+    with one entry per distinct scale, and ``X[index[i]].T`` is equivalent
+    to ``get_X(pdf, Qs[i], reshape=True)``."""
+    unique, index = group_scales(Qs, rtol=rtol)
+    logging.debug("Building PDF matrices at %d distinct scales "
+                  "(from %d requested)" % (len(unique), len(index)))
+    mean, replicas = pdf.grid_values_multiQ(unique, xgrid, fl)
+    X = replicas - mean[:, np.newaxis]
+    X = X.reshape(X.shape[0], X.shape[1], X.shape[2]*X.shape[3])
+    return X, index
+
+def iter_X_multiQ(pdf, Qs, xgrid=None, fl=None, rtol=DEFAULT_Q_RTOL,
+                  chunksize=DEFAULT_Q_CHUNKSIZE):
+    """Yield the PDF matrix at each of the scales ``Qs``, in order, as
+    returned by ``get_X(pdf, Q, reshape=True)``. Each distinct scale (up to
+    ``rtol``) is evaluated once, with ``get_X_multiQ`` on ``chunksize`` of
+    them at a time in the order they are first needed, and its matrix is
+    dropped after its last use."""
+    unique, index = group_scales(Qs, rtol=rtol)
+    last_use = {i: n for n, i in enumerate(index)}
+    first_use = list(OrderedDict.fromkeys(index))
+    computed = {}
+    nevaluated = 0
+    for n, i in enumerate(index):
+        if i not in computed:
+            chunk = first_use[nevaluated:nevaluated+chunksize]
+            nevaluated += len(chunk)
+            X, _ = get_X_multiQ(pdf, unique[chunk], xgrid, fl, rtol=0)
+            computed.update(zip(chunk, X))
+        yield computed[i].T
+        if last_use[i] == n:
+            del computed[i]
+
 def get_X(pdf, Q=None,  reshape=False, xgrid=None, fl=None):
     # Step 1: create pdf covmat
     if Q is None:
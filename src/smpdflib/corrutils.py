@@ -7,6 +7,8 @@ Created on Thu Sep 17 10:27:38 2015
 import numpy as np
 
 DEFAULT_CORRELATION_THRESHOLD = 0.9
+#Rows of the observable correlation matrix computed at once
+DEFAULT_CORRELATION_BLOCKSIZE = 512
 
 
 def corrcoeff(prediction, pdf_val):
@@ -29,39 +31,116 @@ def bin_corrs_from_X(bin_val, X,
     threshold = np.max(np.abs(cc))*correlation_threshold
     return cc, threshold
 
-def observable_correlations(results_table, base_pdf=None):
+def standardize(M, dtype=np.float64):
+    """Return the rows of ``M`` centred and scaled to unit norm, so that
+    ``Z.dot(Z.T)`` is their correlation matrix. Constant rows become nan, as
+    in ``np.corrcoef``."""
+    Z = np.array(M, dtype=dtype)
+    Z -= Z.mean(axis=1)[:, np.newaxis]
+    norm = np.sqrt(np.einsum('ij,ij->i', Z, Z))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Z /= norm[:, np.newaxis]
+    return Z
+
+def correlation_blocks(Z, base=None,
+                       blocksize=DEFAULT_CORRELATION_BLOCKSIZE):
+    """Yield ``(start, block)`` where ``block`` are the rows from ``start``
+    of the correlation matrix of the standardized ``Z``, minus that of
+    ``base`` if given. Only one block of shape ``(blocksize, len(Z))`` is
+    computed at a time."""
+    for start in range(0, len(Z), blocksize):
+        block = Z[start:start+blocksize].dot(Z.T)
+        np.clip(block, -1, 1, out=block)
+        if base is not None:
+            block -= np.clip(base[start:start+blocksize].dot(base.T), -1, 1)
+        yield start, block
+
+def correlation_matrix(blocks, n, dtype=np.float64, out=None):
+    """Assemble the ``(n, n)`` matrix from ``blocks``, into ``out`` if
+    given (e.g. a memory mapped array)."""
+    if out is None:
+        out = np.empty((n, n), dtype=dtype)
+    for start, block in blocks:
+        out[start:start+len(block)] = block
+    return out
+
+def top_correlations(blocks, k=None, threshold=None):
+    """For each bin, select the ``k`` largest correlations in absolute value
+    with the other bins and/or those with absolute value above
+    ``threshold``. Return arrays ``(rows, columns, values)`` ordered by row
+    and then by decreasing absolute value."""
+    if k is None and threshold is None:
+        raise ValueError("Either k or threshold is required")
+    if k is not None and k < 1:
+        raise ValueError("k must be positive")
+    rows, columns, values = [], [], []
+    for start, block in blocks:
+        nrows, ncols = block.shape
+        local = np.arange(nrows)
+        absblock = np.abs(block)
+        #Exclude the bin itself and undefined correlations
+        absblock[local, start + local] = -1
+        absblock[np.isnan(absblock)] = -1
+        if k is not None and k < ncols:
+            cols = np.argpartition(-absblock, k-1, axis=1)[:, :k]
+        else:
+            cols = np.tile(np.arange(ncols), (nrows, 1))
+        selected = absblock[local[:, np.newaxis], cols]
+        order = np.argsort(-selected, axis=1, kind='mergesort')
+        cols = cols[local[:, np.newaxis], order]
+        selected = selected[local[:, np.newaxis], order]
+        mask = selected >= 0
+        if threshold is not None:
+            mask &= selected >= threshold
+        blockrows = np.broadcast_to((start + local)[:, np.newaxis],
+                                    cols.shape)
+        rows.append(blockrows[mask])
+        columns.append(cols[mask])
+        values.append(block[local[:, np.newaxis], cols][mask])
+    if not rows:
+        return (np.empty(0, dtype=int), np.empty(0, dtype=int),
+                np.empty(0))
+    return np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+def _make_labels(results):
+    for result in results:
+        obs = result.obs
+        obslabel = str(obs)
+        if len(obslabel) > 10:
+            obslabel = obslabel[:10] + '...'
+        if result.nbins == 1:
+            yield obslabel
+        else:
+            for b in range(result.nbins):
+                yield "%s (Bin %d)" % (obslabel, b+1)
 
+def observable_correlation_blocks(results_table, base_pdf=None,
+                                  dtype=np.float64,
+                                  blocksize=DEFAULT_CORRELATION_BLOCKSIZE):
+    """Yield ``(title, labels, blocks)`` for each PDF in ``results_table``
+    (except ``base_pdf``), where ``blocks`` is a ``correlation_blocks``
+    generator over all the bins. The replicas are standardized once, in
+    ``dtype``."""
+    from smpdflib.core import ResultSet
+
+    base = None
     if base_pdf is not None:
         base_results = results_table[results_table.PDF == base_pdf].Result.unique()
-        M = np.concatenate([result._all_vals.as_matrix() for
-                            result in base_results])
-        base_corr = np.corrcoef(M)
-
+        base = standardize(ResultSet(base_results).values[:, 1:], dtype)
 
     for pdf, pdf_table in results_table.groupby('PDF', sort=False):
         if base_pdf == pdf:
             continue
         results = pdf_table.Result.unique()
-        M = np.concatenate([result._all_vals.as_matrix() for result in results])
-        #Without atleast_2d would return a scalar if M has only one element.
-        corrmat = np.atleast_2d(np.corrcoef(M))
+        Z = standardize(ResultSet(results).values[:, 1:], dtype)
         title = "Observables correlation\n%s" % pdf
         if base_pdf:
-            corrmat -= base_corr
             title += "-%s" % base_pdf
+        labels = list(_make_labels(results))
+        yield title, labels, correlation_blocks(Z, base, blocksize)
 
-
-        def make_labels(results):
-            for result in results:
-                obs = result.obs
-                obslabel = str(obs)
-                if len(obslabel) > 10:
-                    obslabel = obslabel[:10] + '...'
-                if result.nbins == 1:
-                    yield obslabel
-                else:
-                    for b in range(result.nbins):
-                        yield "%s (Bin %d)" % (obslabel, b+1)
-
-        labels = list(make_labels(results))
-        yield title, corrmat, labels
\ No newline at end of file
+def observable_correlations(results_table, base_pdf=None):
+    for title, labels, blocks in observable_correlation_blocks(results_table,
+                                                               base_pdf):
+        corrmat = correlation_matrix(blocks, len(labels))
+        yield title, corrmat, labels
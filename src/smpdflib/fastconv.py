@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Convolution engine based on the weights exported from APPLgrids.
+
+The APPLgrid convolution is bilinear in the PDFs. Once the weights of a grid
+are exported (see ``applwrap.GridHandle.export_weights``), the predictions
+for all the members of a PDF set are obtained as a few batched tensor
+contractions against the values of the PDFs at the interpolation nodes,
+instead of one APPLgrid convolution per member.
+
+The exported weights are stored in ``get_cache_dir('applgrid_weights')``,
+keyed by the hash of the grid, so they are computed only once.
+
+The normalization of each bin (the bin width and the number of runs of the
+grid) is exported together with the weights, and the strong coupling is
+that of the central member, as in APPLgrid. The APPLgrid convolution
+(``APPLGridObservable.convolute``) is kept as the reference: every
+(grid, PDF) pair is validated on a few members before it is trusted. Grids
+that cannot be exported or that fail the validation are convolved with the
+reference backend.
+"""
+import os.path as osp
+import logging
+import threading
+
+import numpy as np
+import fastcache
+
+from smpdflib.utils import get_cache_dir, save_npz_atomic
+
+#APPLgrid flavour ordering: tbar, ..., g, ..., t
+FLAVOURS = np.arange(-6, 7, dtype=np.intc)
+
+#Number of members contracted at once.
+DEFAULT_CHUNKSIZE = 50
+
+#Relative tolerance of the validation against the reference backend.
+DEFAULT_RTOL = 1e-6
+
+#Arrays that older versions did not export.
+_REQUIRED = ('bin_width', 'run', 'normalised')
+
+#Singular values of the luminosity matrices below this (relative to the
+#largest) are dropped.
+_LUMI_EPS = 1e-12
+
+class WeightsError(Exception):
+    """Raised when the weights of a grid cannot reproduce the reference
+    convolution."""
+    pass
+
+def weights_filename(obs):
+    """Path of the cached weights of the observable ``obs``."""
+    return osp.join(get_cache_dir('applgrid_weights'),
+                    '%s_%d.npz' % (obs.sha1hash.hex(), obs.order))
+
+def _factorize_lumi(lumi):
+    """Write each luminosity matrix as a sum of outer products, so that each
+    PDF is contracted with a few flavour combinations only. Return a list
+    with a pair of ``(rank, 13)`` arrays for each subprocess."""
+    result = []
+    for L in lumi:
+        u, s, vt = np.linalg.svd(L)
+        if not s[0]:
+            result.append((np.empty((0, len(FLAVOURS))),)*2)
+            continue
+        keep = s > _LUMI_EPS*s[0]
+        result.append(((u[:, keep]*s[keep]).T, vt[keep]))
+    return result
+
+class _Block(object):
+    """Weights of one order of one bin, as a dense tensor of shape
+    ``(nsub, nQ, nx1, nx2)`` restricted to the nodes with nonzero weights
+    and to the active subprocesses ``subs``."""
+    __slots__ = ('bin', 'power', 'Q', 'x1', 'x2', 'subs', 'W')
+
+    def __init__(self, arrays, k):
+        def sl(name, offset):
+            o = arrays[offset]
+            return arrays[name][o[k]:o[k+1]]
+        Q, x1, x2 = sl('Q', 'tau_offset'), sl('x1', 'x1_offset'), sl('x2',
+                                                                 'x2_offset')
+        fun1, fun2 = sl('fun1', 'x1_offset'), sl('fun2', 'x2_offset')
+        sub, t, i, j, val = (sl(name, 'w_offset') for name in
+                             ('w_sub', 'w_tau', 'w_x1', 'w_x2', 'w_val'))
+
+        t0, i0, j0 = t.min(), i.min(), j.min()
+        t1, i1, j1 = t.max() + 1, i.max() + 1, j.max() + 1
+        self.bin = int(arrays['block_bin'][k])
+        self.power = int(arrays['block_power'][k])
+        self.Q, self.x1, self.x2 = Q[t0:t1], x1[i0:i1], x2[j0:j1]
+        self.subs = np.unique(sub)
+        W = np.zeros((len(self.subs), t1 - t0, i1 - i0, j1 - j0))
+        W[np.searchsorted(self.subs, sub), t - t0, i - i0, j - j0] = val
+        W *= fun1[i0:i1, np.newaxis]*fun2[np.newaxis, j0:j1]
+        self.W = W
+
+class GridWeights(object):
+    """The weights of an APPLgrid at a given perturbative order, as returned
+    by ``applwrap.GridHandle.export_weights``."""
+    def __init__(self, arrays):
+        self.nbins = int(arrays['nbins'])
+        self.lumi = _factorize_lumi(arrays['lumi'])
+        #As in appl::grid::vconvolute
+        run = float(arrays['run'])
+        invruns = 1/run if run and not arrays['normalised'] else 1
+        self.norm = invruns/np.asarray(arrays['bin_width'], dtype=float)
+        w_offset = arrays['w_offset']
+        self.blocks = [_Block(arrays, k) for k in range(len(w_offset) - 1)
+                       if w_offset[k+1] > w_offset[k]]
+
+    def convolute(self, pdf, members, chunksize=DEFAULT_CHUNKSIZE):
+        """Compute the predictions for the ``members`` of ``pdf``. Return an
+        array of shape ``(len(members), nbins)``."""
+        members = np.asarray(members, dtype=np.intc)
+        result = np.zeros((len(members), self.nbins))
+        for start in range(0, len(members), chunksize):
+            chunk = members[start:start+chunksize]
+            result[start:start+chunksize] = self._convolute_chunk(pdf, chunk)
+        return result*self.norm
+
+    def _convolute_chunk(self, pdf, chunk):
+        result = np.zeros((len(chunk), self.nbins))
+        #Blocks of different bins and orders often share nodes.
+        xfx_cache = {}
+        as_cache = {}
+        def xfx(x, Q):
+            key = (x.tobytes(), Q.tobytes())
+            if key not in xfx_cache:
+                xfx_cache[key] = pdf.xfxQ_multigrid(chunk, FLAVOURS, x, Q)
+            return xfx_cache[key]
+        def alphas(Q):
+            #APPLgrid uses the coupling of the central member for all.
+            key = Q.tobytes()
+            if key not in as_cache:
+                as_cache[key] = pdf.handle.alphasQ([0], Q)[0]/(2*np.pi)
+            return as_cache[key]
+
+        for block in self.blocks:
+            #Shape (nQ, nmem, nfl, nx)
+            F1, F2 = xfx(block.x1, block.Q), xfx(block.x2, block.Q)
+            acc = np.zeros((len(block.Q), len(chunk)))
+            for W, s in zip(block.W, block.subs):
+                u, v = self.lumi[s]
+                if not len(u):
+                    continue
+                A = np.einsum('ra,tmai->rtmi', u, F1)
+                B = np.einsum('rb,tmbj->rtmj', v, F2)
+                acc += np.einsum('rtmj,rtmj->tm', np.matmul(A, W), B)
+            result[:, block.bin] += np.sum(acc.T*alphas(block.Q)**block.power,
+                                           axis=1)
+        return result
+
+@fastcache.lru_cache(maxsize=32)
+def load_weights(obs):
+    """Return the ``GridWeights`` of the APPLgrid observable ``obs``, reading
+    them from the disk cache or exporting them from the grid (and caching
+    them) the first time. Raises ``NotImplementedError`` if the grid
+    cannot be exported."""
+    filename = weights_filename(obs)
+    arrays = None
+    if osp.exists(filename):
+        logging.debug("Reading weights of %s from %s" % (obs, filename))
+        with np.load(filename) as f:
+            arrays = dict(f)
+        if any(name not in arrays for name in _REQUIRED):
+            arrays = None
+    if arrays is None:
+        logging.debug("Exporting weights of %s" % obs)
+        arrays = obs.handle.export_weights(obs.order)
+        save_npz_atomic(filename, **arrays)
+    return GridWeights(arrays)
+
+#Whether the weights are validated for each (observable, pdf) pair.
+_validations = {}
+_validations_lock = threading.Lock()
+
+def validation_members(pdf):
+    """The members on which the weights are checked against the reference:
+    the central member and two replicas spread over the set."""
+    n = len(pdf)
+    return sorted({0, n//2, n - 1})
+
+def _validate(obs, pdf, weights, rtol):
+    """Check that ``weights`` reproduce the reference convolution for the
+    ``validation_members`` of ``pdf``."""
+    check = validation_members(pdf)
+    reference = obs.convolute(pdf, check)
+    result = weights.convolute(pdf, check)
+    for m, ref, res in zip(check, reference, result):
+        if not np.allclose(res, ref, rtol=rtol, atol=0):
+            raise WeightsError("Predictions for member %d do not match the "
+                               "reference" % m)
+
+def is_validated(obs, pdf, rtol=DEFAULT_RTOL):
+    """Return whether the weights of ``obs`` reproduce the reference
+    backend for ``pdf``."""
+    key = (obs, pdf)
+    with _validations_lock:
+        if key in _validations:
+            return _validations[key]
+    try:
+        weights = load_weights(obs)
+        _validate(obs, pdf, weights, rtol)
+        valid = True
+    except (NotImplementedError, WeightsError) as e:
+        logging.warning("Cannot use the exported weights of %s with %s: %s. "
+                        "Falling back to the APPLgrid convolution." %
+                        (obs, pdf, e))
+        valid = False
+    with _validations_lock:
+        _validations[key] = valid
+    return valid
+
+def convolute(obs, pdf, members=None, chunksize=DEFAULT_CHUNKSIZE,
+              rtol=DEFAULT_RTOL):
+    """Drop in replacement for ``obs.convolute(pdf, members)`` using the
+    exported weights of the grid. Return an array of shape
+    ``(nmembers, nbins)``."""
+    if not is_validated(obs, pdf, rtol=rtol):
+        return obs.convolute(pdf, members)
+    if members is None:
+        members = pdf.reps
+    return load_weights(obs).convolute(pdf, members, chunksize)
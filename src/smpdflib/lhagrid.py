@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+A pure NumPy reader and interpolator of LHAPDF grids in the ``lhagrid1``
+format.
+
+The members of a set are read into dense arrays, and the values of
+:math:`xf(x, Q)` are computed with the log-bicubic interpolation of LHAPDF,
+vectorized over members, flavours and x points. This does not need
+``applwrap`` (nor LHAPDF), so it can be used from any thread or process.
+
+Points outside the range of the grid are treated according to the
+``Extrapolator`` of the set, as LHAPDF does: "Continuation" (the default),
+"Nearest" (the closest point of the grid) or "Error" (raise
+``RangeError``).
+"""
+import os.path as osp
+
+import numpy as np
+import fastcache
+
+from smpdflib import lhaindex
+
+
+#PDG id LHAPDF uses for the gluon, also accepted as 0.
+GLUON = 21
+
+#Values of the ``Extrapolator`` info field that are supported, and the one
+#LHAPDF uses when the set does not specify it.
+EXTRAPOLATORS = ('continuation', 'nearest', 'error')
+DEFAULT_EXTRAPOLATOR = 'continuation'
+
+class RangeError(ValueError):
+    """A point is outside of the grid and the extrapolator doesn't allow
+    it."""
+
+def _blocks(f):
+    """Split the contents of the file ``f`` at the ``---`` separators."""
+    block = []
+    for line in f:
+        if line.startswith(b'---'):
+            yield b''.join(block)
+            block = []
+        else:
+            block.append(line)
+    if any(line.strip() for line in block):
+        yield b''.join(block)
+
+def read_member(path):
+    """Read the ``lhagrid1`` file in ``path``. Return ``(header, subgrids)``
+    where ``header`` are the bytes of the header and ``subgrids`` is a list
+    of ``(x, q, flavours, values)`` with ``values`` an array of shape
+    ``(nx, nq, nfl)``."""
+    with open(path, 'rb') as f:
+        blocks = _blocks(f)
+        header = next(blocks)
+        subgrids = []
+        for block in blocks:
+            lines = block.split(b'\n', 3)
+            if len(lines) < 4:
+                continue
+            x = np.array(lines[0].split(), dtype=float)
+            q = np.array(lines[1].split(), dtype=float)
+            flavours = np.array(lines[2].split(), dtype=int)
+            values = np.array(lines[3].split(), dtype=float)
+            subgrids.append((x, q, flavours,
+                             values.reshape(len(x), len(q), len(flavours))))
+    return header, subgrids
+
+def _hermite(t, vl, dl, vh, dh):
+    """Cubic Hermite interpolation in the unit interval, with the
+    derivatives already scaled to the interval."""
+    t2 = t*t
+    t3 = t2*t
+    return ((2*t3 - 3*t2 + 1)*vl + (t3 - 2*t2 + t)*dl +
+            (-2*t3 + 3*t2)*vh + (t3 - t2)*dh)
+
+def _extrapolate_linear(x, xl, xh, yl, yh):
+    """Extrapolate linearly in ``x`` from ``(xl, yl)`` and ``(xh, yh)``. As
+    in LHAPDF, ``log(y)`` is extrapolated instead where both values are
+    above 1e-3, to keep them positive."""
+    s = (x - xl)/(xh - xl)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logy = np.exp(np.log(yl) + s*(np.log(yh) - np.log(yl)))
+    return np.where((yl > 1e-3) & (yh > 1e-3), logy, yl + s*(yh - yl))
+
+class Subgrid(object):
+    """The values of all the members of a set in one range of Q, with shape
+    ``(nmem, nx, nq, nfl)``."""
+    def __init__(self, x, q, flavours, values):
+        self.x = x
+        self.q = q
+        self.flavours = flavours
+        self.values = values
+        self.logx = np.log(x)
+        self.logq2 = np.log(q**2)
+
+    def _slope(self, m, k, iq):
+        """Finite difference in log x between the knots ``k`` and ``k+1``."""
+        lx = self.logx
+        dlogx = (lx[k+1] - lx[k])[..., np.newaxis]
+        return (self.values[m, k+1, iq] - self.values[m, k, iq])/dlogx
+
+    def _ddlogx(self, m, i, iq):
+        """Derivative with respect to log x at the knots ``i``: the average
+        of the left and right finite differences, or the one sided
+        difference at the edges. It is computed only for the knots that are
+        used, so that the values can stay memory mapped."""
+        left = np.maximum(i - 1, 0)
+        right = np.minimum(i, len(self.logx) - 2)
+        return (self._slope(m, left, iq) + self._slope(m, right, iq))/2
+
+    def _interpolate_x(self, mem, ix, t, dlogx, iq):
+        """Interpolate in x at the Q knot ``iq``. Return an array of shape
+        ``(nmem, npoints, nfl)``."""
+        v = self.values
+        m = mem[:, np.newaxis]
+        i = ix[np.newaxis, :]
+        tt = t[np.newaxis, :, np.newaxis]
+        dx = dlogx[np.newaxis, :, np.newaxis]
+        return _hermite(tt, v[m, i, iq], self._ddlogx(m, i, iq)*dx,
+                        v[m, i+1, iq], self._ddlogx(m, i+1, iq)*dx)
+
+    def interpolate(self, members, x, Q):
+        """Return the values at the points ``x`` and the scale ``Q`` for
+        the given ``members`` and all flavours, with shape
+        ``(nmem, npoints, nfl)``. Points outside of the subgrid are
+        evaluated at the closest point in it."""
+        mem = np.asarray(members, dtype=int)
+        logx = np.clip(np.log(x), self.logx[0], self.logx[-1])
+        logq2 = np.clip(np.log(Q**2), self.logq2[0], self.logq2[-1])
+        nx, nq = len(self.logx), len(self.logq2)
+
+        ix = np.clip(np.searchsorted(self.logx, logx, side='right') - 1,
+                     0, nx - 2)
+        dlogx = self.logx[ix+1] - self.logx[ix]
+        t = (logx - self.logx[ix])/dlogx
+
+        iq = int(np.clip(np.searchsorted(self.logq2, logq2, side='right') - 1,
+                         0, nq - 2))
+        lq = self.logq2
+        dlogq = lq[iq+1] - lq[iq]
+        tq = (logq2 - lq[iq])/dlogq
+        vl = self._interpolate_x(mem, ix, t, dlogx, iq)
+        vh = self._interpolate_x(mem, ix, t, dlogx, iq+1)
+        #Like LHAPDF, fall back to linear in log Q2 with less than 4 knots.
+        if nq < 4:
+            return vl + tq*(vh - vl)
+
+        #Derivatives in log Q2, scaled to the [iq, iq+1] interval.
+        if iq > 0:
+            vll = self._interpolate_x(mem, ix, t, dlogx, iq-1)
+            dl = ((vh - vl) + (vl - vll)*dlogq/(lq[iq] - lq[iq-1]))/2
+        if iq + 2 < nq:
+            vhh = self._interpolate_x(mem, ix, t, dlogx, iq+2)
+            dh = ((vh - vl) + (vhh - vh)*dlogq/(lq[iq+2] - lq[iq+1]))/2
+        if iq == 0:
+            dl = vh - vl
+        if iq + 2 == nq:
+            dh = vh - vl
+        return _hermite(tq, vl, dl, vh, dh)
+
+class GridSet(object):
+    """The grids of (some of the) members of an LHAPDF set. ``subgrids`` is
+    a list of ``(x, q, flavours, values)`` with ``values`` of shape
+    ``(nmem, nx, nq, nfl)``. ``extrapolator`` is one of ``EXTRAPOLATORS``
+    (case insensitive, as the ``Extrapolator`` info field)."""
+    def __init__(self, subgrids, extrapolator=DEFAULT_EXTRAPOLATOR):
+        self.subgrids = [Subgrid(*subgrid) for subgrid in subgrids]
+        self.flavours = self.subgrids[0].flavours
+        self._qstarts = np.array([sub.q[0] for sub in self.subgrids])
+        extrapolator = extrapolator.lower()
+        if extrapolator not in EXTRAPOLATORS:
+            raise ValueError("Unsupported extrapolator '%s'. Valid ones are: "
+                             "%s" % (extrapolator, EXTRAPOLATORS))
+        self.extrapolator = extrapolator
+
+    @classmethod
+    def from_files(cls, paths, extrapolator=DEFAULT_EXTRAPOLATOR):
+        """Read the members in the ``.dat`` files ``paths``."""
+        members = [read_member(path)[1] for path in paths]
+        return cls([(x, q, flavours,
+                     np.array([member[isub][3] for member in members]))
+                    for isub, (x, q, flavours, _) in enumerate(members[0])],
+                   extrapolator=extrapolator)
+
+    def __len__(self):
+        return self.subgrids[0].values.shape[0]
+
+    def _flavour_index(self, fl):
+        """Positions of the PDG ids ``fl`` in the grid (-1 if missing)."""
+        fl = np.where(np.asarray(fl) == 0, GLUON, fl)
+        index = {f: i for i, f in enumerate(self.flavours)}
+        return np.array([index.get(f, -1) for f in fl])
+
+    def _subgrid(self, Q):
+        i = np.searchsorted(self._qstarts, Q, side='right') - 1
+        return self.subgrids[max(i, 0)]
+
+    def _values_in_q(self, members, x, Q):
+        """Values at a ``Q`` in the range of the grid. Points below the x
+        range are extrapolated if the extrapolator is 'continuation'."""
+        sub = self._subgrid(Q)
+        values = sub.interpolate(members, x, Q)
+        low = x < sub.x[0]
+        if self.extrapolator == 'continuation' and low.any():
+            edge = sub.interpolate(members, sub.x[:2], Q)
+            values[:, low] = _extrapolate_linear(x[low, np.newaxis],
+                                                 sub.x[0], sub.x[1],
+                                                 edge[:, :1], edge[:, 1:])
+        return values
+
+    def _values(self, members, x, Q):
+        """Values of all the flavours in the grid, with shape
+        ``(nmem, npoints, nfl)``, extrapolated as LHAPDF does."""
+        sub = self._subgrid(Q)
+        qmin, qmax = self.subgrids[0].q[0], self.subgrids[-1].q[-1]
+        if self.extrapolator == 'error' and (Q < qmin or Q > qmax or
+                                             np.any(x < sub.x[0])):
+            raise RangeError("Point outside of the grid at Q=%g (Q range "
+                             "[%g, %g], x min %g)" % (Q, qmin, qmax,
+                                                      sub.x[0]))
+        if self.extrapolator != 'nearest' and np.any(x > sub.x[-1]):
+            raise RangeError("x=%g is above the grid range (x max %g)" %
+                             (np.max(x), sub.x[-1]))
+        if self.extrapolator == 'nearest' or qmin <= Q <= qmax:
+            return self._values_in_q(members, x, Q)
+        if Q > qmax:
+            q1 = self.subgrids[-1].q[-2]
+            return _extrapolate_linear(Q**2, qmax**2, q1**2,
+                                       self._values_in_q(members, x, qmax),
+                                       self._values_in_q(members, x, q1))
+        #Below the grid, use the anomalous dimension at qmin, modified to go
+        #to 1 as Q goes to 0.
+        q1 = self.subgrids[0].q[1]
+        fmin = self._values_in_q(members, x, qmin)
+        f1 = self._values_in_q(members, x, q1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            anom = np.log(f1/fmin)/np.log(q1**2/qmin**2)
+        anom = np.where(np.abs(fmin) >= 1e-5, anom, 1)
+        r = Q**2/qmin**2
+        return fmin*r**(anom*r + 1 - r)
+
+    def xfxQ_grid(self, members, fl, xgrid, Q):
+        """Return an array of shape ``(len(members), len(fl), len(xgrid))``
+        with the values of :math:`xf(x, Q)`, as ``PDF.xfxQ_grid``."""
+        members = np.asarray(members, dtype=int)
+        xgrid = np.asarray(xgrid, dtype=np.float64)
+        values = self._values(members, xgrid, Q)
+        flindex = self._flavour_index(fl)
+        result = np.zeros((len(members), len(flindex), len(xgrid)))
+        present = flindex >= 0
+        result[:, present] = np.transpose(values[:, :, flindex[present]],
+                                          (0, 2, 1))
+        return result
+
+    def xfxQ_multigrid(self, members, fl, xgrid, Qs):
+        """Like ``xfxQ_grid`` for several scales. Return an array of shape
+        ``(len(Qs), len(members), len(fl), len(xgrid))``."""
+        return np.array([self.xfxQ_grid(members, fl, xgrid, Q) for Q in Qs])
+
+def member_path(name, imem):
+    return osp.join(lhaindex.finddir(name), '%s_%04d.dat' % (name, imem))
+
+@fastcache.lru_cache(maxsize=4)
+def load_gridset(name):
+    """Return the ``GridSet`` of all the members of the installed set
+    ``name``, backed by its ``replicastore``, with the ``Extrapolator`` of
+    the set."""
+    from smpdflib import replicastore
+    store = replicastore.load_store(name)
+    extrapolator = lhaindex.parse_info(name).get('Extrapolator',
+                                                 DEFAULT_EXTRAPOLATOR)
+    return GridSet([subgrid + (store.subgrid_values(isub),)
+                    for isub, subgrid in enumerate(store.subgrids)],
+                   extrapolator=extrapolator)
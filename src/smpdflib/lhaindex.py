@@ -9,14 +9,22 @@ from __future__ import print_function
 import os
 import os.path as osp
 import re
-import glob
 import fnmatch
+import json
+import pickle
+import copy
+import hashlib
+import tempfile
+import threading
+import sqlite3
+from collections.abc import Mapping
 
 import yaml
-import fastcache
 
 import applwrap
 
+from smpdflib.utils import get_cache_dir
+
 
 _indexes_to_names = None
 _names_to_indexes = None
@@ -25,9 +33,12 @@ def expand_index_names(globstr):
     return fnmatch.filter(get_names_to_indexes().keys(), globstr)
 
 def expand_local_names(globstr):
-    paths = get_lha_paths()
-    return [name for path in paths for name in glob.glob1(path, globstr)
-            if osp.isdir(osp.join(path, name))]
+    """Return the names of the installed sets matching ``globstr``, looked
+    up in the catalog (see ``installed_sets``)."""
+    names = installed_sets().keys()
+    if not globstr.startswith('.'):
+        names = [name for name in names if not name.startswith('.')]
+    return sorted(fnmatch.filter(names, globstr))
 
 def expand_names(globstr):
     """Return names of installed PDFs. If none is found,
@@ -108,12 +119,259 @@ def infofilename(name):
             return info
     raise FileNotFoundError(name + ".info")
 
-@fastcache.lru_cache()
+def _loaded_catalog(name):
+    """Return the catalog in memory if it has the set ``name``, and
+    otherwise refresh it. Sets found in memory are served without looking
+    at the LHAPDF paths."""
+    with _catalog_lock:
+        catalog = _catalog
+    if catalog is None or name not in catalog:
+        catalog = refresh_catalog()
+    return catalog
+
+class InfoView(Mapping):
+    """Read only view of the content of an info file. Each field is copied
+    when it is looked up, so callers can modify the values they get without
+    changing the cached info, and looking up one field doesn't copy the
+    others."""
+    def __init__(self, info):
+        self._info = info
+
+    def __getitem__(self, key):
+        return copy.deepcopy(self._info[key])
+
+    def __iter__(self):
+        return iter(self._info)
+
+    def __len__(self):
+        return len(self._info)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._info)
+
 def parse_info(name):
+    """Return an ``InfoView`` of the content of the ``.info`` file of the
+    set ``name``, from the catalog in memory if possible. It is cached for
+    the life of the in memory catalog, which is reloaded when the LHAPDF
+    paths change (see ``refresh_catalog``)."""
+    entry = _loaded_catalog(name).get(name)
+    if entry is not None and entry['info'] is not None:
+        return InfoView(entry['info'])
     with open(infofilename(name)) as infofile:
         result = yaml.load(infofile)
+    return InfoView(result)
+
+def set_infos(names):
+    """Return a dict with an ``InfoView`` of the info of each of the
+    installed sets in ``names``, from the catalog. Sets that are not
+    installed are left out."""
+    catalog = installed_sets()
+    result = {}
+    for name in names:
+        entry = catalog.get(name)
+        if entry is not None:
+            result[name] = (InfoView(entry['info'])
+                            if entry['info'] is not None
+                            else parse_info(name))
     return result
 
+#In memory copy of the catalog: the entries of the installed sets by name
+#and the modification times of the LHAPDF paths when it was read.
+_catalog = None
+_catalog_mtimes = None
+_catalog_lock = threading.Lock()
+
+def catalog_path():
+    return osp.join(get_cache_dir(), 'catalog.sqlite')
+
+#Version of the schema of the catalog. Catalogs with other versions are
+#rebuilt.
+CATALOG_VERSION = 3
+
+def _connect_catalog():
+    conn = sqlite3.connect(catalog_path(), timeout=60, isolation_level=None)
+    conn.execute("BEGIN IMMEDIATE")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+        conn.execute("DROP TABLE IF EXISTS paths")
+        conn.execute("DROP TABLE IF EXISTS sets")
+        conn.execute("PRAGMA user_version = %d" % CATALOG_VERSION)
+    conn.execute("CREATE TABLE IF NOT EXISTS paths "
+                 "(path TEXT PRIMARY KEY, mtime INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS sets "
+                 "(path TEXT, name TEXT, info_size INTEGER, "
+                 "info_mtime INTEGER, info BLOB, "
+                 "PRIMARY KEY (path, name))")
+    conn.execute("COMMIT")
+    conn.isolation_level = ''
+    return conn
+
+def _path_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _read_info(infopath):
+    """Parse the info file, or return None if it cannot be parsed."""
+    try:
+        with open(infopath) as infofile:
+            return yaml.load(infofile)
+    except (IOError, ValueError, yaml.YAMLError):
+        return None
+
+def _sync_path(conn, path, mtime):
+    """Update the entries of the LHAPDF path ``path`` in the catalog. The
+    directory is listed only if its modification time changed, and the info
+    files are parsed only if their size or modification time changed."""
+    stored = {name: (size, info_mtime) for name, size, info_mtime in
+              conn.execute("SELECT name, info_size, info_mtime FROM sets "
+                           "WHERE path=?", (path,))}
+    old_mtime = conn.execute("SELECT mtime FROM paths WHERE path=?",
+                             (path,)).fetchone()
+    if mtime is None:
+        names = []
+    elif old_mtime is not None and old_mtime[0] == mtime:
+        names = list(stored)
+    else:
+        names = [name for name in os.listdir(path)
+                 if osp.isdir(osp.join(path, name))]
+    for name in names:
+        infopath = osp.join(path, name, name + '.info')
+        try:
+            st = os.stat(infopath)
+            stamp = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            stamp = (None, None)
+        if name in stored and stored[name] == stamp:
+            continue
+        info = _read_info(infopath) if stamp[0] is not None else None
+        conn.execute("INSERT OR REPLACE INTO sets VALUES (?, ?, ?, ?, ?)",
+                     (path, name, stamp[0], stamp[1],
+                      None if info is None else
+                      sqlite3.Binary(pickle.dumps(info))))
+    removed = set(stored) - set(names)
+    conn.executemany("DELETE FROM sets WHERE path=? AND name=?",
+                     [(path, name) for name in removed])
+    conn.execute("INSERT OR REPLACE INTO paths VALUES (?, ?)", (path, mtime))
+
+def refresh_catalog(full=False):
+    """Bring the catalog up to date with the LHAPDF paths and reload it in
+    memory. Unless ``full`` is set, only the paths whose modification time
+    changed since the catalog was last loaded are rescanned."""
+    global _catalog, _catalog_mtimes
+    paths = get_lha_paths()
+    mtimes = [_path_mtime(path) for path in paths]
+    with _catalog_lock:
+        if not full and _catalog is not None and _catalog_mtimes == mtimes:
+            return _catalog
+        conn = _connect_catalog()
+        try:
+            with conn:
+                for path, mtime in zip(paths, mtimes):
+                    _sync_path(conn, path, mtime)
+                rows = conn.execute("SELECT path, name, info FROM sets "
+                                    "WHERE path IN (%s)" %
+                                    ', '.join('?'*len(paths)), paths)
+                rows = rows.fetchall()
+        finally:
+            conn.close()
+        priority = {path: i for i, path in enumerate(paths)}
+        catalog = {}
+        #Sets in the first paths take precedence, as in ``finddir``
+        for path, name, info in sorted(rows, key=lambda r: -priority[r[0]]):
+            catalog[name] = {'name': name, 'path': osp.join(path, name),
+                             'info': None if info is None else
+                                     pickle.loads(info)}
+        _catalog, _catalog_mtimes = catalog, mtimes
+        return catalog
+
+def installed_sets():
+    """Return a dict with an entry for each installed PDF set, containing
+    its ``name``, its ``path`` and its ``info`` (or None if the info file
+    cannot be read). The entries are shared and must not be modified; use
+    ``parse_info`` or ``set_infos`` to get the info.
+
+    The entries are stored in a SQLite database (see ``catalog_path``) and
+    checked against the LHAPDF paths at load time: sets are rescanned if the
+    directories they are in changed. In the same process, the in memory copy
+    is reused while the modification times of the LHAPDF paths (which change
+    when sets are added or removed) stay the same."""
+    return refresh_catalog()
+
+#Digests of the files of the PDF sets, indexed by path and valid while the
+#size and modification time of the file match. Loaded from (and saved to)
+#``fingerprint_index_path()``.
+_fingerprint_index = None
+_fingerprint_lock = threading.Lock()
+
+def fingerprint_index_path():
+    return osp.join(get_cache_dir(), 'fingerprints.json')
+
+def _load_fingerprint_index():
+    global _fingerprint_index
+    if _fingerprint_index is None:
+        try:
+            with open(fingerprint_index_path()) as f:
+                _fingerprint_index = json.load(f)
+        except (IOError, ValueError):
+            _fingerprint_index = {}
+    return _fingerprint_index
+
+def _save_fingerprint_index(new_entries):
+    """Add ``new_entries`` to the index on disk, keeping the entries added
+    by other processes."""
+    path = fingerprint_index_path()
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = {}
+    index.update(new_entries)
+    fd, tmpname = tempfile.mkstemp(dir=osp.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmpname, path)
+
+def _file_digest(path, blocksize=1<<20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def file_digests(paths):
+    """Return the sha1 hex digests of the files in ``paths``. Files whose
+    size and modification time match the index are not read again, so
+    this costs one ``stat`` per file once the index is warm."""
+    with _fingerprint_lock:
+        index = _load_fingerprint_index()
+        new_entries = {}
+        digests = []
+        for path in paths:
+            path = osp.abspath(path)
+            st = os.stat(path)
+            stamp = [st.st_size, st.st_mtime_ns]
+            entry = index.get(path)
+            if entry is None or entry[:2] != stamp:
+                entry = stamp + [_file_digest(path)]
+                index[path] = new_entries[path] = entry
+            digests.append(entry[2])
+        if new_entries:
+            _save_fingerprint_index(new_entries)
+    return digests
+
+def fingerprint(name):
+    """Return the sha1 digest (as bytes) of the content of all the files
+    (info and members) of the installed PDF set ``name``."""
+    d = finddir(name)
+    files = sorted(f for f in os.listdir(d) if osp.isfile(osp.join(d, f)))
+    h = hashlib.sha1()
+    for f, digest in zip(files, file_digests(osp.join(d, f) for f in files)):
+        h.update(f.encode())
+        h.update(b'\0')
+        h.update(digest.encode())
+    return h.digest()
+
 def get_lha_paths():
     return applwrap.getlhapdfpath()
 
@@ -19,6 +19,7 @@ import yaml
 import applwrap
 
 from smpdflib import lhaindex
+from smpdflib import replicastore
 
 def split_sep(f):
     for line in f:
@@ -106,19 +107,14 @@ def write_replica(rep, pdf_name, header, subgrids):
         _rep_to_buffer(out, header, subgrids)
 
 def load_all_replicas(pdf, db=None):
-    if db is not None:
-        #removing str() will crash as it casts to unicode due to pdf name
-        key = str("(load_all_replicas, %s)" % pdf.get_key())
-        if key in db:
-            return db[key]
-    rep0headers, rep0grids = load_replica(pdf, 0)
-
-    headers, grids = zip(*[load_replica(pdf, rep, rep0grids)
-                         for rep in range(1, len(pdf))])
-    result = [rep0headers] + list(headers), [rep0grids] + list(grids)
-    if db is not None:
-        db[key] = result
-    return result
+    """Return the headers and the grids (as ``Series``) of all the members
+    of ``pdf``. The grids are views of the ``replicastore`` of the set.
+    ``db`` is not used any more and is kept for compatibility."""
+    store = replicastore.load_store(str(pdf))
+    index = store.index
+    grids = [pd.Series(values, index=index, copy=False)
+             for values in store.values]
+    return list(store.headers), grids
 
 def big_matrix(gridlist):
     central_value = gridlist[0]
@@ -162,11 +158,20 @@ def hessian_from_lincomb(pdf, V, set_name=None, folder = None, db=None,
         if extra_fields is not None:
             yaml.dump(extra_fields, out, default_flow_style=False)
 
-    headers, grids = load_all_replicas(pdf, db=db)
+    store = replicastore.load_store(str(pdf))
+    values = store.values
+    if values.shape[0] != V.shape[0] + 1:
+        raise ValueError("Incompatible grid specifications")
     hess_name = set_root + '/' + set_name
-    result  = (big_matrix(grids).dot(V)).add(grids[0], axis=0, )
+    #Same as (values[1:] - values[0]).T.dot(V) + values[0], without building
+    #the difference matrix.
+    V = np.asarray(V)
+    result = (V.T.dot(values[1:]) - np.outer(V.sum(axis=0), values[0])
+              + values[0])
+    index = store.index
     hess_header = b"PdfType: error\nFormat: lhagrid1\n"
-    for column in result.columns:
-        write_replica(column + 1, hess_name, hess_header, result[column])
+    for column, row in enumerate(result):
+        write_replica(column + 1, hess_name, hess_header,
+                      pd.Series(row, index=index))
 
     return set_root
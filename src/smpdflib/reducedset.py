@@ -24,7 +24,7 @@ import numpy.linalg as la
 import pandas as pd
 import yaml
 
-from smpdflib.core import get_X, produce_results, PDF
+from smpdflib.core import iter_X_multiQ, produce_results, PDF
 from smpdflib.lhio import hessian_from_lincomb
 from smpdflib.corrutils import DEFAULT_CORRELATION_THRESHOLD, bin_corrs_from_X
 import applwrap
@@ -168,6 +168,13 @@ SMPDFLincombResult = namedtuple('SMPDFLincombResult',
                                 'errors', 'Rold'))
 
 
+def _bin_scales(pdf_results):
+    """The energy scales of the bins of ``pdf_results``, in the order in
+    which ``get_smpdf_lincomb`` visits them. Results can hold only some of
+    the bins of their observable."""
+    return [result.meanQ[b] for result in pdf_results
+            for b in result.binlabels]
+
 class TooMuchPrecision(Exception):
     def __init__(self, obs, b):
         super().__init__(("A SMPDF cannot be calculated with the requested "
@@ -213,6 +220,9 @@ def get_smpdf_lincomb(pdf, pdf_results,
 
     index = 0
 
+    #Evaluate the PDF at the scales of the bins a few at a time.
+    Xs = iter_X_multiQ(pdf, _bin_scales(pdf_results))
+
     for result in pdf_results:
         obs_desc = OrderedDict()
         obs_errors = OrderedDict()
@@ -221,7 +231,7 @@ def get_smpdf_lincomb(pdf, pdf_results,
         if result.pdf != pdf:
             raise ValueError("PDF results must be for %s" % pdf)
         for b in result.binlabels:
-            Xreal = get_X(pdf, Q=result.meanQ[b], reshape=True)
+            Xreal = next(Xs)
             prediction = result._all_vals.ix[b]
             original_diffs = prediction - np.mean(prediction)
             if Rold is not None:
@@ -298,7 +308,8 @@ def complete_smpdf_description(desc, pdf ,pdf_results, full_grid,
 def smpdf_input_hash(pdf, pdf_results, full_grid,
                       target_error):
 
-    hashstr = b''.join(r.obs.sha1hash for r in pdf_results)
+    hashstr = pdf.sha1hash
+    hashstr += b''.join(r.obs.sha1hash for r in pdf_results)
     hashstr += target_error.hex().encode()
     hashstr += bytes(full_grid)
     input_hash = hashlib.sha1(hashstr).hexdigest()
@@ -310,7 +321,7 @@ def mc2h_input_hash(pdf, Q, Neig):
     return hashlib.sha1(hashstr).hexdigest()
 
 def create_mc2hessian(pdf, Q, Neig, output_dir, name=None, db=None):
-    X = get_X(pdf, Q, reshape=True)
+    X = next(iter_X_multiQ(pdf, [Q]))
     vec = compress_X(X, Neig)
     norm = _pdf_normalization(pdf)
     description = {'input_hash': mc2h_input_hash(pdf,Q,Neig)}
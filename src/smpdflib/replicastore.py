@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+A binary store with the grids of all the members of a PDF set.
+
+The ``.dat`` files of a set are parsed once and written into a single file
+containing the values at the nodes of all the members, as a contiguous
+array of shape ``(nmem, npoints)``, followed by a JSON trailer with the
+nodes of the subgrids, the headers of the members and the fingerprint of
+the set (see ``lhaindex.fingerprint``). Readers memory map the array, so
+that all the replicas are available without parsing or copying and the
+pages are shared by all the processes using the same set.
+
+The points of each member are ordered as in the ``.dat`` files: subgrid,
+x, Q and flavour, from slowest to fastest.
+"""
+import os
+import os.path as osp
+import json
+import struct
+import tempfile
+import logging
+
+import numpy as np
+import pandas as pd
+
+from smpdflib import lhaindex
+from smpdflib.lhagrid import read_member, member_path
+from smpdflib.utils import get_cache_dir
+
+MAGIC = b'SMPDFREP1\n'
+#Magic, offset and length of the trailer
+_PREFIX = struct.Struct('<%dsQQ' % len(MAGIC))
+#The values start at this offset, so that they are aligned.
+DATA_OFFSET = 64
+DTYPE = np.dtype('<f8')
+
+class ReplicaStoreError(Exception):
+    """Raised when a file is not a valid replica store."""
+    pass
+
+def store_filename(name):
+    return osp.join(get_cache_dir('replicas'), '%s.rep' % name)
+
+def write_store(filename, paths, fingerprint=b''):
+    """Write the members in the ``.dat`` files ``paths`` (in order) to the
+    store ``filename``. Members are read one at a time and the file is
+    renamed into place at the end, so concurrent readers never see a
+    partial store."""
+    headers = []
+    subgrids = None
+    fd, tmpname = tempfile.mkstemp(dir=osp.dirname(filename) or '.',
+                                   suffix='.rep.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\0'*DATA_OFFSET)
+            for path in paths:
+                header, member = read_member(path)
+                nodes = [(x, q, fl) for x, q, fl, _ in member]
+                if subgrids is None:
+                    subgrids = nodes
+                elif not _same_nodes(subgrids, nodes):
+                    raise ValueError("Incompatible grid specifications in "
+                                     "%s" % path)
+                headers.append(header.decode('latin-1'))
+                for _, _, _, values in member:
+                    f.write(np.ascontiguousarray(values, dtype=DTYPE)
+                            .tobytes())
+            trailer = json.dumps({
+                'fingerprint': fingerprint.hex(),
+                'nmembers': len(headers),
+                'subgrids': [{'x': x.tolist(), 'q': q.tolist(),
+                              'flavours': fl.tolist()}
+                             for x, q, fl in subgrids],
+                'headers': headers,
+            }).encode()
+            offset = f.tell()
+            f.write(trailer)
+            f.seek(0)
+            f.write(_PREFIX.pack(MAGIC, offset, len(trailer)))
+        os.replace(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+
+def _same_nodes(a, b):
+    return len(a) == len(b) and all(np.array_equal(u, v)
+                                    for s, t in zip(a, b)
+                                    for u, v in zip(s, t))
+
+class ReplicaStore(object):
+    """A replica store opened read only. ``values`` is a memory mapped
+    array of shape ``(nmem, npoints)``."""
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                magic, offset, length = _PREFIX.unpack(
+                                            f.read(_PREFIX.size))
+            except struct.error:
+                magic = None
+            if magic != MAGIC:
+                raise ReplicaStoreError("%s is not a replica store" %
+                                        filename)
+            f.seek(offset)
+            try:
+                trailer = json.loads(f.read(length).decode())
+            except ValueError as e:
+                raise ReplicaStoreError("Corrupted replica store %s: %s" %
+                                        (filename, e))
+        self.fingerprint = bytes.fromhex(trailer['fingerprint'])
+        self.headers = [h.encode('latin-1') for h in trailer['headers']]
+        self.subgrids = [(np.array(s['x']), np.array(s['q']),
+                          np.array(s['flavours'], dtype=int))
+                         for s in trailer['subgrids']]
+        self.shapes = [(len(x), len(q), len(fl)) for x, q, fl in
+                       self.subgrids]
+        npoints = sum(int(np.prod(shape)) for shape in self.shapes)
+        nmembers = trailer['nmembers']
+        if offset != DATA_OFFSET + nmembers*npoints*DTYPE.itemsize:
+            raise ReplicaStoreError("Corrupted replica store %s: wrong "
+                                    "size" % filename)
+        self.values = np.memmap(filename, dtype=DTYPE, mode='r',
+                                offset=DATA_OFFSET,
+                                shape=(nmembers, npoints))
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def subgrid_values(self, isub):
+        """View of the values of the subgrid ``isub``, with shape
+        ``(nmem, nx, nq, nfl)``."""
+        start = sum(int(np.prod(shape)) for shape in self.shapes[:isub])
+        shape = self.shapes[isub]
+        return self.values[:, start:start + int(np.prod(shape))].reshape(
+                   (len(self),) + shape)
+
+    @property
+    def index(self):
+        """``MultiIndex`` of the points, with levels subgrid, x, Q and
+        flavour, as used in ``lhio``."""
+        arrays = []
+        for isub, (x, q, fl) in enumerate(self.subgrids):
+            size = len(x)*len(q)*len(fl)
+            arrays.append((np.full(size, isub),
+                           np.repeat(x, len(q)*len(fl)),
+                           np.tile(np.repeat(q, len(fl)), len(x)),
+                           np.tile(fl, len(x)*len(q))))
+        return pd.MultiIndex.from_arrays([np.concatenate(level) for level in
+                                          zip(*arrays)])
+
+def load_store(name):
+    """Return the ``ReplicaStore`` of the installed set ``name``, writing it
+    first if it doesn't exist or if the set has changed since it was
+    written."""
+    filename = store_filename(name)
+    fingerprint = lhaindex.fingerprint(name)
+    try:
+        store = ReplicaStore(filename)
+    except (IOError, OSError, ReplicaStoreError):
+        store = None
+    if store is not None and store.fingerprint == fingerprint:
+        return store
+    logging.info("Writing the replica store of %s to %s" % (name, filename))
+    nmembers = lhaindex.parse_info(name)['NumMembers']
+    write_store(filename, [member_path(name, i) for i in range(nmembers)],
+                fingerprint)
+    return ReplicaStore(filename)
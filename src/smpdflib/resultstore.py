@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+A store of the convolution results, used as the ``db`` of ``get_dataset``.
+
+The store is a directory with an SQLite index and a ``.npy`` file for each
+entry, with the values of all the members as an array of shape
+``(nmem, nbins)``. Entries are read as memory mapped arrays, so a lookup
+doesn't load or unpickle anything until the values are used.
+
+Writers first save the array to a new file and then register it in the
+index in a single transaction, so any number of threads and processes can
+write to the same store concurrently. A ``ResultStore`` can be pickled and
+sent to the workers; each process and thread uses its own connection.
+
+The interface is that of the ``shelve`` databases used previously: keys
+are strings and values ``OrderedDict``s mapping the members to the arrays
+of values of the bins. Existing shelve files can be imported with
+``migrate_shelve``.
+
+Results can also be stored member by member (``store_members``), with the
+digest of the file of each member, as the convolutions progress. Members
+are indexed individually, so that an interrupted convolution, or one of a
+set with more members, only has to compute the members that are missing
+(see ``core.get_dataset``).
+"""
+import os
+import os.path as osp
+import ast
+import json
+import uuid
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import numpy as np
+
+INDEX_NAME = 'index.sqlite'
+BLOCKS_DIR = 'blocks'
+#Written once a shelve file has been imported
+MIGRATED_NAME = 'migrated'
+#Maximum number of parameters in an SQLite query
+_QUERY_CHUNK = 500
+
+class ResultStore(MutableMapping):
+    """Results stored in the directory ``path``, created if needed."""
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(osp.join(path, BLOCKS_DIR), exist_ok=True)
+        self._local = threading.local()
+        #Create the schema
+        self._connection()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __repr__(self):
+        return "<%s:%s>" % (self.__class__.__name__, self.path)
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(osp.join(self.path, INDEX_NAME),
+                                   timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS results "
+                         "(key TEXT PRIMARY KEY, filename TEXT NOT NULL, "
+                         "members TEXT NOT NULL, nmem INTEGER, "
+                         "nbins INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS members "
+                         "(key TEXT, member INTEGER, digest TEXT, "
+                         "filename TEXT NOT NULL, row INTEGER, "
+                         "PRIMARY KEY (key, member))")
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def _blockpath(self, filename):
+        return osp.join(self.path, BLOCKS_DIR, filename)
+
+    def _row(self, key):
+        row = self._connection().execute("SELECT filename, members FROM "
+                                         "results WHERE key=?",
+                                         (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def load(self, key):
+        """Return ``(members, values)``, where ``values`` is the memory
+        mapped array of shape ``(nmem, nbins)`` stored for ``key``."""
+        filename, members = self._row(key)
+        values = np.load(self._blockpath(filename), mmap_mode='r')
+        return json.loads(members), values
+
+    def __getitem__(self, key):
+        members, values = self.load(key)
+        return OrderedDict(zip(members, values))
+
+    def __setitem__(self, key, data):
+        if not isinstance(data, dict):
+            raise TypeError("Values must be mappings from members to the "
+                            "values of the bins, not %s" % type(data))
+        members = [int(m) if isinstance(m, np.integer) else m for m in data]
+        values = np.array([np.asarray(v, dtype=float) for v in
+                           data.values()])
+        if values.ndim == 1:
+            values = values[:, np.newaxis]
+        self.store(key, members, values)
+
+    def _write_block(self, values):
+        filename = '%s.npy' % uuid.uuid4().hex
+        tmpname = self._blockpath(filename + '.tmp')
+        try:
+            with open(tmpname, 'wb') as f:
+                np.save(f, np.ascontiguousarray(values))
+            os.replace(tmpname, self._blockpath(filename))
+        except BaseException:
+            if osp.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+        return filename
+
+    def store(self, key, members, values):
+        """Store the array ``values`` of shape ``(nmem, nbins)`` with the
+        labels ``members`` of the rows for ``key``."""
+        filename = self._write_block(values)
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = conn.execute("SELECT filename FROM results WHERE key=?",
+                               (key,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO results VALUES "
+                         "(?, ?, ?, ?, ?)",
+                         (key, filename, json.dumps(members),
+                          values.shape[0], values.shape[1]))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            os.unlink(self._blockpath(filename))
+            raise
+        conn.execute("COMMIT")
+        if old is not None:
+            self._remove_block(old[0])
+
+    def store_members(self, key, members, values, digests):
+        """Store the rows of ``values`` as the results of the integer
+        ``members`` for ``key``, replacing the previous ones. ``digests``
+        identify the version of each member."""
+        values = np.asarray(values, dtype=float)
+        filename = self._write_block(values)
+        rows = [(key, int(m), d, filename, i) for i, (m, d) in
+                enumerate(zip(members, digests))]
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = set()
+            for i in range(0, len(rows), _QUERY_CHUNK):
+                chunk = [int(m) for m in members[i:i+_QUERY_CHUNK]]
+                old.update(row[0] for row in conn.execute(
+                    "SELECT DISTINCT filename FROM members WHERE key=? AND "
+                    "member IN (%s)" % ', '.join('?'*len(chunk)),
+                    [key] + chunk))
+            conn.executemany("INSERT OR REPLACE INTO members VALUES "
+                             "(?, ?, ?, ?, ?)", rows)
+            unused = [f for f in old if not conn.execute(
+                          "SELECT 1 FROM members WHERE filename=? LIMIT 1",
+                          (f,)).fetchone()]
+        except BaseException:
+            conn.execute("ROLLBACK")
+            os.unlink(self._blockpath(filename))
+            raise
+        conn.execute("COMMIT")
+        for f in unused:
+            self._remove_block(f)
+
+    def stored_members(self, keys):
+        """Return a dictionary mapping each of ``keys`` to a dictionary with
+        the digests of the members stored for it."""
+        keys = list(keys)
+        found = {key: {} for key in keys}
+        conn = self._connection()
+        for i in range(0, len(keys), _QUERY_CHUNK):
+            chunk = keys[i:i+_QUERY_CHUNK]
+            rows = conn.execute("SELECT key, member, digest FROM members "
+                                "WHERE key IN (%s)" %
+                                ', '.join('?'*len(chunk)), chunk)
+            for key, member, digest in rows:
+                found[key][member] = digest
+        return found
+
+    def load_members(self, key, members):
+        """Return the values stored for ``members`` of ``key`` as an array
+        of shape ``(len(members), nbins)``. Raise ``KeyError`` if any of
+        them is missing."""
+        members = [int(m) for m in members]
+        rows = {}
+        conn = self._connection()
+        for i in range(0, len(members), _QUERY_CHUNK):
+            chunk = members[i:i+_QUERY_CHUNK]
+            rows.update((member, (filename, row)) for member, filename, row
+                        in conn.execute("SELECT member, filename, row FROM "
+                                        "members WHERE key=? AND member IN "
+                                        "(%s)" % ', '.join('?'*len(chunk)),
+                                        [key] + chunk))
+        missing = [m for m in members if m not in rows]
+        if missing:
+            raise KeyError("Members %s of %s are not stored" % (missing, key))
+        blocks = {}
+        result = None
+        for i, m in enumerate(members):
+            filename, row = rows[m]
+            if filename not in blocks:
+                blocks[filename] = np.load(self._blockpath(filename),
+                                           mmap_mode='r')
+            block = blocks[filename]
+            if result is None:
+                result = np.empty((len(members), block.shape[1]))
+            result[i] = block[row]
+        if result is None:
+            result = np.empty((0, 0))
+        return result
+
+    def _remove_block(self, filename):
+        #Readers can still have the file mapped; that is fine on POSIX.
+        try:
+            os.unlink(self._blockpath(filename))
+        except OSError as e:
+            logging.warning("Could not remove %s: %s" % (filename, e))
+
+    def __delitem__(self, key):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT filename FROM results WHERE key=?",
+                           (key,)).fetchone()
+        conn.execute("DELETE FROM results WHERE key=?", (key,))
+        conn.execute("COMMIT")
+        if row is None:
+            raise KeyError(key)
+        self._remove_block(row[0])
+
+    def __contains__(self, key):
+        return bool(self.existing([key]))
+
+    def existing(self, keys):
+        """Return the set of ``keys`` that are in the store, with one query
+        per few hundred keys."""
+        keys = list(keys)
+        found = set()
+        conn = self._connection()
+        for i in range(0, len(keys), _QUERY_CHUNK):
+            chunk = keys[i:i+_QUERY_CHUNK]
+            rows = conn.execute("SELECT key FROM results WHERE key IN (%s)" %
+                                ', '.join('?'*len(chunk)), chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def __iter__(self):
+        rows = self._connection().execute("SELECT key FROM results")
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM "
+                                          "results").fetchone()[0]
+
+    def close(self):
+        local = self._local
+        if getattr(local, 'pid', None) == os.getpid():
+            local.conn.close()
+        local.pid = None
+
+def _is_result_key(key):
+    """Whether ``key`` has the form of ``core.result_key``:
+    ``str(((pdfname,), (obsname, order)))``."""
+    try:
+        pdfkey, obskey = ast.literal_eval(key)
+    except (ValueError, SyntaxError, TypeError, MemoryError,
+            RecursionError):
+        return False
+    return (isinstance(pdfkey, tuple) and len(pdfkey) == 1 and
+            isinstance(pdfkey[0], str) and isinstance(obskey, tuple) and
+            len(obskey) == 2 and isinstance(obskey[0], str) and
+            isinstance(obskey[1], int))
+
+def migrate_shelve(shelve_path, store):
+    """Copy the convolution results in the shelve file ``shelve_path`` that
+    are not already in ``store``. Other entries (such as the replicas
+    cached by old versions of ``lhio.load_all_replicas``) are skipped.
+    Return the number of entries copied."""
+    import shelve
+    db = shelve.open(shelve_path, flag='r')
+    try:
+        keys = [key for key in db.keys() if _is_result_key(key)]
+        skipped = len(db) - len(keys)
+        present = store.existing(keys)
+        n = 0
+        for key in keys:
+            if key in present:
+                continue
+            data = db[key]
+            if not isinstance(data, dict):
+                skipped += 1
+                continue
+            store[key] = data
+            n += 1
+    finally:
+        db.close()
+    if skipped:
+        logging.info("Skipped %d entries of %s that are not convolution "
+                     "results" % (skipped, shelve_path))
+    return n
+
+def _is_shelve(path):
+    import dbm
+    try:
+        return bool(dbm.whichdb(path))
+    except OSError:
+        return False
+
+def open_store(path):
+    """Open the ``ResultStore`` for the ``--use-db`` argument ``path``. If
+    ``path`` is an old shelve file, its entries are imported into the store
+    ``<path>.store`` until that completes once."""
+    if not _is_shelve(path):
+        return ResultStore(path)
+    store = ResultStore(path + '.store')
+    marker = osp.join(store.path, MIGRATED_NAME)
+    if not osp.exists(marker):
+        logging.info("Importing the results in %s into %s" % (path,
+                                                              store.path))
+        n = migrate_shelve(path, store)
+        logging.info("Imported %d results" % n)
+        with open(marker, 'w') as f:
+            f.write(path + '\n')
+    return store
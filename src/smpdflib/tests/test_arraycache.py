@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Test the on disk array cache.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+from unittest import mock
+
+import numpy as np
+
+from smpdflib.arraycache import ArrayCache, make_key
+
+
+class TestArrayCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        cache = ArrayCache(self.directory, maxsize=10**6)
+        key = make_key('pdf', 1.65, np.linspace(0, 1, 5))
+        self.assertIsNone(cache.get(key))
+        mean, replicas = np.arange(6.).reshape(2, 3), np.ones((4, 2, 3))
+        cache.put(key, (mean, replicas))
+        cmean, creplicas = cache.get(key)
+        self.assertTrue(np.all(cmean == mean))
+        self.assertTrue(np.all(creplicas == replicas))
+        self.assertIsInstance(creplicas, np.memmap)
+        #Storing twice must not fail
+        cache.put(key, (mean, replicas))
+
+    def test_keys(self):
+        x = np.linspace(0, 1, 5)
+        self.assertEqual(make_key('a', x), make_key('a', x.copy()))
+        self.assertNotEqual(make_key('a', x), make_key('a', x[:-1]))
+        self.assertNotEqual(make_key('a', x), make_key('a', x.astype(int)))
+
+    def test_eviction(self):
+        array = np.zeros(1000)
+        cache = ArrayCache(self.directory, maxsize=3*array.nbytes)
+        for i in range(5):
+            cache.put(str(i), (array,))
+            #Make sure the entries have different times
+            os.utime(os.path.join(self.directory, str(i)), (i, i))
+        self.assertIsNone(cache.get('0'))
+        self.assertIsNotNone(cache.get('4'))
+        self.assertLessEqual(sum(size for _, size, _ in cache.entries()),
+                             cache.maxsize)
+
+    def test_running_size(self):
+        array = np.zeros(1000)
+        cache = ArrayCache(self.directory, maxsize=3*array.nbytes)
+        cache.put('0', (array,))
+        #The directory is only scanned again when the limit is exceeded
+        with mock.patch.object(cache, 'entries',
+                               wraps=cache.entries) as entries:
+            cache.put('1', (array,))
+            cache.put('1', (array,))
+            self.assertEqual(entries.call_count, 0)
+            #With the headers of the files, this exceeds the limit
+            cache.put('2', (array,))
+            self.assertEqual(entries.call_count, 1)
+        self.assertEqual(cache._size,
+                         sum(size for _, size, _ in cache.entries()))
+        self.assertLessEqual(cache._size, cache.maxsize)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Test the check of the linearity of the predictions in alpha_s.
+"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from smpdflib import core
+
+
+def make_table(points):
+    """``points`` is a list of (observable, alpha_s, cv)"""
+    return pd.DataFrame({
+        'Observable': [p[0] for p in points],
+        'NumFlavors': 5,
+        'PDF_OrderQCD': 'NLO',
+        'Collaboration': 'NNPDF',
+        'alpha_sMref': [p[1] for p in points],
+        'CV': [p[2] for p in points],
+        'Up68': 0.1,
+        'Remarks': [[] for _ in points],
+    })
+
+class TestAsLinearity(unittest.TestCase):
+
+    def test_fit(self):
+        alphas = np.linspace(0.114, 0.122, 5)
+        line = list(10 + 100*(alphas - 0.118))
+        bent = list(line)
+        bent[2] -= 1
+        points = ([('a', a, cv) for a, cv in zip(alphas, line)] +
+                  [('b', a, cv) for a, cv in zip(alphas, bent)] +
+                  [('c', a, cv) for a, cv in zip(alphas[:2], bent[:2])])
+        table = make_table(points)
+        core.test_as_linearity(table)
+        remarks = list(table['Remarks'])
+        self.assertTrue(all(not r for r in remarks[:5]))
+        self.assertEqual([bool(r) for r in remarks[5:10]],
+                         [False, False, True, False, False])
+
+        #Compare with the weighted least squares solution
+        x, y = alphas, np.array(bent)
+        sw = 1/np.abs(y)
+        coef, *_ = np.linalg.lstsq(np.c_[np.ones_like(x), x]*sw[:, None],
+                                   y*sw, rcond=None)
+        diff = (coef[0] + coef[1]*x[2] - y[2])/0.1
+        self.assertEqual(remarks[7],
+                         [u"Point away from linear fit by %1.1fσ" % diff])
+        #Groups with two points are not fitted
+        self.assertTrue(all(not r for r in remarks[10:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
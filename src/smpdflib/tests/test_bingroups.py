@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Test the aggregation of bins in user defined groups.
+"""
+import unittest
+
+import numpy as np
+
+from smpdflib.core import MCResult, SymHessianResult, BaseObservable
+from smpdflib.bingroups import parse_bin_groups, group_results
+
+class FakePDF(object):
+    label = 'fake'
+
+def make_result(cls, name, pdf, nbins, seed):
+    values = np.random.RandomState(seed).normal(loc=10, size=(nbins, 21))
+    return cls(BaseObservable(name, 1), pdf, values)
+
+SPEC = [
+    {'name': 'central', 'observable': 'jets-eta*', 'bins': [1, 2]},
+    {'name': 'ratio', 'bins': {'jets-eta2': 'all'},
+     'over': {'jets-eta1': [3]}},
+    {'name': 'other', 'observable': 'ttbar', 'bins': 'all'},
+]
+
+class TestBinGroups(unittest.TestCase):
+
+    def test_parse(self):
+        groups = parse_bin_groups(SPEC)
+        self.assertEqual([g.name for g in groups], ['central', 'ratio',
+                                                     'other'])
+        self.assertEqual(groups[0].bins, [('jets-eta*', [1, 2])])
+        self.assertEqual(groups[1].over, [('jets-eta1', [3])])
+        self.assertEqual(groups[2].bins, [('ttbar', None)])
+        bad = [[{'name': 'a', 'bins': [1]}],
+               [{'name': 'a', 'observable': 'x', 'bins': [0]}],
+               [{'name': 'a', 'observable': 'x', 'patata': 1}],
+               [{'name': 'a', 'observable': 'x'}]*2,
+               {'name': 'a'}]
+        for spec in bad:
+            with self.assertRaises(ValueError):
+                parse_bin_groups(spec)
+
+    def test_group_results(self):
+        pdfs = FakePDF(), FakePDF()
+        results = []
+        for i, (pdf, cls) in enumerate(zip(pdfs, (MCResult,
+                                                  SymHessianResult))):
+            results += [make_result(cls, 'jets-eta1', pdf, 4, 3*i),
+                        make_result(cls, 'jets-eta2', pdf, 3, 3*i + 1)]
+        results.append(make_result(MCResult, 'ttbar', pdfs[0], 1, 7))
+        grouped = group_results(results, parse_bin_groups(SPEC))
+        self.assertEqual([(r.obs.name, r.pdf) for r in grouped],
+                         [('central', pdfs[0]), ('ratio', pdfs[0]),
+                          ('other', pdfs[0]), ('central', pdfs[1]),
+                          ('ratio', pdfs[1])])
+        self.assertIsInstance(grouped[3], SymHessianResult)
+        eta1, eta2 = results[0]._values, results[1]._values
+        self.assertTrue(np.allclose(grouped[0]._values[0],
+                                    eta1[:2].sum(axis=0) +
+                                    eta2[:2].sum(axis=0)))
+        self.assertTrue(np.allclose(grouped[1]._values[0],
+                                    eta2.sum(axis=0)/eta1[2]))
+        self.assertTrue(np.allclose(grouped[2]._values, results[4]._values))
+        self.assertTrue(np.allclose(results[0].sumbins([0, 2])._values[0],
+                                    eta1[[0, 2]].sum(axis=0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -183,6 +183,51 @@ actions:
         )
         self._test_bad_config(s)
 
+    def test_bad_engine(self):
+        s= (
+"""observables:
+   - {name: data/applgrid/ttbar-xsectot-8tev.root, order: 0}
+pdfsets:
+   - NNPDF30_nlo_as_0118
+convolution_engine: patata
+actions:
+   - savedata
+"""
+        )
+        self._test_bad_config(s)
+
+    def test_bad_backend(self):
+        s= (
+"""observables:
+   - {name: data/applgrid/ttbar-xsectot-8tev.root, order: 0}
+pdfsets:
+   - NNPDF30_nlo_as_0118
+convolution_backend: patata
+actions:
+   - savedata
+"""
+        )
+        self._test_bad_config(s)
+
+    def test_bad_qladder(self):
+        s= (
+"""observables:
+   - {name: data/applgrid/ttbar-xsectot-8tev.root, order: 0}
+pdfsets:
+   - NNPDF30_nlo_as_0118
+qladder: {density: 10, patata: 1}
+actions:
+   - savedata
+"""
+        )
+        self._test_bad_config(s)
+
+    def test_explicit_actions(self):
+        from smpdflib import actions
+        self.assertNotIn('scalevariations', actions.build_actions(['all']))
+        self.assertIn('scalevariations',
+                      actions.build_actions(['all', 'scalevariations']))
+
     def test_correct_obs_dict(self):
         s= (
 """observables:
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Test the blocked computation of the correlations between observables.
+"""
+import unittest
+
+import numpy as np
+
+from smpdflib.core import MCResult, BaseObservable, results_table
+from smpdflib.corrutils import (standardize, correlation_blocks,
+                                correlation_matrix, top_correlations,
+                                observable_correlations)
+from smpdflib.tests.test_result import FakePDF, make_data
+
+class TestCorrelations(unittest.TestCase):
+
+    def setUp(self):
+        self.M = make_data(nbins=13, nmem=51)
+        #Some strongly correlated bins
+        self.M[5] = 2*self.M[2] + 0.1*self.M[5]
+        self.M[9] = -self.M[0] + 0.2*self.M[9]
+        self.expected = np.corrcoef(self.M)
+
+    def test_blocks(self):
+        Z = standardize(self.M)
+        for blocksize in (1, 4, 13, 100):
+            corrmat = correlation_matrix(correlation_blocks(Z,
+                                         blocksize=blocksize), len(Z))
+            self.assertTrue(np.allclose(corrmat, self.expected))
+        Z = standardize(self.M, np.float32)
+        corrmat = correlation_matrix(correlation_blocks(Z, blocksize=4),
+                                     len(Z), dtype=np.float32)
+        self.assertEqual(corrmat.dtype, np.float32)
+        self.assertTrue(np.allclose(corrmat, self.expected, atol=1e-5))
+
+    def test_base(self):
+        other = make_data(nbins=13, nmem=51, seed=1)
+        corrmat = correlation_matrix(correlation_blocks(standardize(self.M),
+                                     standardize(other), blocksize=5), 13)
+        self.assertTrue(np.allclose(corrmat,
+                                    self.expected - np.corrcoef(other)))
+
+    def test_top(self):
+        Z = standardize(self.M)
+        absexpected = np.abs(self.expected)
+        np.fill_diagonal(absexpected, -1)
+        for blocksize in (3, 13):
+            rows, cols, values = top_correlations(
+                correlation_blocks(Z, blocksize=blocksize), k=2)
+            self.assertEqual(len(rows), 2*13)
+            self.assertTrue(np.all(rows != cols))
+            self.assertTrue(np.allclose(values, self.expected[rows, cols]))
+            for i in range(13):
+                best = np.argsort(-absexpected[i])[:2]
+                self.assertEqual(list(cols[rows == i]), list(best))
+        rows, cols, values = top_correlations(correlation_blocks(Z,
+                                              blocksize=4), threshold=0.9)
+        self.assertEqual(set(zip(rows, cols)),
+                         {(0, 9), (9, 0), (2, 5), (5, 2)})
+        with self.assertRaises(ValueError):
+            top_correlations(correlation_blocks(Z))
+
+    def test_observable_correlations(self):
+        pdf = FakePDF()
+        results = [MCResult(BaseObservable('a', 1), pdf, self.M[:4]),
+                   MCResult(BaseObservable('b', 1), pdf, self.M[4:5]),
+                   MCResult(BaseObservable('c', 1), pdf, self.M[5:])]
+        (title, corrmat, labels), = observable_correlations(
+                                        results_table(results))
+        self.assertTrue(np.allclose(corrmat, np.corrcoef(self.M[:, 1:])))
+        self.assertEqual(len(labels), 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
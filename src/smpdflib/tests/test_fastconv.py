@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Test the contraction of exported APPLgrid weights against a direct sum over
+the weights.
+"""
+import unittest
+
+import numpy as np
+
+from smpdflib.fastconv import (GridWeights, FLAVOURS, WeightsError,
+                               _validate, validation_members)
+
+
+NMEM = 5
+NSUB = 3
+NBINS = 2
+
+class FakeHandle(object):
+    def alphasQ(self, members, Qs):
+        return np.array([[0.1 + 0.01*m + 1/np.log(Q) for Q in Qs]
+                         for m in members])
+
+class FakePDF(object):
+    """Smooth and member dependent xf(x, Q)."""
+    handle = FakeHandle()
+
+    def __init__(self, coefs):
+        self.coefs = coefs
+
+    def xfx(self, m, fl, x, Q):
+        c = self.coefs[m, fl + 6]
+        return c[0] + c[1]*x + c[2]*np.log(Q)
+
+    def xfxQ_multigrid(self, members, fl, x, Qs):
+        return np.array([[[[self.xfx(m, f, xx, Q) for xx in x] for f in fl]
+                          for m in members] for Q in Qs])
+
+class FakeSet(FakePDF):
+    def __len__(self):
+        return NMEM
+
+class FakeObservable(object):
+    def __init__(self, reference):
+        self.reference = reference
+
+    def convolute(self, pdf, members):
+        return self.reference[members]
+
+def make_arrays(rng):
+    names = ('Q', 'x1', 'x2', 'fun1', 'fun2', 'w_sub', 'w_tau', 'w_x1',
+             'w_x2', 'w_val')
+    arrays = {name: [] for name in names}
+    offsets = {name: [0] for name in ('tau', 'x1', 'x2', 'w')}
+    block_bin, block_power = [], []
+    nt, n1, n2 = 3, 4, 5
+    for b in range(NBINS):
+        for iorder in range(2):
+            arrays['Q'] += list(rng.uniform(10, 100, nt))
+            arrays['x1'] += list(rng.uniform(0.01, 0.9, n1))
+            arrays['x2'] += list(rng.uniform(0.01, 0.9, n2))
+            arrays['fun1'] += list(rng.uniform(1, 2, n1))
+            arrays['fun2'] += list(rng.uniform(1, 2, n2))
+            for s in range(NSUB):
+                for t in range(nt):
+                    #Leave the first x1 node empty
+                    for i in range(1, n1):
+                        for j in range(n2):
+                            if rng.uniform() < 0.5:
+                                arrays['w_sub'].append(s)
+                                arrays['w_tau'].append(t)
+                                arrays['w_x1'].append(i)
+                                arrays['w_x2'].append(j)
+                                arrays['w_val'].append(rng.normal())
+            offsets['tau'].append(len(arrays['Q']))
+            offsets['x1'].append(len(arrays['x1']))
+            offsets['x2'].append(len(arrays['x2']))
+            offsets['w'].append(len(arrays['w_val']))
+            block_bin.append(b)
+            block_power.append(iorder + 1)
+    arrays = {name: np.array(val) for name, val in arrays.items()}
+    arrays.update({name + '_offset': np.array(val)
+                   for name, val in offsets.items()})
+    lumi = rng.normal(size=(NSUB, len(FLAVOURS), len(FLAVOURS)))
+    #A rank one subprocess
+    lumi[1] = np.outer(rng.normal(size=len(FLAVOURS)),
+                       rng.normal(size=len(FLAVOURS)))
+    arrays.update(nbins=NBINS, lumi=lumi, block_bin=np.array(block_bin),
+                  block_power=np.array(block_power),
+                  bin_width=rng.uniform(0.5, 2, NBINS), run=np.array(4.),
+                  normalised=np.array(False))
+    return arrays
+
+def direct_convolution(arrays, pdf):
+    result = np.zeros((NMEM, NBINS))
+    for k in range(len(arrays['block_bin'])):
+        def sl(name, offset):
+            o = arrays[offset]
+            return arrays[name][o[k]:o[k+1]]
+        Q, x1, x2 = sl('Q', 'tau_offset'), sl('x1', 'x1_offset'), sl('x2',
+                                                                 'x2_offset')
+        fun1, fun2 = sl('fun1', 'x1_offset'), sl('fun2', 'x2_offset')
+        for w in range(arrays['w_offset'][k], arrays['w_offset'][k+1]):
+            s, t, i, j, val = (arrays[name][w] for name in
+                               ('w_sub', 'w_tau', 'w_x1', 'w_x2', 'w_val'))
+            for m in range(NMEM):
+                alphas = pdf.handle.alphasQ([0], [Q[t]])[0,0]/(2*np.pi)
+                f1 = np.array([pdf.xfx(m, fl, x1[i], Q[t])
+                               for fl in FLAVOURS])
+                f2 = np.array([pdf.xfx(m, fl, x2[j], Q[t])
+                               for fl in FLAVOURS])
+                result[m, arrays['block_bin'][k]] += (val*fun1[i]*fun2[j]*
+                    alphas**arrays['block_power'][k]*
+                    np.dot(f1, np.dot(arrays['lumi'][s], f2)))
+    return result/arrays['run']/arrays['bin_width']
+
+class TestFastconv(unittest.TestCase):
+
+    def test_contraction(self):
+        rng = np.random.RandomState(0)
+        arrays = make_arrays(rng)
+        pdf = FakePDF(rng.normal(size=(NMEM, len(FLAVOURS), 3)))
+        weights = GridWeights(arrays)
+        self.assertEqual(weights.nbins, NBINS)
+        result = weights.convolute(pdf, range(NMEM), chunksize=2)
+        self.assertTrue(np.allclose(result, direct_convolution(arrays, pdf),
+                                    rtol=1e-10, atol=0))
+
+    def test_validation(self):
+        rng = np.random.RandomState(0)
+        arrays = make_arrays(rng)
+        pdf = FakeSet(rng.normal(size=(NMEM, len(FLAVOURS), 3)))
+        weights = GridWeights(arrays)
+        reference = direct_convolution(arrays, pdf)
+        self.assertEqual(validation_members(pdf), [0, 2, 4])
+        _validate(FakeObservable(reference), pdf, weights, 1e-10)
+        #An error in a member other than the central one is detected
+        reference[2, 1] *= 1.01
+        with self.assertRaises(WeightsError):
+            _validate(FakeObservable(reference), pdf, weights, 1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Test the NumPy reader and interpolator of LHAPDF grids.
+"""
+import unittest
+import tempfile
+import shutil
+import os.path as osp
+
+import numpy as np
+
+from smpdflib.lhagrid import GridSet, RangeError, read_member
+
+FLAVOURS = [-2, -1, 1, 2, 21]
+XS = np.logspace(-5, -0.01, 20)
+QS = [[1.65, 2, 3, 4.5], [4.5, 10, 100, 1000, 1e4]]
+
+def linear(m, x, Q):
+    """Linear in log x and log Q^2, so the interpolation is exact."""
+    fl = np.arange(len(FLAVOURS))
+    return (m + 1)*(1 + fl + 0.3*np.log(x) - 0.2*fl*np.log(Q**2))
+
+def extrapolate(x, xl, xh, yl, yh):
+    #LHAPDF's continuation, in log y if both values are above 1e-3
+    if yl > 1e-3 and yh > 1e-3:
+        return np.exp(np.log(yl) + (x - xl)/(xh - xl)*np.log(yh/yl))
+    return yl + (x - xl)/(xh - xl)*(yh - yl)
+
+def write_member(path, m, func):
+    with open(path, 'w') as f:
+        f.write('PdfType: replica\nFormat: lhagrid1\n---\n')
+        for qs in QS:
+            f.write(' '.join('%.10e' % x for x in XS) + '\n')
+            f.write(' '.join('%.10e' % q for q in qs) + '\n')
+            f.write(' '.join('%d' % fl for fl in FLAVOURS) + '\n')
+            for x in XS:
+                for q in qs:
+                    f.write(' '.join('%.16e' % v for v in func(m, x, q)) +
+                            '\n')
+            f.write('---\n')
+
+
+class TestLHAGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = [osp.join(self.directory, 'set_%04d.dat' % m)
+                      for m in range(3)]
+        for m, path in enumerate(self.paths):
+            write_member(path, m, linear)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read(self):
+        header, subgrids = read_member(self.paths[1])
+        self.assertIn(b'lhagrid1', header)
+        self.assertEqual(len(subgrids), 2)
+        x, q, flavours, values = subgrids[1]
+        self.assertEqual(values.shape, (len(XS), len(QS[1]), len(FLAVOURS)))
+        self.assertTrue(np.allclose(values[3, 2], linear(1, XS[3], q[2])))
+
+    def test_interpolation(self):
+        grids = GridSet.from_files(self.paths)
+        self.assertEqual(len(grids), 3)
+        xs = np.logspace(-4.5, -0.02, 37)
+        for Q in (1.7, 3.3, 4.5, 7, 150, 9000):
+            values = grids.xfxQ_grid([2, 0], [1, 2, 0, 5], xs, Q)
+            self.assertEqual(values.shape, (2, 4, len(xs)))
+            for i, m in enumerate([2, 0]):
+                expected = np.array([linear(m, x, Q) for x in xs]).T
+                #d, u and g (0 is the gluon); no top
+                self.assertTrue(np.allclose(values[i, :3], expected[[2, 3, 4]]))
+                self.assertTrue(np.all(values[i, 3] == 0))
+
+    def test_extrapolation(self):
+        fl = [1, 2, 21]
+        ifl = [2, 3, 4]
+        qmin, qmax = QS[0][0], QS[-1][-1]
+        nearest = GridSet.from_files(self.paths, extrapolator='Nearest')
+        continuation = GridSet.from_files(self.paths)
+        error = GridSet.from_files(self.paths, extrapolator='Error')
+        for x, Q in ((1e-7, 10), (XS[3], 1e5), (XS[3], 1.2)):
+            xc = np.clip(x, XS[0], XS[-1])
+            Qc = np.clip(Q, qmin, qmax)
+            values = nearest.xfxQ_grid([1], fl, [x], Q)[0, :, 0]
+            self.assertTrue(np.allclose(values, linear(1, xc, Qc)[ifl]))
+            with self.assertRaises(RangeError):
+                error.xfxQ_grid([1], fl, [x], Q)
+        #Below the x range
+        values = continuation.xfxQ_grid([1], fl, [1e-7], 10)[0, :, 0]
+        expected = [extrapolate(1e-7, XS[0], XS[1], yl, yh) for yl, yh in
+                    zip(linear(1, XS[0], 10)[ifl], linear(1, XS[1], 10)[ifl])]
+        self.assertTrue(np.allclose(values, expected))
+        #Above the Q range
+        values = continuation.xfxQ_grid([1], fl, [XS[3]], 1e5)[0, :, 0]
+        expected = [extrapolate(1e10, qmax**2, QS[-1][-2]**2, yl, yh)
+                    for yl, yh in zip(linear(1, XS[3], qmax)[ifl],
+                                      linear(1, XS[3], QS[-1][-2])[ifl])]
+        self.assertTrue(np.allclose(values, expected))
+        #Below the Q range
+        values = continuation.xfxQ_grid([1], fl, [XS[3]], 1.2)[0, :, 0]
+        fmin = linear(1, XS[3], qmin)[ifl]
+        f1 = linear(1, XS[3], QS[0][1])[ifl]
+        anom = np.log(f1/fmin)/np.log(QS[0][1]**2/qmin**2)
+        r = 1.2**2/qmin**2
+        self.assertTrue(np.allclose(values, fmin*r**(anom*r + 1 - r)))
+        #Above the x range
+        with self.assertRaises(RangeError):
+            continuation.xfxQ_grid([1], fl, [0.999], 10)
+        with self.assertRaises(ValueError):
+            GridSet.from_files(self.paths, extrapolator='patata')
+
+    def test_knots(self):
+        rng = np.random.RandomState(0)
+        func = lambda m, x, Q: rng.normal(size=len(FLAVOURS))
+        for m, path in enumerate(self.paths):
+            write_member(path, m, func)
+        grids = GridSet.from_files(self.paths)
+        _, subgrids = read_member(self.paths[0])
+        x, q, flavours, values = subgrids[0]
+        result = grids.xfxQ_multigrid([0], flavours, x, q[:-1])
+        self.assertTrue(np.allclose(result[:, 0],
+                                    np.transpose(values[:, :-1], (1, 2, 0))))
+
+
+if __name__ == '__main__':
+    unittest.main()
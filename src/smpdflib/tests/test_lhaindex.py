@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Test the fingerprinting of files.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import os.path as osp
+import hashlib
+from unittest import mock
+
+from smpdflib import lhaindex
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.oldcache = os.environ.get('SMPDF_CACHE_DIR')
+        os.environ['SMPDF_CACHE_DIR'] = osp.join(self.directory, 'cache')
+        lhaindex._fingerprint_index = None
+
+    def tearDown(self):
+        if self.oldcache is None:
+            del os.environ['SMPDF_CACHE_DIR']
+        else:
+            os.environ['SMPDF_CACHE_DIR'] = self.oldcache
+        lhaindex._fingerprint_index = None
+        shutil.rmtree(self.directory)
+
+    def test_file_digests(self):
+        path = osp.join(self.directory, 'set_0000.dat')
+        with open(path, 'wb') as f:
+            f.write(b'patata')
+        digest, = lhaindex.file_digests([path])
+        self.assertEqual(digest, hashlib.sha1(b'patata').hexdigest())
+        self.assertTrue(osp.exists(lhaindex.fingerprint_index_path()))
+
+        #A new process reads the index from disk
+        lhaindex._fingerprint_index = None
+        self.assertEqual(lhaindex.file_digests([path]), [digest])
+
+        #Changes in the file invalidate the entry
+        with open(path, 'wb') as f:
+            f.write(b'patatas')
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertEqual(lhaindex.file_digests([path]),
+                         [hashlib.sha1(b'patatas').hexdigest()])
+
+
+def write_set(path, name, nmembers):
+    os.makedirs(osp.join(path, name))
+    with open(osp.join(path, name, name + '.info'), 'w') as f:
+        f.write('SetDesc: "A set"\nNumMembers: %d\nErrorType: replicas\n'
+                'Flavors: [-1, 1, 21]\n' % nmembers)
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.oldcache = os.environ.get('SMPDF_CACHE_DIR')
+        os.environ['SMPDF_CACHE_DIR'] = osp.join(self.directory, 'cache')
+        self.paths = [osp.join(self.directory, 'a'),
+                      osp.join(self.directory, 'b')]
+        for path in self.paths:
+            os.makedirs(path)
+        write_set(self.paths[0], 'NNPDF_patata', 100)
+        write_set(self.paths[1], 'NNPDF_patata', 1000)
+        write_set(self.paths[1], 'CT_patata', 50)
+        os.makedirs(osp.join(self.paths[1], 'notaset'))
+        self.patch = mock.patch.object(lhaindex, 'get_lha_paths',
+                                       lambda: self.paths)
+        self.patch.start()
+        lhaindex._catalog = None
+
+    def tearDown(self):
+        self.patch.stop()
+        if self.oldcache is None:
+            del os.environ['SMPDF_CACHE_DIR']
+        else:
+            os.environ['SMPDF_CACHE_DIR'] = self.oldcache
+        lhaindex._catalog = None
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        self.assertEqual(lhaindex.expand_local_names('*patata'),
+                         ['CT_patata', 'NNPDF_patata'])
+        self.assertEqual(lhaindex.expand_local_names('notaset'), ['notaset'])
+        #The first path takes precedence
+        self.assertEqual(lhaindex.parse_info('NNPDF_patata')['NumMembers'],
+                         100)
+        self.assertEqual(lhaindex.parse_info('CT_patata')['Flavors'],
+                         [-1, 1, 21])
+        infos = lhaindex.set_infos(['CT_patata', 'missing'])
+        self.assertEqual(list(infos), ['CT_patata'])
+        self.assertEqual(infos['CT_patata']['ErrorType'], 'replicas')
+        #Looking up a field does not copy the others
+        with mock.patch.object(lhaindex.copy, 'deepcopy',
+                               wraps=lhaindex.copy.deepcopy) as deepcopy:
+            self.assertEqual(lhaindex.parse_info('CT_patata')['NumMembers'],
+                             50)
+            self.assertEqual(deepcopy.call_count, 1)
+
+    def test_refresh(self):
+        lhaindex.installed_sets()
+        #New sets are found when the path changes
+        write_set(self.paths[0], 'MMHT_patata', 51)
+        st = os.stat(self.paths[0])
+        os.utime(self.paths[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertEqual(lhaindex.parse_info('MMHT_patata')['NumMembers'], 51)
+
+        #A new process reads the catalog from disk and rereads changed info
+        #files only
+        lhaindex._catalog = None
+        info = osp.join(self.paths[1], 'CT_patata', 'CT_patata.info')
+        with open(info, 'a') as f:
+            f.write('AlphaS_MZ: 0.118\n')
+        with mock.patch.object(lhaindex, '_read_info',
+                               wraps=lhaindex._read_info) as read_info:
+            self.assertEqual(lhaindex.parse_info('CT_patata')['AlphaS_MZ'],
+                             0.118)
+            self.assertEqual(read_info.call_count, 1)
+    def test_info_cache(self):
+        info = osp.join(self.paths[1], 'CT_patata', 'CT_patata.info')
+        with open(info, 'a') as f:
+            f.write('Thresholds: {4: 1.3, 5: 4.75}\nDate: 2015-06-01\n')
+        parsed = lhaindex.parse_info('CT_patata')
+        #The types of the YAML are kept
+        self.assertEqual(parsed['Thresholds'], {4: 1.3, 5: 4.75})
+        self.assertNotIsInstance(parsed['Date'], str)
+        #Callers get a read only view, with copies of the values
+        parsed['Flavors'].append(2)
+        with self.assertRaises(TypeError):
+            parsed['NumMembers'] = 0
+        #Sets in memory are served without scanning the paths
+        with mock.patch.object(lhaindex, 'get_lha_paths') as paths:
+            again = lhaindex.parse_info('CT_patata')
+            self.assertFalse(paths.called)
+        self.assertEqual(again['Flavors'], [-1, 1, 21])
+        self.assertEqual(again['NumMembers'], 50)
+        #Also when read back from disk
+        lhaindex._catalog = None
+        self.assertEqual(lhaindex.parse_info('CT_patata')['Thresholds'],
+                         {4: 1.3, 5: 4.75})
+
+
+if __name__ == '__main__':
+    unittest.main()
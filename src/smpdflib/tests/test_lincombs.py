@@ -9,8 +9,15 @@ from collections import OrderedDict
 import unittest
 
 import numpy as np
+import pandas as pd
 
-from smpdflib.reducedset import merge_lincombs
+from smpdflib.core import Observable, MCResult
+from smpdflib.reducedset import merge_lincombs, _bin_scales
+
+class FakeObservable(Observable):
+    def __init__(self, name, meanQ):
+        super().__init__(name, 1)
+        self._meanQ = meanQ
 
 class TestLincombs(unittest.TestCase):
     def test_merge_lincombs(self):
@@ -64,5 +71,13 @@ class TestLincombs(unittest.TestCase):
                                                     1,  1,  1,  1, 1,  1,  1,]]
                                                     )).all())
 
+    def test_bin_scales(self):
+        values = pd.DataFrame(np.ones((4, 3)))
+        full = MCResult(FakeObservable('a', [10, 20, 30, 40]), None, values)
+        #Only some of the bins, as in the refinement of get_smpdf_params
+        part = MCResult(FakeObservable('b', [1, 2, 3, 4]), None,
+                        values.iloc[[1, 3]])
+        self.assertEqual(_bin_scales([part, full]), [2, 4, 10, 20, 30, 40])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
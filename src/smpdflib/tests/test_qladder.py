@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Test the interpolation of PDF values in a Q ladder.
+"""
+import unittest
+
+import numpy as np
+
+from smpdflib.core import PDF, QLadder, get_X, iter_X_multiQ
+
+XGRID = np.linspace(0.1, 0.9, 5)
+
+class FakePDF(PDF):
+    """PDF with values given by ``func(Q)`` that records the scales where
+    they are computed."""
+    QMin = 1.
+    QMax = 1e5
+
+    def __init__(self, func, qladder):
+        super(FakePDF, self).__init__('fake', qladder=qladder)
+        self.func = func
+        self.computed = []
+
+    def _grid_values(self, Q, xgrid=None, fl=None):
+        self.computed.append(Q)
+        reps = np.array([(1 + 0.1*r)*self.func(Q) for r in range(-2, 3)])
+        return reps.mean(axis=0), reps
+
+
+def smooth(Q):
+    #A cubic in log Q is interpolated exactly
+    l = np.log(Q)
+    return np.outer([1, 2], XGRID)*(1 + l - 0.1*l**2 + 0.01*l**3)
+
+def vanishing(Q):
+    #A flavour that is zero and one where all the replicas are equal, as
+    #close to x=1
+    return np.array([np.zeros_like(XGRID), 1e-12*np.log(Q)**6*XGRID])
+
+class SpreadlessPDF(FakePDF):
+    """PDF where the replicas are all equal to the central value."""
+    def _grid_values(self, Q, xgrid=None, fl=None):
+        self.computed.append(Q)
+        reps = np.array([self.func(Q)]*5)
+        return reps.mean(axis=0), reps
+
+def kink(Q):
+    return np.outer([1, 2], XGRID)*max(np.log(Q/4.75), 0)
+
+class EvaluatorPDF(PDF):
+    """PDF whose values depend on the evaluator."""
+    reps = range(3)
+
+    def _cached_values(self, compute, *spec):
+        return compute()
+
+    def xfxQ_grid(self, reps, fl, xgrid, Q):
+        value = 1. if self.evaluator == 'lhapdf' else 2.
+        return np.full((len(reps), len(fl), len(xgrid)), value)
+
+
+class TestQLadder(unittest.TestCase):
+
+    def test_memory_cache_key(self):
+        #Equal PDFs with different settings do not share cached values
+        lha = EvaluatorPDF('evaluators', evaluator='lhapdf')
+        numpy = EvaluatorPDF('evaluators', evaluator='numpy')
+        self.assertEqual(lha, numpy)
+        self.assertTrue(np.all(lha._grid_values(10.)[0] == 1))
+        self.assertTrue(np.all(numpy._grid_values(10.)[0] == 2))
+        self.assertIs(numpy._grid_values(10.)[0], numpy._grid_values(10.)[0])
+
+    def test_weights(self):
+        ladder = QLadder()
+        for t in (0, 0.2, 0.5, 0.9):
+            self.assertAlmostEqual(ladder.cubic_weights(t).sum(), 1)
+            self.assertAlmostEqual(ladder.quadratic_weights(t).sum(), 1)
+        self.assertTrue(np.allclose(ladder.cubic_weights(0), [0, 1, 0, 0]))
+        k, t = ladder.locate(ladder.node(23)*1.001)
+        self.assertEqual(k, 23)
+        self.assertAlmostEqual(t, 10*np.log10(1.001))
+
+    def test_interpolation(self):
+        pdf = FakePDF(smooth, QLadder(density=5))
+        Qs = np.logspace(0.5, 3.5, 200)
+        for Q in Qs:
+            mean, reps = pdf.grid_values(Q)
+            self.assertTrue(np.allclose(reps, FakePDF._grid_values(
+                                        FakePDF(smooth, None), Q)[1]))
+        self.assertTrue(set(pdf.computed) <=
+                        {pdf.qladder.node(k) for k in range(0, 20)})
+        self.assertLess(len(set(pdf.computed)), 20)
+
+    def test_fallback(self):
+        pdf = FakePDF(kink, QLadder(density=5))
+        pdf.grid_values(4.9)
+        self.assertIn(4.9, pdf.computed)
+        #Outside of the range of the set
+        pdf = FakePDF(smooth, QLadder())
+        pdf.grid_values(1.05)
+        self.assertIn(1.05, pdf.computed)
+        mean, reps = pdf.grid_values_multiQ([10, 11])
+        self.assertEqual(reps.shape, (2, 5, 2, len(XGRID)))
+
+    def test_no_spread(self):
+        pdf = SpreadlessPDF(vanishing, QLadder(density=5))
+        pdf.grid_values(37.)
+        self.assertNotIn(37., pdf.computed)
+        #Without an absolute tolerance the ladder is not used
+        pdf = SpreadlessPDF(vanishing, QLadder(density=5, atol=0))
+        pdf.grid_values(37.)
+        self.assertIn(37., pdf.computed)
+
+    def test_iter_X(self):
+        pdf = FakePDF(smooth, QLadder())
+        sweeps = []
+        multiQ = pdf.grid_values_multiQ
+        def record(Qs, *args):
+            sweeps.append(list(Qs))
+            return multiQ(Qs, *args)
+        pdf.grid_values_multiQ = record
+        Qs = [10, 20, 10.001, 30, 40, 20, 50]
+        Xs = list(iter_X_multiQ(pdf, Qs, chunksize=2))
+        self.assertEqual(len(Xs), len(Qs))
+        #10.001 is evaluated at 10
+        for Q, X in zip([10, 20, 10, 30, 40, 20, 50], Xs):
+            self.assertTrue(np.allclose(X, get_X(pdf, Q, reshape=True)))
+        #Each distinct scale is evaluated once
+        self.assertEqual(sweeps, [[10, 20], [30, 40], [50]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Test the binary store of PDF replicas.
+"""
+import unittest
+import tempfile
+import shutil
+import os.path as osp
+
+import numpy as np
+
+from smpdflib.lhagrid import GridSet, read_member
+from smpdflib.replicastore import (write_store, ReplicaStore,
+                                   ReplicaStoreError)
+from smpdflib.tests.test_lhagrid import (write_member, linear, XS, QS,
+                                         FLAVOURS)
+
+
+class TestReplicaStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = [osp.join(self.directory, 'set_%04d.dat' % m)
+                      for m in range(3)]
+        for m, path in enumerate(self.paths):
+            write_member(path, m, linear)
+        self.filename = osp.join(self.directory, 'set.rep')
+        write_store(self.filename, self.paths, b'\x01\x02')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_values(self):
+        store = ReplicaStore(self.filename)
+        self.assertEqual(store.fingerprint, b'\x01\x02')
+        self.assertEqual(len(store), 3)
+        self.assertIsInstance(store.values, np.memmap)
+        for m, path in enumerate(self.paths):
+            header, subgrids = read_member(path)
+            self.assertEqual(store.headers[m], header)
+            flat = np.concatenate([s[3].ravel() for s in subgrids])
+            self.assertTrue(np.array_equal(store.values[m], flat))
+            for isub, subgrid in enumerate(subgrids):
+                self.assertTrue(np.array_equal(store.subgrid_values(isub)[m],
+                                               subgrid[3]))
+
+    def test_index(self):
+        store = ReplicaStore(self.filename)
+        index = store.index
+        self.assertEqual(len(index), store.values.shape[1])
+        #subgrid, x, Q, flavour of the second subgrid
+        sub, x, q, fl = index[len(XS)*len(QS[0])*len(FLAVOURS) + 7]
+        self.assertEqual((sub, fl), (1, FLAVOURS[2]))
+        self.assertTrue(np.allclose([x, q], [XS[0], QS[1][1]]))
+
+    def test_gridset(self):
+        store = ReplicaStore(self.filename)
+        grids = GridSet([subgrid + (store.subgrid_values(isub),)
+                         for isub, subgrid in enumerate(store.subgrids)])
+        expected = GridSet.from_files(self.paths)
+        xs = np.logspace(-4, -0.1, 11)
+        self.assertTrue(np.allclose(grids.xfxQ_grid([0, 2], [1, 21], xs, 50),
+                                    expected.xfxQ_grid([0, 2], [1, 21], xs,
+                                                       50)))
+
+    def test_bad_files(self):
+        with open(self.filename, 'r+b') as f:
+            f.write(b'patata')
+        with self.assertRaises(ReplicaStoreError):
+            ReplicaStore(self.filename)
+        #Different nodes in one member
+        with open(self.paths[2]) as f:
+            text = f.read()
+        with open(self.paths[2], 'w') as f:
+            f.write(text.replace('%.10e' % QS[1][1], '%.10e' % 11, 1))
+        with self.assertRaises(ValueError):
+            write_store(self.filename, self.paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
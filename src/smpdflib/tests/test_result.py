@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Test the computation of uncertainties of results.
+"""
+from collections import OrderedDict
+import pickle
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from smpdflib.core import (MCResult, SymHessianResult, HessianResult,
+                           BaseObservable,
+                           ResultSet, results_table, summed_results_table)
+
+class FakePDF(object):
+    label = 'fake'
+    collaboration = 'FAKE'
+    as_from_name = '0118'
+    AlphaS_MZ = 0.118
+    oqcd_str = 'NLO'
+    NumFlavors = 5
+
+def make_data(nbins=7, nmem=101, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.normal(loc=10, size=(nbins, nmem))
+
+class TestResult(unittest.TestCase):
+
+    def setUp(self):
+        self.obs = BaseObservable('patata', 1)
+        self.values = make_data()
+        self.frame = pd.DataFrame(self.values)
+
+    def test_inputs(self):
+        members = OrderedDict((m, self.values[:, m])
+                              for m in range(self.values.shape[1]))
+        for data in (self.values, self.frame, members):
+            result = MCResult(self.obs, FakePDF(), data)
+            self.assertEqual(result.nbins, 7)
+            self.assertEqual(result.nrep, 100)
+            self.assertTrue(np.array_equal(result._data.values, self.values))
+            self.assertTrue(np.array_equal(result[3], self.values[:, 3]))
+            self.assertEqual(list(result.iterreplicas()), list(range(101)))
+        self.assertFalse(hasattr(result, '__dict__'))
+
+    def test_labels(self):
+        frame = self.frame.iloc[[2, 5]]
+        result = MCResult(self.obs, FakePDF(), frame)
+        self.assertEqual(list(result.binlabels), [2, 5])
+        self.assertTrue(np.array_equal(result.central_value.loc[5],
+                                       self.values[5, 0]))
+        summed = result.sumbins()
+        self.assertEqual(summed.nbins, 1)
+        self.assertTrue(np.allclose(summed._values[0],
+                                    self.values[[2, 5]].sum(axis=0)))
+
+    def test_mc_errors(self):
+        result = MCResult(self.obs, FakePDF(), self.values)
+        diffs = self.frame.iloc[:, 1:].subtract(self.frame[0], axis=0)
+        self.assertTrue(np.allclose(result.std_error(),
+                                    self.frame.iloc[:, 1:].std(axis=1)))
+        interval = result.errorbar68
+        for b in range(result.nbins):
+            row = diffs.iloc[b].values
+            sel = row[np.argsort(np.abs(row))][:68]
+            self.assertEqual(interval['min'][b], sel.min())
+            self.assertEqual(interval['max'][b], sel.max())
+
+    def test_centered_intervals(self):
+        result = MCResult(self.obs, FakePDF(), self.values)
+        diffs = self.values[:, 1:] - self.values[:, :1]
+        intervals = result.centered_intervals([68, 95, 50], addcentral=False)
+        self.assertEqual(list(intervals), [68, 95, 50])
+        for p, interval in intervals.items():
+            for b in range(result.nbins):
+                row = diffs[b]
+                sel = row[np.argsort(np.abs(row))][:p]
+                self.assertEqual(interval['min'][b], sel.min())
+                self.assertEqual(interval['max'][b], sel.max())
+        self.assertIn(('centered', 95), result._cache)
+        centered = result.centered_interval(95)
+        self.assertTrue(np.allclose(centered['max'],
+                                    intervals[95]['max'] + self.values[:, 0]))
+        with self.assertRaises(ValueError):
+            result.centered_interval(0.5)
+
+    def test_hessian_errors(self):
+        result = SymHessianResult(self.obs, FakePDF(), self.values)
+        diffs = self.values[:, 1:] - self.values[:, :1]
+        std = np.sqrt((diffs**2).sum(axis=1))
+        self.assertTrue(np.allclose(result.std_error(), std))
+        self.assertTrue(np.allclose(result.errorbar68['max'], std))
+        self.assertTrue(np.allclose(result.std_interval()['min'],
+                                    self.values[:, 0] - std))
+
+    def test_sampling(self):
+        for cls in (MCResult, SymHessianResult, HessianResult):
+            result = cls(self.obs, FakePDF(), self.values)
+            samples = result.sample_matrix(1000, rng=1, chunksize=300)
+            self.assertEqual(samples.shape, (1000, result.nbins))
+            #Reproducible with the same seed, regardless of the chunks
+            again = result.sample_matrix(1000, rng=np.random.default_rng(1),
+                                         chunksize=1000)
+            self.assertTrue(np.allclose(samples, again))
+            values = list(result.sample_values(3))
+            self.assertEqual(len(values), 3)
+            self.assertEqual(len(values[0]), result.nbins)
+        #MC samples are members
+        result = MCResult(self.obs, FakePDF(), self.values)
+        samples = result.sample_matrix(50, rng=0)
+        for sample in samples:
+            self.assertTrue(np.any(np.all(self.values[:, 1:].T == sample,
+                                          axis=1)))
+        #Hessian samples have the right standard deviation
+        result = SymHessianResult(self.obs, FakePDF(), self.values)
+        samples = result.sample_matrix(20000, rng=0)
+        self.assertTrue(np.allclose(samples.std(axis=0), result.std_error(),
+                                    rtol=0.05))
+
+    def test_pickle(self):
+        result = MCResult(self.obs, FakePDF(), self.values)
+        result._data
+        new = pickle.loads(pickle.dumps(result))
+        self.assertTrue(np.array_equal(new._values, self.values))
+        self.assertIsNone(new._frame)
+        #Results pickled with the DataFrame representation
+        old = MCResult.__new__(MCResult)
+        old.__setstate__({'obs': self.obs, 'pdf': FakePDF(),
+                          '_data': self.frame})
+        self.assertTrue(np.array_equal(old._values, self.values))
+
+    def test_result_set(self):
+        pdfs = FakePDF(), FakePDF()
+        results = [MCResult(BaseObservable('obs%d' % i, 1), pdfs[i%2],
+                            make_data(nbins=i+1, seed=i))
+                   for i in range(5)]
+        result_set = ResultSet(results[::2])
+        self.assertEqual(result_set.values.shape, (1 + 3 + 5, 101))
+        self.assertEqual(list(result_set.index.get_level_values('Bin')),
+                         [0, 0, 1, 2, 0, 1, 2, 3, 4])
+        for result, summed in zip(result_set, result_set.sumbins()):
+            self.assertTrue(np.allclose(summed._values,
+                                        result.sumbins()._values))
+
+        table = results_table(results)
+        self.assertEqual(len(table), 15)
+        offset = 0
+        for result in results:
+            rows = table.iloc[offset:offset+result.nbins]
+            offset += result.nbins
+            self.assertTrue(all(r is result for r in rows.Result))
+            self.assertEqual(list(rows.Bin), list(range(1, result.nbins+1)))
+            self.assertTrue(np.allclose(rows.CV, result.central_value))
+            self.assertTrue(np.allclose(rows.Up68,
+                                        np.abs(result.errorbar68['max'])))
+            self.assertTrue(np.allclose(rows.Down68,
+                                        np.abs(result.errorbar68['min'])))
+        self.assertIsNot(table.Remarks[0], table.Remarks[1])
+
+        summed = summed_results_table(table)
+        self.assertEqual(len(summed), 5)
+        self.assertEqual(summed.Observable[1].name, 'obs1[Sum]')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Test the store of convolution results.
+"""
+from collections import OrderedDict
+import multiprocessing
+import os
+import os.path as osp
+import shelve
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from smpdflib.core import PDF, get_dataset
+from smpdflib.resultstore import ResultStore, migrate_shelve, open_store
+
+def make_entry(nmem=5, nbins=3, seed=0):
+    rng = np.random.RandomState(seed)
+    return OrderedDict((m, rng.rand(nbins)) for m in range(nmem))
+
+def write_entries(args):
+    store, worker = args
+    for i in range(10):
+        store['worker %d %d' % (worker, i)] = make_entry(seed=i)
+        store['shared'] = make_entry(seed=worker)
+
+class FakeHandle(object):
+    max_resident = 3
+
+class FakePDF(object):
+    handle = FakeHandle()
+    iter_member_chunks = PDF.iter_member_chunks
+
+    def __init__(self, nmembers):
+        self.NumMembers = nmembers
+        self.digests = ['d%d' % m for m in range(nmembers)]
+
+    def get_key(self):
+        return ('fake',)
+
+    @property
+    def reps(self):
+        return range(self.NumMembers)
+
+    def member_digests(self):
+        return self.digests
+
+class FakeObservable(object):
+    sha1hash = b'\x01'
+    order = 1
+    def __init__(self, fail_after=None):
+        self.calls = []
+        self.fail_after = fail_after
+
+    def get_key(self):
+        return ('fake.root', 1)
+
+    def convolute(self, pdf, members):
+        if self.fail_after is not None and len(self.calls) == self.fail_after:
+            raise RuntimeError("Killed")
+        self.calls.append(list(members))
+        return np.array([[m, 2*m] for m in members], dtype=float)
+
+class TestResultStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = osp.join(self.directory, 'db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertEntryEqual(self, a, b):
+        self.assertEqual(list(a), list(b))
+        for x, y in zip(a.values(), b.values()):
+            self.assertTrue(np.array_equal(x, y))
+
+    def test_roundtrip(self):
+        store = ResultStore(self.path)
+        entry = make_entry()
+        store['a'] = entry
+        self.assertIn('a', store)
+        self.assertNotIn('b', store)
+        self.assertEntryEqual(store['a'], entry)
+        members, values = ResultStore(self.path).load('a')
+        self.assertEqual(members, list(range(5)))
+        self.assertIsInstance(values, np.memmap)
+        self.assertEqual(values.shape, (5, 3))
+        #Replacing removes the old block
+        store['a'] = make_entry(seed=1)
+        self.assertEntryEqual(store['a'], make_entry(seed=1))
+        self.assertEqual(len(os.listdir(osp.join(self.path, 'blocks'))), 1)
+        store['b'] = entry
+        self.assertEqual(store.existing(['a', 'b', 'c']), {'a', 'b'})
+        self.assertEqual(sorted(store), ['a', 'b'])
+        del store['a']
+        self.assertEqual(len(store), 1)
+        with self.assertRaises(KeyError):
+            store['a']
+
+    def test_concurrent_writes(self):
+        store = ResultStore(self.path)
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.map(write_entries, [(store, w) for w in range(4)])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len(store), 41)
+        self.assertEntryEqual(store['worker 3 7'], make_entry(seed=7))
+        self.assertIn(store['shared'][0][0],
+                      [make_entry(seed=w)[0][0] for w in range(4)])
+        self.assertEqual(len(os.listdir(osp.join(self.path, 'blocks'))), 41)
+
+    def test_migrate(self):
+        shelve_path = osp.join(self.directory, 'old')
+        a = str((('NNPDF',), ('a.root', 1)))
+        b = str((('NNPDF',), ('b.root', 1)))
+        db = shelve.open(shelve_path)
+        db[a] = make_entry()
+        db[b] = make_entry(seed=1)
+        db.close()
+        store = open_store(shelve_path)
+        self.assertEqual(store.path, shelve_path + '.store')
+        self.assertEntryEqual(store[b], make_entry(seed=1))
+        self.assertEqual(migrate_shelve(shelve_path, store), 0)
+        self.assertEqual(open_store(shelve_path).existing([a, b]), {a, b})
+
+    def test_migrate_mixed(self):
+        shelve_path = osp.join(self.directory, 'old')
+        key = str((('NNPDF',), ('grid.root', 1)))
+        db = shelve.open(shelve_path)
+        db[key] = make_entry()
+        db["(load_all_replicas, ('NNPDF',))"] = (['header'], [np.ones(3)])
+        db[str((('NNPDF',), ('other.root', 0)))] = (['header'], None)
+        db.close()
+        store = open_store(shelve_path)
+        self.assertEqual(list(store), [key])
+        self.assertEntryEqual(store[key], make_entry())
+        self.assertTrue(osp.exists(osp.join(store.path, 'migrated')))
+        with self.assertRaises(TypeError):
+            store['x'] = ([], [])
+
+    def test_members(self):
+        store = ResultStore(self.path)
+        store.store_members('k', [0, 1, 2], np.eye(3), ['a', 'b', 'c'])
+        store.store_members('k', [2, 3], np.ones((2, 3)), ['C', 'd'])
+        self.assertEqual(store.stored_members(['k', 'l']),
+                         {'k': {0: 'a', 1: 'b', 2: 'C', 3: 'd'}, 'l': {}})
+        self.assertTrue(np.array_equal(store.load_members('k', [3, 0, 2]),
+                                       [[1, 1, 1], [1, 0, 0], [1, 1, 1]]))
+        with self.assertRaises(KeyError):
+            store.load_members('k', [4])
+        #The first block is still used by members 0 and 1
+        self.assertEqual(len(os.listdir(osp.join(self.path, 'blocks'))), 2)
+        store.store_members('k', [0, 1], np.zeros((2, 3)), ['a', 'b'])
+        self.assertEqual(len(os.listdir(osp.join(self.path, 'blocks'))), 2)
+
+    def test_incremental_dataset(self):
+        store = ResultStore(self.path)
+        pdf = FakePDF(8)
+        obs = FakeObservable(fail_after=2)
+        with self.assertRaises(RuntimeError):
+            get_dataset([pdf], [obs], store, engine='applgrid')
+        self.assertEqual(obs.calls, [[0, 1, 2], [3, 4, 5]])
+        #Resume from the stored chunks
+        obs = FakeObservable()
+        dataset = get_dataset([pdf], [obs], store, engine='applgrid')
+        self.assertEqual(obs.calls, [[6, 7]])
+        self.assertEqual(list(dataset[pdf][obs]), list(range(8)))
+        self.assertTrue(np.array_equal(dataset[pdf][obs][5], [5, 10]))
+        #Extend the set and modify a member
+        pdf = FakePDF(10)
+        pdf.digests[1] = 'new'
+        obs = FakeObservable()
+        dataset = get_dataset([pdf], [obs], store, engine='applgrid')
+        self.assertEqual(obs.calls, [[1, 8, 9]])
+        self.assertEqual(len(dataset[pdf][obs]), 10)
+        obs = FakeObservable()
+        get_dataset([pdf], [obs], store, engine='applgrid')
+        self.assertEqual(obs.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
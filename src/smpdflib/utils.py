@@ -4,9 +4,40 @@ Created on Wed Jun 24 15:41:26 2015
 
 @author: zah
 """
+import os
+import os.path as osp
+import tempfile
+
 import pandas as pd
 import numpy as np
 
+#Environment variable that overrides the location of the on disk caches.
+CACHE_DIR_ENV = 'SMPDF_CACHE_DIR'
+
+def get_cache_dir(*subdirs):
+    """Return the directory where the on disk caches are stored, creating it
+    if needed. It is ``$SMPDF_CACHE_DIR`` if set, or ``~/.cache/smpdf``
+    otherwise. ``subdirs`` are joined to the base path."""
+    base = os.environ.get(CACHE_DIR_ENV)
+    if not base:
+        base = osp.join(osp.expanduser('~'), '.cache', 'smpdf')
+    path = osp.join(base, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def save_npz_atomic(filename, **arrays):
+    """Write ``arrays`` to the ``.npz`` file ``filename`` atomically, so
+    that concurrent processes never see a partial file."""
+    fd, tmpname = tempfile.mkstemp(dir=osp.dirname(filename),
+                                   suffix='.npz.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
 def save_html(df, path):
     import jinja2
 